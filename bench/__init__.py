@@ -0,0 +1 @@
+"""Benchmark offline y dobles de prueba (gspread / Telegram) del bot."""
@@ -0,0 +1,154 @@
+"""
+Prueba offline del archivo de meses (services.archivo.compactar) sobre el
+spreadsheet falso de bench.fakes. Es el único camino que borra filas de las
+hojas vivas, así que se revisa fila por fila lo que queda en cada hoja:
+- los gastos de meses cerrados pasan a su hoja de archivo y salen de Gastos;
+- una fecha que no es AAAA-MM-DD (escrita a mano) no se archiva ni se borra;
+- de Pendientes solo salen los OK de meses cerrados, y el cursor de la
+  ingesta se corre con ellos;
+- si la hoja cambia entre la lectura y el borrado, no se borra nada, y la
+  pasada siguiente termina el trabajo sin duplicar el archivo.
+
+Sale con código 1 si algo no cuadra, para que CI lo detecte.
+
+Uso:
+    python -m bench.archivo
+"""
+import os
+import sys
+import tempfile
+from datetime import date
+
+# Antes de importar el bot: sin credenciales reales, backend Sheets y bases
+# locales en un directorio temporal
+_tmp = tempfile.mkdtemp(prefix="gastobot-archivo-")
+os.environ.setdefault("GOOGLE_SHEET_ID", "bench")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "bench")
+os.environ["STORAGE_BACKEND"] = "sheets"
+os.environ["SHEETS_READS_PER_MIN"] = "1000000"
+os.environ["SHEETS_WRITES_PER_MIN"] = "1000000"
+os.environ["SHEETS_BURST"] = "1000000"
+os.environ["ARCHIVO_MESES"] = "3"
+
+from bench.fakes import FakeClient, FakeSpreadsheet  # noqa: E402
+from services import archivo, ingesta, sheets  # noqa: E402
+
+CHAT_ID = "4242"
+HOY = date.today().strftime("%Y-%m-%d")
+
+GASTOS = [
+    ["fecha", "hora", "descripcion", "monto", "categoria", "comercio_raw", "alias", "usuario", "chat_id", "email_id"],
+    ["2024-01-03", "10:00", "", "1000", "Comida", "COMERCIO A", "A", "telegram", CHAT_ID, "G1"],
+    ["2024-01-05", "10:00", "", "2000", "Comida", "COMERCIO A", "A", "telegram", CHAT_ID, "G2"],
+    ["03/01/2024", "10:00", "", "3000", "Hogar", "COMERCIO B", "B", "a mano", CHAT_ID, ""],
+    ["2024-02-10", "10:00", "", "4000", "Hogar", "COMERCIO B", "B", "telegram", CHAT_ID, "G4"],
+    [HOY, "10:00", "", "5000", "Ocio", "COMERCIO C", "C", "telegram", CHAT_ID, "G5"],
+]
+
+PENDIENTES = [
+    ["email_id", "fecha", "hora", "monto", "comercio_raw", "desc", "estado"],
+    ["G1", "2024-01-03", "10:00", "1.000", "COMERCIO A", "", "OK"],
+    ["P2", "2024-01-04", "10:00", "1.500", "COMERCIO X", "", ""],
+    ["G2", "2024-01-05", "10:00", "2.000", "COMERCIO A", "", "OK"],
+    ["P4", "2024-1x-05", "10:00", "2.500", "COMERCIO A", "", "OK"],
+    ["G4", "2024-02-10", "10:00", "4.000", "COMERCIO B", "", "OK"],
+    ["G5", HOY, "10:00", "5.000", "COMERCIO C", "", "OK"],
+]
+
+
+def construir_planilla() -> FakeSpreadsheet:
+    return FakeSpreadsheet({
+        "Usuarios": [["chat_id", "nombre", "estado", "fecha"], [CHAT_ID, "Bench", "AUTORIZADO", "2024-01-01"]],
+        "Comercios": [["comercio_raw", "alias", "categoria"], ["COMERCIO A", "A", "Comida"]],
+        "Pendientes": [list(r) for r in PENDIENTES],
+        "Gastos": [list(r) for r in GASTOS],
+    })
+
+
+def _preparar(carpeta: str) -> FakeSpreadsheet:
+    os.environ["ARCHIVO_PATH"] = os.path.join(carpeta, "archivo.sqlite3")
+    os.environ["INGESTA_PATH"] = os.path.join(carpeta, "ingesta.sqlite3")
+    planilla = construir_planilla()
+    sheets.set_client(FakeClient(planilla))
+    sheets.reset_indices()
+    sheets.cargar_indices()
+    # La ingesta ya leyó hasta G5 (fila 7 de Pendientes)
+    ingesta.set_cursor(7)
+    return planilla
+
+
+def _ids(planilla: FakeSpreadsheet, hoja: str, col: int) -> list[str]:
+    return [r[col] if len(r) > col else "" for r in planilla.tabs[hoja].rows[1:]]
+
+
+def _revisar_archivado(planilla: FakeSpreadsheet, fallas: list, etapa: str):
+    def esperar(que, obtenido, esperado):
+        if obtenido != esperado:
+            fallas.append(f"{etapa}: {que} = {obtenido!r}, se esperaba {esperado!r}")
+
+    esperar("Gastos", [r[0] for r in planilla.tabs["Gastos"].rows], ["fecha", "03/01/2024", HOY])
+    esperar("Gastos 2024-01", _ids(planilla, "Gastos 2024-01", 9), ["G1", "G2"])
+    esperar("Gastos 2024-02", _ids(planilla, "Gastos 2024-02", 9), ["G4"])
+    esperar("Pendientes", _ids(planilla, "Pendientes", 0), ["P2", "P4", "G5"])
+    esperar("cursor de la ingesta", ingesta.get_cursor(), 4)
+    esperar("ubicar(G1)", (archivo.ubicar("G1") or {}).get("hoja"), "Gastos 2024-01")
+
+
+def caso_normal(carpeta: str) -> list[str]:
+    planilla = _preparar(carpeta)
+    fallas = []
+    r = archivo.compactar()
+    if r != {"gastos": 3, "pendientes": 3}:
+        fallas.append(f"normal: compactar() = {r}, se esperaba 3 gastos y 3 pendientes")
+    _revisar_archivado(planilla, fallas, "normal")
+    return fallas
+
+
+def caso_hoja_cambiada(carpeta: str) -> list[str]:
+    planilla = _preparar(carpeta)
+    fallas = []
+    borrar = sheets._borrar_filas
+
+    def _con_fila_insertada(por_hoja):
+        # Alguien inserta una fila arriba en Pendientes entre la lectura y el borrado
+        planilla.tabs["Pendientes"].rows.insert(1, ["A MANO", "2024-01-01", "", "1", "X", "", ""])
+        planilla.tocar()
+        return borrar(por_hoja)
+
+    sheets._borrar_filas = _con_fila_insertada
+    try:
+        r = archivo.compactar()
+    finally:
+        sheets._borrar_filas = borrar
+    if r:
+        fallas.append(f"cambiada: compactar() = {r}, no debía borrar nada")
+    if _ids(planilla, "Gastos", 9) != [r[9] for r in GASTOS[1:]]:
+        fallas.append(f"cambiada: Gastos = {_ids(planilla, 'Gastos', 9)}, no debía perder filas")
+    if ingesta.get_cursor() != 7:
+        fallas.append(f"cambiada: cursor = {ingesta.get_cursor()}, no debía moverse")
+
+    # Se deshace la fila a mano: la pasada siguiente archiva sin duplicar
+    del planilla.tabs["Pendientes"].rows[1]
+    planilla.tocar()
+    archivo.compactar()
+    _revisar_archivado(planilla, fallas, "cambiada, segunda pasada")
+    return fallas
+
+
+CASOS = {"normal": caso_normal, "hoja_cambiada": caso_hoja_cambiada}
+
+
+def main() -> int:
+    fallas = []
+    for nombre, caso in CASOS.items():
+        fallas += caso(os.path.join(_tmp, nombre))
+    for f in fallas:
+        print(f"❌ {f}", file=sys.stderr)
+    if fallas:
+        return 1
+    print(f"archivo: {len(CASOS)} caso(s) OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
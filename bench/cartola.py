@@ -0,0 +1,155 @@
+"""
+Pruebas offline de la lectura de cartolas (services.cartola): el parseo de
+fechas y montos, el reconocimiento de columnas, qué líneas se importan y los
+email_id estables. No usa Sheets: el backend es un doble en memoria.
+
+Sale con código 1 si algo no cuadra, para que CI lo detecte.
+
+Uso:
+    python -m bench.cartola
+"""
+import io
+import os
+import sys
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
+
+from services import cartola, storage
+
+FALLAS = []
+
+
+def esperar(que, obtenido, esperado):
+    if obtenido != esperado:
+        FALLAS.append(f"{que} = {obtenido!r}, se esperaba {esperado!r}")
+
+
+# -------------------------
+# FUNCIONES PURAS
+# -------------------------
+def caso_fecha():
+    esperar("_fecha('2024-05-01')", cartola._fecha("2024-05-01"), "2024-05-01")
+    esperar("_fecha('01/05/2024')", cartola._fecha(" 01/05/2024 "), "2024-05-01")
+    esperar("_fecha('01-05-24')", cartola._fecha("01-05-24"), "2024-05-01")
+    esperar("_fecha('Total')", cartola._fecha("Total"), None)
+
+
+def caso_monto():
+    esperar("_monto('12.990')", cartola._monto("12.990"), 12990)
+    esperar("_monto('$ -12.990')", cartola._monto("$ -12.990"), -12990)
+    esperar("_monto('12990,00')", cartola._monto("12990,00"), 12990)
+    esperar("_monto('(1.990)')", cartola._monto("(1.990)"), -1990)
+    esperar("_monto('')", cartola._monto(""), None)
+    esperar("_monto('0')", cartola._monto("0"), None)
+
+
+def caso_columnas():
+    esperar("columnas con signo", cartola._columnas(["Fecha", "Descripción", "Monto"]),
+            {"fecha": 0, "comercio": 1, "monto": 2})
+    esperar("columnas de cargos", cartola._columnas(["Fecha", "Glosa", "Cargos", "Abonos", "Monto"]),
+            {"fecha": 0, "comercio": 1, "cargo": 2, "abono": 3})
+    esperar("sin monto", cartola._columnas(["Fecha", "Glosa"]), None)
+
+
+def caso_leer():
+    con_signo = (
+        "Cuenta 123-4\n"
+        "Fecha;Descripción;Monto;Saldo\n"
+        "01/05/2024;LIDER;-12.990;1\n"
+        "02/05/2024;DEPOSITO;500.000;1\n"
+        "03/05/2024;CAFE;(3.500);1\n"
+        "Total;;;\n"
+    )
+    saltadas = Counter()
+    esperar("leer con signo", list(cartola.leer(io.StringIO(con_signo), saltadas)),
+            [("2024-05-01", "", "LIDER", 12990), ("2024-05-03", "", "CAFE", 3500)])
+    esperar("saltadas con signo", saltadas, Counter(abonos=1, ignoradas=1))
+
+    cargos = "Fecha,Glosa,Cargos,Abonos\n2024-05-01,LIDER,12990,\n2024-05-02,ABONO,,5000\n2024-05-03,REVERSA,-100,\n"
+    saltadas = Counter()
+    esperar("leer cargos", list(cartola.leer(io.StringIO(cargos), saltadas)), [("2024-05-01", "", "LIDER", 12990)])
+    esperar("saltadas cargos", saltadas, Counter(abonos=2))
+
+    try:
+        list(cartola.leer(io.StringIO("a;b\n1;2\n")))
+        FALLAS.append("leer sin encabezado no lanzó CartolaInvalida")
+    except cartola.CartolaInvalida:
+        pass
+
+
+def caso_email_id():
+    a = cartola._email_id("2024-05-01", "Cafe", 3500, 0)
+    esperar("_email_id sin distinguir mayúsculas", cartola._email_id("2024-05-01", "CAFE", 3500, 0), a)
+    esperar("_email_id formato", (a.startswith("cartola:"), len(a)), (True, len("cartola:") + 16))
+    if cartola._email_id("2024-05-01", "CAFE", 3500, 1) == a:
+        FALLAS.append("_email_id: la segunda compra igual repite el id de la primera")
+
+
+# -------------------------
+# IMPORTACIÓN (backend en memoria)
+# -------------------------
+class _Backend:
+    def __init__(self):
+        self.gastos = {}
+
+    def get_mapping(self, comercio):
+        return ("Café", "Comida") if comercio.upper() == "CAFE" else (None, None)
+
+    def importar_gastos(self, lote, flujo=""):
+        nuevos = [g for g in lote if g["email_id"] not in self.gastos]
+        self.gastos.update((g["email_id"], g) for g in nuevos)
+        return len(nuevos)
+
+
+@contextmanager
+def _cartola(texto: str):
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(texto)
+    try:
+        yield path
+    finally:
+        os.unlink(path)
+
+
+def caso_importar():
+    # Tres cafés iguales el mismo día, uno de ellos no seguido a los otros
+    texto = (
+        "Fecha;Descripción;Monto\n"
+        "2024-05-01;CAFE;-3.500\n"
+        "2024-05-01;CAFE;-3.500\n"
+        "2024-05-01;KIOSCO;-1.000\n"
+        "2024-05-01;CAFE;-3.500\n"
+    )
+    backend = _Backend()
+    original = storage.backend
+    storage.backend = lambda: backend
+    try:
+        with _cartola(texto) as path:
+            r = cartola.importar(path, 1)
+            esperar("importados", (r["importados"], r["repetidos"], r["sin_comercio"]), (3, 0, 1))
+            esperar("email_id distintos", len(backend.gastos), 3)
+            # Reimportar el mismo archivo no duplica
+            r = cartola.importar(path, 1)
+            esperar("reimportar", (r["importados"], r["repetidos"]), (0, 3))
+    finally:
+        storage.backend = original
+
+
+CASOS = [caso_fecha, caso_monto, caso_columnas, caso_leer, caso_email_id, caso_importar]
+
+
+def main() -> int:
+    for caso in CASOS:
+        caso()
+    for f in FALLAS:
+        print(f"❌ {f}", file=sys.stderr)
+    if FALLAS:
+        return 1
+    print(f"cartola: {len(CASOS)} caso(s) OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
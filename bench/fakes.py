@@ -0,0 +1,316 @@
+"""
+Dobles en memoria de gspread y de Telegram para correr el bot sin red.
+
+FakeClient imita lo que services.sheets usa de gspread (open_by_key,
+worksheet, get_all_values, get, update_acell, append_row, values_batch_update,
+values_append, values_batch_get, get_lastUpdateTime) y cuenta lecturas,
+escrituras y bytes transferidos. Las ediciones "a mano" de un test deben
+llamar a FakeSpreadsheet.tocar() para que cambie el modifiedTime.
+"""
+import json
+import re
+from types import SimpleNamespace
+
+import gspread
+
+from services import telegram as salida
+
+
+def _bytes(obj) -> int:
+    return len(json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8"))
+
+
+def _col(letras: str) -> int:
+    n = 0
+    for c in letras:
+        n = n * 26 + (ord(c) - 64)
+    return n - 1
+
+
+def _celda(a1: str):
+    m = re.fullmatch(r"([A-Z]+)(\d+)", a1)
+    return _col(m.group(1)), int(m.group(2)) - 1
+
+
+def _split_rango(rango: str):
+    """"'Tab'!A2:C" -> ("Tab", "A2:C")."""
+    if "!" not in rango:
+        return None, rango
+    tab, a1 = rango.rsplit("!", 1)
+    return tab.strip("'"), a1
+
+
+class Contador:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.reads = 0
+        self.writes = 0
+        self.bytes = 0
+        self.metadata = 0
+
+    def snapshot(self) -> dict:
+        return {"reads": self.reads, "writes": self.writes, "bytes": self.bytes, "metadata": self.metadata}
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet: "FakeSpreadsheet", title: str, rows: list):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = len(spreadsheet.tabs)
+        self.rows = [[str(c) for c in r] for r in rows]
+
+    @property
+    def contador(self) -> Contador:
+        return self.spreadsheet.contador
+
+    @property
+    def row_count(self) -> int:
+        return max(len(self.rows), 1000)
+
+    def _ancho(self) -> int:
+        return max((len(r) for r in self.rows), default=0)
+
+    # --- lecturas ---
+    def get_all_values(self):
+        ancho = self._ancho()
+        values = [r + [""] * (ancho - len(r)) for r in self.rows]
+        self.contador.reads += 1
+        self.contador.bytes += _bytes(values)
+        return values
+
+    def _leer(self, a1: str):
+        inicio, _, fin = a1.partition(":")
+        m1 = re.fullmatch(r"([A-Z]+)(\d*)", inicio)
+        c1 = _col(m1.group(1))
+        r1 = int(m1.group(2)) - 1 if m1.group(2) else 0
+        if fin:
+            m2 = re.fullmatch(r"([A-Z]+)(\d*)", fin)
+            c2 = _col(m2.group(1))
+            r2 = int(m2.group(2)) if m2.group(2) else len(self.rows)
+        else:
+            c2, r2 = c1, r1 + 1
+        out = []
+        for r in self.rows[r1:r2]:
+            fila = list(r[c1:c2 + 1])
+            while fila and fila[-1] == "":
+                fila.pop()
+            out.append(fila)
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    def get(self, a1: str = "A1:Z", **kwargs):
+        values = self._leer(a1)
+        self.contador.reads += 1
+        self.contador.bytes += _bytes(values)
+        return values
+
+    # --- escrituras ---
+    def _set(self, a1: str, valor):
+        self.spreadsheet.tocar()
+        c, r = _celda(a1)
+        while len(self.rows) <= r:
+            self.rows.append([])
+        fila = self.rows[r]
+        while len(fila) <= c:
+            fila.append("")
+        fila[c] = "" if valor is None else str(valor)
+
+    def update_acell(self, a1: str, valor):
+        self._set(a1, valor)
+        self.contador.writes += 1
+        self.contador.bytes += _bytes([a1, valor])
+        return {"updatedCells": 1}
+
+    def _append(self, filas: list) -> dict:
+        self.spreadsheet.tocar()
+        # Como la API: agrega después de la última fila con datos
+        while self.rows and not any(self.rows[-1]):
+            self.rows.pop()
+        primera = len(self.rows) + 1
+        for f in filas:
+            self.rows.append(["" if c is None else str(c) for c in f])
+        ultima = len(self.rows)
+        return {"updates": {"updatedRange": f"'{self.title}'!A{primera}:J{ultima}", "updatedRows": len(filas)}}
+
+    def append_row(self, fila: list, value_input_option=None, **kwargs):
+        resp = self._append([fila])
+        self.contador.writes += 1
+        self.contador.bytes += _bytes(fila)
+        return resp
+
+
+class FakeSpreadsheet:
+    def __init__(self, tabs: dict[str, list]):
+        self.contador = Contador()
+        self.modificado = 0
+        self.tabs = {}
+        for titulo, rows in tabs.items():
+            self.tabs[titulo] = FakeWorksheet(self, titulo, rows)
+
+    def tocar(self):
+        self.modificado += 1
+
+    def get_lastUpdateTime(self) -> str:
+        self.contador.metadata += 1
+        return f"2024-01-01T00:00:{self.modificado:06d}Z"
+
+    def worksheet(self, titulo: str) -> FakeWorksheet:
+        self.contador.metadata += 1
+        if titulo not in self.tabs:
+            raise gspread.exceptions.WorksheetNotFound(titulo)
+        return self.tabs[titulo]
+
+    def worksheets(self):
+        self.contador.metadata += 1
+        return list(self.tabs.values())
+
+    def add_worksheet(self, title: str, rows: int = 100, cols: int = 26, index=None):
+        self.contador.writes += 1
+        self.tabs[title] = FakeWorksheet(self, title, [])
+        return self.tabs[title]
+
+    def batch_update(self, body: dict):
+        # Solo deleteDimension de filas (lo que usa el archivo de meses)
+        por_id = {ws.id: ws for ws in self.tabs.values()}
+        for req in body["requests"]:
+            rango = req["deleteDimension"]["range"]
+            del por_id[rango["sheetId"]].rows[rango["startIndex"]:rango["endIndex"]]
+        self.tocar()
+        self.contador.writes += 1
+        self.contador.bytes += _bytes(body)
+        return {"replies": [{} for _ in body["requests"]]}
+
+    def values_batch_update(self, body: dict):
+        for d in body["data"]:
+            tab, a1 = _split_rango(d["range"])
+            for i, fila in enumerate(d["values"]):
+                c, r = _celda(a1.split(":")[0])
+                for j, valor in enumerate(fila):
+                    self.tabs[tab]._set(f"{_letras(c + j)}{r + 1 + i}", valor)
+        self.contador.writes += 1
+        self.contador.bytes += _bytes(body)
+        return {"totalUpdatedCells": sum(len(f) for d in body["data"] for f in d["values"])}
+
+    def values_append(self, rango: str, params=None, body=None):
+        tab, _ = _split_rango(rango)
+        resp = self.tabs[tab]._append(body["values"])
+        self.contador.writes += 1
+        self.contador.bytes += _bytes(body)
+        return resp
+
+    def values_batch_get(self, rangos: list, params=None):
+        resp = {"valueRanges": []}
+        for rango in rangos:
+            tab, a1 = _split_rango(rango)
+            resp["valueRanges"].append({"range": rango, "values": self.tabs[tab]._leer(a1)})
+        self.contador.reads += 1
+        self.contador.bytes += _bytes(resp)
+        return resp
+
+
+def _letras(col: int) -> str:
+    s = ""
+    col += 1
+    while col:
+        col, r = divmod(col - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+
+class FakeClient:
+    def __init__(self, spreadsheet: FakeSpreadsheet, otras: dict | None = None):
+        self.spreadsheet = spreadsheet
+        self.otras = otras or {}   # sheet_id -> FakeSpreadsheet (planillas por chat)
+
+    def open_by_key(self, key: str) -> FakeSpreadsheet:
+        sh = self.otras.get(key, self.spreadsheet)
+        sh.contador.metadata += 1
+        return sh
+
+
+# -------------------------
+# TELEGRAM
+# -------------------------
+class FakeBot:
+    """Registra todo lo que el bot manda a Telegram."""
+
+    def __init__(self):
+        self.enviados = []
+        self._next_id = 1000
+
+    def _id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.enviados.append(("send_message", chat_id, text))
+        return FakeMessage(self, chat_id, text, message_id=self._id())
+
+    async def edit_message_text(self, text=None, chat_id=None, message_id=None, **kwargs):
+        # Como LimiteSalida: la edición pisa a la provisional pendiente del mensaje
+        salida.cancelar_provisional((str(chat_id), message_id))
+        self.enviados.append(("edit_message_text", chat_id, text))
+        return True
+
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot, chat_id: int, text: str = "", message_id: int | None = None):
+        self._bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.message_id = message_id or bot._id()
+
+    async def reply_text(self, text, **kwargs):
+        return await self._bot.send_message(self.chat_id, text, **kwargs)
+
+    async def delete(self):
+        self._bot.enviados.append(("delete_message", self.chat_id, self.message_id))
+        return True
+
+
+class FakeCallbackQuery:
+    def __init__(self, bot: FakeBot, chat_id: int, data: str, message: FakeMessage):
+        self._bot = bot
+        self.data = data
+        self.message = message
+        self.chat_id = chat_id
+
+    async def answer(self, *args, **kwargs):
+        return True
+
+    async def edit_message_text(self, text=None, **kwargs):
+        return await self._bot.edit_message_text(text=text, chat_id=self.chat_id, message_id=self.message.message_id)
+
+
+class FakeUpdate:
+    def __init__(self, bot: FakeBot, chat_id: int, nombre: str, message=None, callback_query=None):
+        self._bot = bot
+        self.effective_chat = SimpleNamespace(id=chat_id)
+        self.effective_user = SimpleNamespace(id=chat_id, full_name=nombre, username=nombre.lower(), first_name=nombre)
+        self.message = message
+        self.callback_query = callback_query
+
+    def get_bot(self):
+        return self._bot
+
+
+class FakeChat:
+    """Un chat con su propio user_data; fabrica updates de texto y de botones."""
+
+    def __init__(self, bot: FakeBot, chat_id: int, nombre: str = "Bench"):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.nombre = nombre
+        self.context = SimpleNamespace(bot=bot, user_data={}, bot_data={})
+        self.ultimo_mensaje = FakeMessage(bot, chat_id)
+
+    def texto(self, text: str) -> FakeUpdate:
+        msg = FakeMessage(self.bot, self.chat_id, text)
+        return FakeUpdate(self.bot, self.chat_id, self.nombre, message=msg)
+
+    def boton(self, data: str) -> FakeUpdate:
+        query = FakeCallbackQuery(self.bot, self.chat_id, data, self.ultimo_mensaje)
+        return FakeUpdate(self.bot, self.chat_id, self.nombre, callback_query=query)
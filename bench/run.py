@@ -0,0 +1,178 @@
+"""
+Benchmark offline de los flujos del bot, con presupuesto de llamadas a Sheets.
+
+Corre cada flujo de punta a punta contra el spreadsheet falso de bench.fakes
+(con los índices ya calientes, como en un bot que lleva rato corriendo) y
+mide tiempo, lecturas, escrituras y bytes. Sale con código 1 si algún flujo
+se pasa de su presupuesto (BUDGETS), para que CI lo detecte.
+
+Uso:
+    python -m bench.run [--filas N] [--json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Antes de importar el bot: sin credenciales reales, backend Sheets y sin
+# límites de cuota (medimos requests, no queremos esperar al token bucket)
+os.environ.setdefault("GOOGLE_SHEET_ID", "bench")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "bench")
+os.environ["STORAGE_BACKEND"] = "sheets"
+os.environ["SHEETS_READS_PER_MIN"] = "1000000"
+os.environ["SHEETS_WRITES_PER_MIN"] = "1000000"
+os.environ["SHEETS_BURST"] = "1000000"
+os.environ["JOURNAL_PATH"] = os.path.join(tempfile.mkdtemp(prefix="gastobot-bench-"), "journal.sqlite3")
+
+from bench.fakes import FakeBot, FakeChat, FakeClient, FakeSpreadsheet  # noqa: E402
+from bot import main as bot  # noqa: E402
+from services import journal, sheets, sheets_async  # noqa: E402
+
+CHAT_ID = 4242
+CHAT_NUEVO = 9191
+
+# Máximo de requests a Sheets por flujo (con índices calientes)
+BUDGETS = {
+    "clasificar":        {"reads": 0, "writes": 3},
+    "check_conocido":    {"reads": 0, "writes": 2},
+    "check_keep_cat":    {"reads": 0, "writes": 3},
+    "otro_alias_newcat": {"reads": 0, "writes": 3},
+    "solicitud_acceso":  {"reads": 0, "writes": 1},
+}
+
+
+def construir_planilla(filas: int) -> FakeSpreadsheet:
+    """Planilla con `filas` de historia en Gastos/Pendientes y los pendientes del bench."""
+    comercios = [["comercio_raw", "alias", "categoria"]]
+    comercios += [[f"COMERCIO {i}", f"Comercio {i}", ["Comida", "Hogar", "Ocio"][i % 3]] for i in range(300)]
+    comercios.append(["LIDER EXPRESS", "Lider", "Supermercado"])
+
+    pendientes = [["email_id", "fecha", "hora", "monto", "comercio_raw", "desc", "estado"]]
+    pendientes += [[f"hist{i}", "2024-01-01", "12:00", "1.000", f"COMERCIO {i % 300}", "", "OK"] for i in range(filas)]
+    pendientes += [
+        ["E1", "2024-05-01", "10:00", "12.990", "METRO SANTIAGO", "Compra", ""],
+        ["E2", "2024-05-01", "11:00", "4.500", "CAFE NUEVO", "Compra", ""],
+        ["E3", "2024-05-01", "12:00", "8.000", "PET SHOP SPA", "Compra", ""],
+        ["E4", "2024-05-01", "13:00", "23.450", "LIDER EXPRESS", "Compra", ""],
+    ]
+
+    gastos = [["fecha", "hora", "descripcion", "monto", "categoria", "comercio_raw", "alias", "usuario", "chat_id", "email_id"]]
+    gastos += [["2024-01-01", "12:00", "", "1000", "Comida", f"COMERCIO {i % 300}", "", "telegram", str(CHAT_ID), f"hist{i}"] for i in range(filas)]
+
+    usuarios = [["chat_id", "nombre", "estado", "fecha"], [str(CHAT_ID), "Bench", "AUTORIZADO", "2024-01-01"]]
+
+    return FakeSpreadsheet({
+        "Usuarios": usuarios,
+        "Comercios": comercios,
+        "Pendientes": pendientes,
+        "Gastos": gastos,
+    })
+
+
+# -------------------------
+# FLUJOS
+# -------------------------
+async def flujo_clasificar(chat: FakeChat):
+    await bot.clasificar(chat.texto("/clasificar E1 Transporte | Metro"), chat.context)
+
+
+async def flujo_check_conocido(chat: FakeChat):
+    await bot.button_handler(chat.boton("CHECK|E4"), chat.context)
+
+
+async def flujo_check_keep_cat(chat: FakeChat):
+    await bot.button_handler(chat.boton("CHECK|E2"), chat.context)
+    await bot.button_handler(chat.boton("KEEP|E2"), chat.context)
+    await bot.button_handler(chat.boton("CAT|E2|Comida"), chat.context)
+
+
+async def flujo_otro_alias_newcat(chat: FakeChat):
+    await bot.button_handler(chat.boton("OTRO|E3"), chat.context)
+    await bot.on_text(chat.texto("Tienda Mascotas"), chat.context)
+    await bot.button_handler(chat.boton("NEW_CAT|E3"), chat.context)
+    await bot.on_text(chat.texto("mascotas"), chat.context)
+
+
+async def flujo_solicitud_acceso(chat: FakeChat):
+    await bot.on_text(chat.texto("hola"), chat.context)
+
+
+FLUJOS = {
+    "clasificar": (flujo_clasificar, CHAT_ID),
+    "check_conocido": (flujo_check_conocido, CHAT_ID),
+    "check_keep_cat": (flujo_check_keep_cat, CHAT_ID),
+    "otro_alias_newcat": (flujo_otro_alias_newcat, CHAT_ID),
+    "solicitud_acceso": (flujo_solicitud_acceso, CHAT_NUEVO),
+}
+
+
+async def calentar():
+    """Deja los índices cargados, como en un bot que ya atendió su primer update."""
+    await sheets_async.cargar_indices()
+
+
+async def correr_flujo(nombre: str, filas: int) -> dict:
+    fn, chat_id = FLUJOS[nombre]
+    planilla = construir_planilla(filas)
+    sheets.set_client(FakeClient(planilla))
+    sheets.reset_indices()
+
+    await calentar()
+    planilla.contador.reset()
+
+    chat = FakeChat(FakeBot(), chat_id)
+    t0 = time.perf_counter()
+    await fn(chat)
+    # El journal se vacía en segundo plano; lo contamos como parte del flujo
+    await sheets_async.run(journal.flush)
+    ms = (time.perf_counter() - t0) * 1000
+
+    return {"flujo": nombre, "ms": round(ms, 2), **planilla.contador.snapshot(), "telegram": len(chat.bot.enviados)}
+
+
+def excedidos(resultado: dict) -> list[str]:
+    budget = BUDGETS.get(resultado["flujo"], {})
+    return [
+        f"{k}={resultado[k]} > {limite}"
+        for k, limite in budget.items()
+        if resultado[k] > limite
+    ]
+
+
+async def correr(filas: int) -> list[dict]:
+    resultados = []
+    for nombre in FLUJOS:
+        resultados.append(await correr_flujo(nombre, filas))
+    sheets_async.shutdown()
+    return resultados
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark offline de los flujos del bot")
+    parser.add_argument("--filas", type=int, default=int(os.getenv("BENCH_ROWS", "5000")),
+                        help="filas de historia en Gastos y Pendientes")
+    parser.add_argument("--json", action="store_true", help="salida en JSON")
+    args = parser.parse_args(argv)
+
+    resultados = asyncio.run(correr(args.filas))
+    fallas = {r["flujo"]: excedidos(r) for r in resultados if excedidos(r)}
+
+    if args.json:
+        print(json.dumps({"resultados": resultados, "excedidos": fallas}, indent=2))
+    else:
+        print(f"{'flujo':<20}{'ms':>9}{'reads':>7}{'writes':>8}{'bytes':>9}{'meta':>6}{'tg':>5}")
+        for r in resultados:
+            marca = "  <-- " + ", ".join(fallas[r["flujo"]]) if r["flujo"] in fallas else ""
+            print(f"{r['flujo']:<20}{r['ms']:>9}{r['reads']:>7}{r['writes']:>8}{r['bytes']:>9}{r['metadata']:>6}{r['telegram']:>5}{marca}")
+
+    if fallas:
+        print(f"\n❌ {len(fallas)} flujo(s) sobre su presupuesto de llamadas a Sheets", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,28 @@
+import asyncio
+import html
 import os
+import tempfile
+import time
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, PicklePersistence, PersistenceInput, filters
 
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import CallbackQueryHandler
 
-from services.sheets import (
+from bot import trabajadores
+from bot.procesador import ProcesadorPorChat
+from services import (
+    archivo, candados, cartola, cuota, ingesta, journal, metricas, mirror, sheets, sheets_async, snapshot,
+    storage, telegram as salida,
+)
+from services.sheets_async import (
     get_pendiente,
-    mark_pendiente_ok,
-    append_gasto,
     upsert_mapping,
     get_unique_categories,
-    get_mapping, get_usuarios_autorizados, upsert_usuario,get_estado_usuario
+    get_mapping, upsert_usuario, get_estado_usuario
 )
 def load_env():
     env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".env"))
@@ -27,29 +35,30 @@ def load_env():
                 k, v = line.split("=", 1)
                 os.environ.setdefault(k.strip(), v.strip())
 
-load_env()
+with metricas.fase("env"):
+    load_env()
 
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))
 
-_auth_cache = {"ids": set(), "ts": 0}
-
-def is_authorized(update: Update) -> bool:
-    import time
-    ahora = time.time()
-    
-    if ahora - _auth_cache["ts"] > 120:
-        _auth_cache["ids"] = get_usuarios_autorizados()
-        _auth_cache["ts"] = ahora
-    
-    return update.effective_chat.id in _auth_cache["ids"]
+async def is_authorized(update: Update) -> bool:
+    # Sale del índice de Usuarios en memoria (se refresca en segundo plano)
+    estado = await get_estado_usuario(update.effective_chat.id)
+    return estado == "AUTORIZADO"
 
 async def request_access(update: Update):
     """Notifica al admin cuando alguien desconocido escribe."""
+    # En este proceso, un aviso al admin por solicitud; entre procesos (bot y
+    # trabajadores) manda la escritura condicional de _request_access
+    async with candados.clave_async("chat", update.effective_chat.id):
+        await _request_access(update)
+
+
+async def _request_access(update: Update):
     user = update.effective_user
     chat_id = update.effective_chat.id
     nombre = user.full_name or user.username or str(chat_id)
 
-    estado = get_estado_usuario(chat_id)
+    estado = await get_estado_usuario(chat_id)
     if estado == "PENDIENTE":
         await update.message.reply_text("⏳ Tu solicitud ya fue enviada. Espera la aprobación.")
         return
@@ -57,8 +66,10 @@ async def request_access(update: Update):
         await update.message.reply_text("⛔ Tu acceso fue rechazado.")
         return
 
-    # Guardamos como PENDIENTE
-    upsert_usuario(chat_id, nombre, "PENDIENTE")
+    # Guardamos como PENDIENTE, solo si nadie cambió el estado desde que lo leímos
+    if not await upsert_usuario(chat_id, nombre, "PENDIENTE", si_estado=estado or ""):
+        await update.message.reply_text("⏳ Tu solicitud ya está en curso.")
+        return
 
     # Notificamos al admin con botones
     keyboard = InlineKeyboardMarkup([
@@ -92,21 +103,37 @@ async def request_access(update: Update):
     )
 
 
-def build_category_keyboard(email_id):
-    cats = get_unique_categories()
-    
-    keyboard = []
-    row = []
-    
-    for cat in cats:
-        btn = InlineKeyboardButton(cat, callback_data=f"CAT|{email_id}|{cat}")
-        row.append(btn)
-        if len(row) == 2:
-            keyboard.append(row)
-            row = []
-    
-    if row:
-        keyboard.append(row)
+# Teclado de categorías precalculado: la lista y la disposición en filas se
+# arman una vez por versión de categorías; por request solo se completa el
+# email_id del callback.
+_teclado_cache = {"version": None, "ts": 0, "filas": []}
+
+
+def invalidar_teclado():
+    _teclado_cache["version"] = None
+
+
+async def _layout_categorias() -> list[list[str]]:
+    version = storage.backend().categorias_version()
+    ttl = float(os.getenv("COMERCIOS_TTL", "300"))
+    if _teclado_cache["version"] == version and time.time() - _teclado_cache["ts"] <= ttl:
+        return _teclado_cache["filas"]
+
+    cats = await get_unique_categories()
+    filas = [cats[i:i + 2] for i in range(0, len(cats), 2)]
+
+    # La versión se lee después: get_unique_categories pudo recargar Comercios
+    _teclado_cache.update(version=storage.backend().categorias_version(), ts=time.time(), filas=filas)
+    return filas
+
+
+async def build_category_keyboard(email_id):
+    filas = await _layout_categorias()
+
+    keyboard = [
+        [InlineKeyboardButton(cat, callback_data=f"CAT|{email_id}|{cat}") for cat in fila]
+        for fila in filas
+    ]
         
     keyboard.append([
         InlineKeyboardButton("➕ Nueva Categoría...", callback_data=f"NEW_CAT|{email_id}")
@@ -120,6 +147,12 @@ def build_category_keyboard(email_id):
 
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    action = (update.callback_query.data or "").split("|")[0]
+    with metricas.medir_bloque(f"button_handler.{action}"):
+        await _button_handler(update, context)
+
+
+async def _button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data
     parts = data.split("|")
@@ -132,21 +165,26 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_chat_id = int(parts[1])
         nombre = parts[2] if len(parts) > 2 else str(target_chat_id)
 
+        nuevo_estado = "AUTORIZADO" if action == "AUTH_OK" else "RECHAZADO"
+        # Solo una solicitud PENDIENTE se resuelve: un doble clic (o el mismo
+        # botón en otro proceso) no pisa lo que ya se decidió
+        if not await upsert_usuario(target_chat_id, nombre, nuevo_estado, si_estado="PENDIENTE"):
+            actual = await get_estado_usuario(target_chat_id)
+            await query.edit_message_text(f"ℹ️ {nombre} ya no estaba pendiente ({actual or 'sin registro'}).")
+            return
+
         if action == "AUTH_OK":
-            upsert_usuario(target_chat_id, nombre, "AUTORIZADO")
-            _auth_cache["ts"] = 0  # fuerza refresco inmediato
             await query.edit_message_text(f"✅ {nombre} autorizado.")
             await context.bot.send_message(
                 chat_id=target_chat_id,
                 text="✅ ¡Acceso aprobado! Ya puedes usar el bot."
             )
         else:
-            upsert_usuario(target_chat_id, nombre, "RECHAZADO")
             await query.edit_message_text(f"❌ {nombre} rechazado.")
         return
 
     # El resto de acciones sí requieren autorización
-    if not is_authorized(update):
+    if not await is_authorized(update):
         await query.answer("⛔ No autorizado.", show_alert=True)
         return
 
@@ -161,9 +199,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- CASO 2: MANTENER NOMBRE ORIGINAL ---
     if action == "KEEP":
-        await query.edit_message_text(text="⏳ Cargando categorías...")
+        salida.provisional(query, "⏳ Cargando categorías...")
 
-        row_idx, p = get_pendiente(email_id)
+        row_idx, p = await get_pendiente(email_id)
         if not p:
             await query.edit_message_text(text="⚠️ Error: No encontré el gasto en Pendientes.")
             return
@@ -173,7 +211,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["temp_alias"] = alias_original
         context.user_data["esperando_categoria_id"] = email_id
         
-        reply_markup = build_category_keyboard(email_id) 
+        reply_markup = await build_category_keyboard(email_id) 
 
         await query.edit_message_text(
             text=f"✅ Alias: <b>{alias_original}</b>\n\n📂 Selecciona la <b>CATEGORÍA</b>:",
@@ -191,12 +229,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- CASO 3: CAMBIAR NOMBRE MANUALMENTE ---
     if action == "OTRO":
-        await query.edit_message_text(text="🔍 Preparando...")
+        salida.provisional(query, "🔍 Preparando...")
         
         context.user_data["esperando_alias_id"] = email_id
         context.user_data["mensaje_instruccion_id"] = query.message.message_id
         
-        row_idx, p = get_pendiente(email_id)
+        row_idx, p = await get_pendiente(email_id)
         nombre_banco = p["comercio_raw"] if p else "este comercio"
 
         await query.edit_message_text(
@@ -207,7 +245,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- CASO 4: SELECCIONAR CATEGORÍA ---
     if action == "CAT":
-        await query.edit_message_text(text="⏳ Guardando en Sheets...")
+        salida.provisional(query, "⏳ Guardando en Sheets...")
         
         categoria_seleccionada = parts[2]
         alias_guardado = context.user_data.get("temp_alias")
@@ -224,13 +262,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     if action == "CHECK":
-        await query.edit_message_text(text="🔍 Buscando en la base de datos...")
-        row_idx, p = get_pendiente(email_id)
+        salida.provisional(query, "🔍 Buscando en la base de datos...")
+        row_idx, p = await get_pendiente(email_id)
         if not p:
             await query.edit_message_text(text="⚠️ Error: No encontré el gasto en Pendientes.")
             return
         comercio_raw = p["comercio_raw"]
-        alias_encontrado, categoria_encontrada = get_mapping(comercio_raw)
+        alias_encontrado, categoria_encontrada = await get_mapping(comercio_raw)
         if alias_encontrado and categoria_encontrada:
             await query.edit_message_text(text="✅ ¡Comercio encontrado! Registrando...")
             await procesar_gasto(
@@ -254,8 +292,24 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
 
+def _paso_conversacion(user_data) -> str:
+    """Paso del flujo de texto en que está el chat (mismo orden que on_text)."""
+    if user_data.get("esperando_alias_id"):
+        return "alias"
+    if user_data.get("esperando_nueva_cat_id"):
+        return "nueva_cat"
+    if user_data.get("esperando_categoria_id"):
+        return "categoria"
+    return "libre"
+
+
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update):
+    with metricas.medir_bloque(f"on_text.{_paso_conversacion(context.user_data)}"):
+        await _on_text(update, context)
+
+
+async def _on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_authorized(update):
         await request_access(update)
         return
 
@@ -280,7 +334,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         del context.user_data["esperando_alias_id"]
         context.user_data["esperando_categoria_id"] = esperando_alias_email
 
-        reply_markup = build_category_keyboard(esperando_alias_email)   
+        reply_markup = await build_category_keyboard(esperando_alias_email)   
 
         texto_siguiente = (
             f"✅ Alias guardado: <b>{nuevo_alias}</b>\n\n"
@@ -336,6 +390,9 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.pop("esperando_nueva_cat_id", None)
         context.user_data.pop("mensaje_instruccion_id", None)
         context.user_data.pop("temp_alias", None)
+
+        # La categoría nueva tiene que aparecer en el próximo teclado
+        invalidar_teclado()
         return
 
     # --- PASO 2: RECIBIMOS LA CATEGORÍA (MANUALMENTE) ---
@@ -363,8 +420,14 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def procesar_gasto(update, context, email_id, categoria, mensaje_id_to_edit=None, alias_manual=None):
+    # Dos chats del mismo hogar pueden cerrar el mismo gasto a la vez
+    async with candados.clave_async("email", email_id):
+        await _procesar_gasto(update, context, email_id, categoria, mensaje_id_to_edit, alias_manual)
+
+
+async def _procesar_gasto(update, context, email_id, categoria, mensaje_id_to_edit=None, alias_manual=None):
     chat_id = update.effective_chat.id
-    row_idx, p = get_pendiente(email_id)
+    row_idx, p = await get_pendiente(email_id)
     
     if not p:
         msg = "⚠️ Ya no encuentro ese gasto pendiente."
@@ -374,6 +437,13 @@ async def procesar_gasto(update, context, email_id, categoria, mensaje_id_to_edi
             except: await context.bot.send_message(chat_id=chat_id, text=msg)
         return
 
+    # Ya está en Gastos (doble toque, /clasificar antes, callback repetido)
+    if await sheets_async.gasto_registrado(email_id):
+        texto = "⚠️ Ese gasto ya estaba registrado."
+        if update.callback_query: await update.callback_query.edit_message_text(texto)
+        else: await context.bot.send_message(chat_id=chat_id, text=texto)
+        return
+
     comercio_raw = p["comercio_raw"]
     monto = p["monto"]
     
@@ -382,19 +452,23 @@ async def procesar_gasto(update, context, email_id, categoria, mensaje_id_to_edi
     else:
         alias = comercio_raw.title().strip()
 
-    append_gasto(
+    # Se anota en el journal local; el loop de fondo lo escribe en Sheets
+    nuevo = await sheets_async.run(
+        journal.registrar, row_idx,
         fecha=p["fecha_email"], hora=p["hora_email"], descripcion=p["desc"], monto=monto,
         categoria=categoria, comercio_raw=comercio_raw, comercio_alias=alias,
-        usuario="telegram", chat_id=str(chat_id), email_id=email_id
+        usuario="telegram", chat_id=str(chat_id), email_id=email_id,
+        flujo="procesar_gasto",
     )
-    upsert_mapping(comercio_raw, alias, categoria)
-    mark_pendiente_ok(row_idx)
 
-    texto_final = (
-        f"✅ <b>Listo.</b> Gasto de <b>${monto}</b>\n"
-        f"🏪 <b>{alias}</b>\n"
-        f"📂 <b>{categoria}</b>"
-    )
+    if nuevo:
+        texto_final = (
+            f"✅ <b>Listo.</b> Gasto de <b>${monto}</b>\n"
+            f"🏪 <b>{alias}</b>\n"
+            f"📂 <b>{categoria}</b>"
+        )
+    else:
+        texto_final = "⚠️ Ese gasto ya estaba registrado."
     
     try:
         if update.callback_query:
@@ -414,6 +488,93 @@ async def procesar_gasto(update, context, email_id, categoria, mensaje_id_to_edi
 
 
 
+# -------------------------
+# INGESTA AUTOMÁTICA
+# -------------------------
+async def _destinos_ingesta(planilla: str | None = None) -> list[int]:
+    """
+    Chats de la planilla que reciben el resumen: los de INGESTA_CHAT_IDS o
+    todos los autorizados.
+    """
+    fijos = [c.strip() for c in os.getenv("INGESTA_CHAT_IDS", "").split(",") if c.strip()]
+    if fijos:
+        chats = [int(c) for c in fijos]
+    else:
+        chats = sorted(await sheets_async.get_usuarios_autorizados())
+    return [c for c in chats if storage.backend().planilla_de(c) == planilla]
+
+
+def _texto_resumen(resumen: dict) -> str | None:
+    registrados = resumen["registrados"]
+    if not registrados and not resumen["preguntar"]:
+        return None
+    lineas = []
+    if registrados:
+        lineas.append(f"🤖 Registré <b>{len(registrados)}</b> gasto(s) de comercios conocidos:")
+        for g in registrados[:20]:
+            lineas.append(f"• ${g['monto']} {html.escape(g['comercio_alias'])} ({html.escape(g['categoria'])})")
+        if len(registrados) > 20:
+            lineas.append(f"… y {len(registrados) - 20} más")
+    if resumen["en_espera"]:
+        lineas.append(f"❓ {resumen['en_espera']} gasto(s) esperan que clasifiques su comercio.")
+    return "\n".join(lineas)
+
+
+async def _ingestar(bot):
+    # Una pasada por planilla (la principal y las de cada chat u hogar)
+    for planilla in sorted(storage.backend().planillas_registradas(), key=lambda p: p or ""):
+        try:
+            await _ingestar_planilla(bot, planilla)
+        except Exception as e:
+            print(f"Ingesta: error en la planilla {planilla or 'principal'}: {e}")
+
+
+async def _ingestar_planilla(bot, planilla: str | None):
+    resumen = await sheets_async.run(ingesta.ingerir, planilla)
+    texto = _texto_resumen(resumen)
+    if texto is None:
+        return
+
+    for chat_id in await _destinos_ingesta(planilla):
+        try:
+            # Un solo resumen por chat y una pregunta por comercio desconocido
+            await bot.send_message(chat_id=chat_id, text=texto, parse_mode="HTML")
+            for _, p, mas in resumen["preguntar"]:
+                email_id = p["email_id"]
+                keyboard = InlineKeyboardMarkup([
+                    [InlineKeyboardButton(f"✅ Mantener: {p['comercio_raw']}", callback_data=f"KEEP|{email_id}")],
+                    [InlineKeyboardButton("✏️ Asignar nuevo nombre...", callback_data=f"OTRO|{email_id}")],
+                    [InlineKeyboardButton("❌ Ignorar", callback_data=f"IGNORE|{email_id}")]
+                ])
+                extra = f"\n(+{mas} más del mismo comercio, se registrarán solos)" if mas else ""
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=f"🆕 Gasto de <b>${p['monto']}</b> en <b>{html.escape(p['comercio_raw'])}</b> "
+                         f"({p['fecha_email']}){extra}\n\n¿Cómo lo registro?",
+                    parse_mode="HTML",
+                    reply_markup=keyboard
+                )
+        except Exception as e:
+            print(f"Ingesta: no pude avisar a {chat_id}: {e}")
+
+
+async def ingesta_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await _ingestar(context.bot)
+    except Exception as e:
+        print(f"Ingesta: error en el ciclo: {e}")
+
+
+async def _ingesta_loop(bot, intervalo: float):
+    """Respaldo si no está instalado el extra job-queue de python-telegram-bot."""
+    while True:
+        await asyncio.sleep(intervalo)
+        try:
+            await _ingestar(bot)
+        except Exception as e:
+            print(f"Ingesta: error en el ciclo: {e}")
+
+
 def get_token() -> str:
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not token:
@@ -428,8 +589,9 @@ def now_local():
     return dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M:%S")
 
 
+@metricas.medir("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update):
+    if not await is_authorized(update):
         await request_access(update)
         return
     
@@ -445,8 +607,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@metricas.medir("help")
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update):
+    if not await is_authorized(update):
         await request_access(update)
         return
 
@@ -455,14 +618,19 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/start\n"
         "/help\n"
         "/chatid\n"
-        "/clasificar <email_id> Categoria | Alias\n\n"
+        "/clasificar <email_id> Categoria | Alias\n"
+        "/comercio <COMERCIO> = Categoria | Alias\n"
+        "/resumen [categoria]\n"
+        "/mes [AAAA-MM]\n"
+        "Envía la cartola del banco (.csv) para importar tu historia.\n\n"
         "Ej:\n"
         "/clasificar 19b547fd2f29cd4e Transporte | Metro"
     )
 
 
+@metricas.medir("chatid")
 async def chatid(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update):
+    if not await is_authorized(update):
         await request_access(update)
         return
 
@@ -483,8 +651,9 @@ def parse_clasificacion(text: str):
     return email_id.strip(), categoria, alias
 
 
+@metricas.medir("clasificar")
 async def clasificar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update):
+    if not await is_authorized(update):
         await update.message.reply_text("⛔ No autorizado.")
         return
     
@@ -503,7 +672,12 @@ async def clasificar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     email_id, categoria, alias = parsed
 
-    row_idx, p = get_pendiente(email_id)
+    async with candados.clave_async("email", email_id):
+        await _clasificar(update, email_id, categoria, alias)
+
+
+async def _clasificar(update: Update, email_id: str, categoria: str, alias: str):
+    row_idx, p = await get_pendiente(email_id)
     if not p:
         await update.message.reply_text(
             f"No encontré ese email_id en Pendientes: {email_id}\n"
@@ -515,6 +689,10 @@ async def clasificar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Ese pendiente ya estaba marcado como OK ✅")
         return
 
+    if await sheets_async.gasto_registrado(email_id):
+        await update.message.reply_text("Ese gasto ya estaba registrado ✅")
+        return
+
     comercio_raw = p["comercio_raw"]
     monto = p["monto"]
     descripcion = p["desc"]
@@ -525,14 +703,16 @@ async def clasificar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username or update.effective_user.first_name or "usuario"
     chat_id = update.effective_chat.id
 
-    append_gasto(
+    nuevo = await sheets_async.run(
+        journal.registrar, row_idx,
         fecha=fecha, hora=hora, descripcion=descripcion, monto=monto,
         categoria=categoria, comercio_raw=comercio_raw, comercio_alias=alias,
         usuario=username, chat_id=str(chat_id), email_id=email_id,
+        flujo="clasificar",
     )
-
-    upsert_mapping(comercio_raw=comercio_raw, alias=alias, categoria=categoria)
-    mark_pendiente_ok(row_idx)
+    if not nuevo:
+        await update.message.reply_text("Ese gasto ya estaba registrado ✅")
+        return
 
     await update.message.reply_text(
         "✅ Listo. Registré el gasto y aprendí el comercio:\n"
@@ -543,22 +723,407 @@ async def clasificar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-def main():
+# -------------------------
+# CARTOLAS
+# -------------------------
+@metricas.medir("comercio")
+async def comercio_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/comercio <COMERCIO> = Categoria | Alias: enseña un comercio (p. ej. uno de una cartola)."""
+    if not await is_authorized(update):
+        await update.message.reply_text("⛔ No autorizado.")
+        return
+
+    _, _, resto = (update.message.text or "").partition(" ")
+    comercio_raw, _, clasif = resto.partition("=")
+    categoria, _, alias = clasif.partition("|")
+    comercio_raw, categoria, alias = comercio_raw.strip(), categoria.strip(), alias.strip()
+    if not comercio_raw or not categoria:
+        await update.message.reply_text(
+            "Formato inválido.\n"
+            "Usa:\n"
+            "/comercio <COMERCIO> = Categoria | Alias\n"
+            "Ej:\n"
+            "/comercio LIDER EXPRESS = Supermercado | Lider"
+        )
+        return
+
+    alias = alias or comercio_raw.title()
+    await upsert_mapping(comercio_raw, alias, categoria)
+    await update.message.reply_text(f"✅ {comercio_raw} → {alias} ({categoria})")
+
+
+@metricas.medir("cartola")
+async def cartola_doc(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Un .csv enviado al chat se importa como cartola (ver services.cartola)."""
+    if not await is_authorized(update):
+        await request_access(update)
+        return
+
+    aviso = await update.message.reply_text("⏳ Importando la cartola...")
+    # Se baja a disco y se lee en streaming: la memoria no depende del tamaño
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        archivo_tg = await update.message.document.get_file()
+        await archivo_tg.download_to_drive(path)
+        username = update.effective_user.username or update.effective_user.first_name or "cartola"
+        r = await sheets_async.run(cartola.importar, path, update.effective_chat.id, usuario=username)
+    except cartola.CartolaInvalida as e:
+        await aviso.edit_text(f"❌ No pude leer la cartola: {e}.")
+        return
+    except Exception as e:
+        print(f"Cartola: error importando: {e}")
+        await aviso.edit_text("❌ Falló la importación; lo ya importado no se duplica si reintentas.")
+        return
+    finally:
+        os.unlink(path)
+
+    lineas = [
+        f"✅ <b>{r['importados']}</b> gasto(s) importado(s)"
+        + (f", {r['repetidos']} ya estaban" if r["repetidos"] else "") + "."
+    ]
+    if r["abonos"]:
+        lineas.append(f"↩️ {r['abonos']} abono(s) (depósitos, devoluciones, pagos) no se importaron.")
+    if r["desconocidos"]:
+        lineas.append(
+            f"\n🔍 <b>{r['sin_comercio']}</b> línea(s) de {len(r['desconocidos'])} comercio(s) sin categoría. "
+            "Clasifícalos y vuelve a enviar el archivo:"
+        )
+        largo = sum(len(l) for l in lineas)
+        for i, (comercio_raw, n, total) in enumerate(r["desconocidos"]):
+            linea = f"<code>/comercio {html.escape(comercio_raw)} = </code> · {n} × · {_pesos(total)}"
+            # Telegram corta en 4096 caracteres (y cortar el HTML rompe el mensaje)
+            largo += len(linea) + 1
+            if largo > 3800:
+                lineas.append(f"… y {len(r['desconocidos']) - i} más")
+                break
+            lineas.append(linea)
+    await aviso.edit_text("\n".join(lineas), parse_mode="HTML")
+
+
+# -------------------------
+# RESÚMENES
+# -------------------------
+def _pesos(n: int) -> str:
+    return f"${n:,}".replace(",", ".")
+
+
+def _mes_anterior(mes: str) -> str:
+    anio, m = int(mes[:4]), int(mes[5:7])
+    return f"{anio - 1}-12" if m == 1 else f"{anio}-{m - 1:02d}"
+
+
+def _top(totales: dict, n: int = 8) -> list:
+    return sorted(totales.items(), key=lambda kv: kv[1], reverse=True)[:n]
+
+
+@metricas.medir("resumen")
+async def resumen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/resumen [categoría]: lo gastado este mes (y el anterior) por categoría."""
+    if not await is_authorized(update):
+        await request_access(update)
+        return
+
+    mes = now_local()[0][:7]
+    actual = await sheets_async.resumen_mes(mes)
+    anterior = await sheets_async.resumen_mes(_mes_anterior(mes))
+
+    if context.args:
+        buscada = " ".join(context.args).strip().lower()
+        nombre = next((c for c in actual["categorias"] if c.lower() == buscada), None)
+        nombre = nombre or next((c for c in anterior["categorias"] if c.lower() == buscada), " ".join(context.args))
+        cat = actual["categorias"].get(nombre, {"total": 0, "n": 0, "alias": {}})
+        previo = anterior["categorias"].get(nombre, {"total": 0})
+        lineas = [
+            f"📂 <b>{html.escape(nombre)}</b> en {mes}: <b>{_pesos(cat['total'])}</b> ({cat['n']} gastos)",
+            f"Mes anterior: {_pesos(previo['total'])}",
+        ]
+        for alias, total in _top(cat["alias"]):
+            lineas.append(f"• {html.escape(alias)}: {_pesos(total)}")
+        await update.message.reply_text("\n".join(lineas), parse_mode="HTML")
+        return
+
+    lineas = [
+        f"📅 <b>{mes}</b>: <b>{_pesos(actual['total'])}</b> en {actual['n']} gastos "
+        f"(mes anterior: {_pesos(anterior['total'])})"
+    ]
+    cats = sorted(actual["categorias"].items(), key=lambda kv: kv[1]["total"], reverse=True)
+    for nombre, cat in cats:
+        previo = anterior["categorias"].get(nombre, {"total": 0})["total"]
+        lineas.append(f"• {html.escape(nombre)}: {_pesos(cat['total'])} (antes {_pesos(previo)})")
+    if not cats:
+        lineas.append("Aún no hay gastos este mes.")
+    lineas.append("\nDetalle: /resumen &lt;categoría&gt; · /mes [AAAA-MM]")
+    await update.message.reply_text("\n".join(lineas), parse_mode="HTML")
+
+
+@metricas.medir("mes")
+async def mes_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/mes [AAAA-MM]: totales del mes por categoría, comercio y usuario."""
+    if not await is_authorized(update):
+        await request_access(update)
+        return
+
+    mes = context.args[0] if context.args else now_local()[0][:7]
+    if len(mes) != 7 or mes[4] != "-" or not (mes[:4] + mes[5:]).isdigit():
+        await update.message.reply_text("Formato: /mes 2024-05")
+        return
 
-    app = Application.builder().token(get_token()).build()
+    r = await sheets_async.resumen_mes(mes)
+    if not r["n"]:
+        await update.message.reply_text(f"No hay gastos registrados en {mes}.")
+        return
+
+    comercios = {}
+    for cat in r["categorias"].values():
+        for alias, total in cat["alias"].items():
+            comercios[alias] = comercios.get(alias, 0) + total
+
+    lineas = [f"📅 <b>{mes}</b>: <b>{_pesos(r['total'])}</b> en {r['n']} gastos", "", "📂 <b>Por categoría</b>"]
+    for nombre, cat in sorted(r["categorias"].items(), key=lambda kv: kv[1]["total"], reverse=True):
+        lineas.append(f"• {html.escape(nombre)}: {_pesos(cat['total'])} ({cat['total'] * 100 // max(r['total'], 1)}%)")
+    lineas += ["", "🏪 <b>Top comercios</b>"]
+    lineas += [f"• {html.escape(alias)}: {_pesos(total)}" for alias, total in _top(comercios, 10)]
+    lineas += ["", "👤 <b>Por usuario</b>"]
+    lineas += [f"• {html.escape(u)}: {_pesos(total)}" for u, total in _top(r["usuarios"])]
+    await update.message.reply_text("\n".join(lineas), parse_mode="HTML")
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Métricas internas; solo para el admin."""
+    if update.effective_chat.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("⛔ No autorizado.")
+        return
+
+    # Las bases locales (SQLite) se consultan fuera del event loop
+    def _locales():
+        estado_trabajadores = trabajadores.estado() if trabajadores.cantidad() else "no"
+        return journal.estado(), ingesta.en_espera(), archivo.estado(), estado_trabajadores
+
+    estado_journal, en_espera, estado_archivo, estado_trabajadores = await sheets_async.run(_locales)
+    texto = (
+        f"{metricas.resumen_texto()}\n\n"
+        f"pool: {sheets.pool_stats()}\n"
+        f"cuota: {cuota.estado()}\n"
+        f"escrituras: {sheets.write_stats()}\n"
+        f"revalidación: {sheets.revalidacion_stats()}\n"
+        f"journal: {estado_journal}\n"
+        f"ingesta en espera: {en_espera}\n"
+        f"archivo: {estado_archivo}\n"
+        f"candados: {candados.estado()}\n"
+        f"trabajadores: {estado_trabajadores}\n"
+        f"salida: {context.bot.rate_limiter.estado() if context.bot.rate_limiter else 'sin límite'}\n"
+        f"arranque: {metricas.arranque_texto()}"
+    )
+    # Telegram corta en 4096 caracteres
+    await update.message.reply_text(f"<pre>{html.escape(texto)[:4000]}</pre>", parse_mode="HTML")
+
+
+async def planilla_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/planilla <chat_id> [sheet_id]: datos del chat en su propia planilla (sin id, en la principal)."""
+    if update.effective_chat.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("⛔ No autorizado.")
+        return
+    if storage.nombre_backend() != "sheets":
+        await update.message.reply_text("Las planillas por chat solo existen con el backend de Sheets.")
+        return
+    if not context.args or not context.args[0].lstrip("-").isdigit():
+        await update.message.reply_text("Formato: /planilla <chat_id> [sheet_id]")
+        return
+
+    chat_id = int(context.args[0])
+    try:
+        # set_planilla valida la planilla (y carga sus índices) antes de registrarla
+        await sheets_async.run(sheets.set_planilla, chat_id, context.args[1] if len(context.args) > 1 else None)
+        nueva = sheets.planilla_de(chat_id)
+    except Exception as e:
+        await update.message.reply_text(f"❌ No pude asignar la planilla: {e}")
+        return
 
+    await update.message.reply_text(f"✅ El chat {chat_id} usa {nueva or 'la planilla principal'}.")
+
+
+async def _revalidar_indices():
+    """Tras arrancar desde el snapshot: relee la hoja sin frenar a los handlers."""
+    try:
+        with cuota.prioridad(cuota.FONDO), metricas.medir_bloque("arranque.revalidacion"):
+            await sheets_async.cargar_indices()
+            await sheets_async.run(snapshot.guardar)
+    except Exception as e:
+        print(f"No pude revalidar los índices: {e}")
+
+
+async def post_init(app: Application):
+    tareas = app.bot_data.setdefault("tareas", [])
+
+    with metricas.fase("metricas"):
+        metricas.servir_prometheus()
+
+    # Reenvía lo que haya quedado en el journal y sigue enviando en segundo plano
+    tareas.append(asyncio.create_task(journal.flush_loop()))
+
+    # Con snapshot en disco se atiende de inmediato y la hoja se revalida
+    # en segundo plano; sin él, Usuarios, Comercios y Pendientes se cargan
+    # al partir (una sola lectura)
+    with metricas.fase("snapshot"):
+        try:
+            en_caliente = snapshot.cargar()
+        except Exception as e:
+            print(f"No pude cargar el snapshot: {e}")
+            en_caliente = False
+    if en_caliente:
+        tareas.append(asyncio.create_task(_revalidar_indices()))
+    else:
+        with metricas.fase("indices"):
+            try:
+                await sheets_async.cargar_indices()
+                await sheets_async.run(snapshot.guardar)
+            except Exception as e:
+                print(f"No pude cargar los índices al iniciar: {e}")
+
+    # Después los índices se revalidan en segundo plano con sondeos baratos
+    # (solo se recarga la hoja que cambió)
+    tareas.append(asyncio.create_task(
+        sheets_async.refrescar_cada(
+            storage.backend().revalidar,
+            float(os.getenv("REVALIDAR_S", "30")),
+            "índices",
+        )
+    ))
+
+    tareas.append(asyncio.create_task(
+        sheets_async.refrescar_cada(snapshot.guardar, float(os.getenv("SNAPSHOT_S", "300")), "snapshot")
+    ))
+
+    # Ingesta de Pendientes: registra solo los comercios conocidos
+    intervalo = float(os.getenv("INGESTA_S", "60"))
+    if intervalo > 0:
+        if app.job_queue is not None:
+            app.job_queue.run_repeating(ingesta_job, interval=intervalo, first=intervalo, name="ingesta")
+        else:
+            print("Ingesta: falta python-telegram-bot[job-queue], uso un loop simple")
+            tareas.append(asyncio.create_task(_ingesta_loop(app.bot, intervalo)))
+
+    # Meses cerrados fuera de las hojas vivas (en SQLite las consultas ya van por índice)
+    archivo_s = float(os.getenv("ARCHIVO_S", "86400"))
+    if storage.nombre_backend() == "sheets" and archivo_s > 0:
+        tareas.append(asyncio.create_task(
+            sheets_async.refrescar_cada(archivo.compactar, archivo_s, "archivo")
+        ))
+
+    # Backend SQLite con espejo: la planilla se mantiene al día en segundo plano
+    if mirror.activo():
+        with metricas.fase("espejo"):
+            try:
+                await sheets_async.run(mirror.importar_inicial)
+            except Exception as e:
+                print(f"No pude importar desde Sheets al iniciar: {e}")
+        tareas.append(asyncio.create_task(
+            sheets_async.refrescar_cada(
+                mirror.sincronizar,
+                float(os.getenv("SQLITE_MIRROR_S", "30")),
+                "espejo Sheets",
+            )
+        ))
+
+    origen = "snapshot" if en_caliente else "Sheets"
+    print(f"⏱️ Listo para atender en {metricas.arranque_texto()}, índices desde {origen}")
+
+
+async def post_shutdown(app: Application):
+    for task in app.bot_data.pop("tareas", []):
+        task.cancel()
+    try:
+        await sheets_async.run(snapshot.guardar)
+    except Exception as e:
+        print(f"No pude guardar el snapshot: {e}")
+    try:
+        await sheets_async.run(journal.flush)
+    except Exception as e:
+        print(f"Journal: quedan gastos sin enviar ({e}); se enviarán al reiniciar.")
+    if mirror.activo():
+        try:
+            await sheets_async.run(mirror.sincronizar)
+        except Exception as e:
+            print(f"Espejo: quedan cambios sin replicar ({e}); se enviarán al reiniciar.")
+    sheets_async.shutdown()
+
+
+def _registrar_handlers(app: Application):
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(CommandHandler("chatid", chatid))
     app.add_handler(CommandHandler("clasificar", clasificar))
+    app.add_handler(CommandHandler("resumen", resumen))
+    app.add_handler(CommandHandler("mes", mes_cmd))
+    app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("planilla", planilla_cmd))
+    app.add_handler(CommandHandler("comercio", comercio_cmd))
 
     app.add_handler(CallbackQueryHandler(button_handler))
 
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+    app.add_handler(MessageHandler(filters.Document.FileExtension("csv"), cartola_doc))
+
+
+def _arrancar(app: Application):
+    concurrencia = int(os.getenv("BOT_CONCURRENCIA", "8"))
+
+    # Con WEBHOOK_URL (URL pública que llega a WEBHOOK_HOST:WEBHOOK_PORT) se usa
+    # webhook; si no, polling
+    webhook_url = os.getenv("WEBHOOK_URL", "").strip()
+    if webhook_url:
+        host = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+        port = int(os.getenv("WEBHOOK_PORT", "8443"))
+        path = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+        print(f"🤖 Bot corriendo por webhook en {host}:{port}/{path} (concurrencia {concurrencia})")
+        app.run_webhook(
+            listen=host,
+            port=port,
+            url_path=path,
+            webhook_url=f"{webhook_url.rstrip('/')}/{path}",
+            secret_token=os.getenv("WEBHOOK_SECRET") or None,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        return
 
-    print("🤖 Bot corriendo... (Ctrl+C para detener)")
+    print(f"🤖 Bot corriendo... (concurrencia {concurrencia}, Ctrl+C para detener)")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
+def main():
+    # Con BOT_TRABAJADORES=N este proceso solo recibe updates y los reparte
+    # por chat entre N procesos (ver bot.trabajadores)
+    total = trabajadores.cantidad()
+    if total > 0:
+        trabajadores.correr(total, _arrancar)
+        return
+
+    # Chats distintos en paralelo; dentro de un chat, en orden de llegada
+    concurrencia = int(os.getenv("BOT_CONCURRENCIA", "8"))
+
+    with metricas.fase("app"):
+        # user_data (los flujos de varios pasos) sobrevive a los reinicios
+        persistencia = PicklePersistence(
+            os.getenv("BOT_ESTADO_PATH", "data/bot_estado.pickle"),
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+        )
+        app = (
+            Application.builder()
+            .token(get_token())
+            .persistence(persistencia)
+            .concurrent_updates(ProcesadorPorChat(concurrencia))
+            .rate_limiter(salida.LimiteSalida())
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+            .build()
+        )
+
+    with metricas.fase("handlers"):
+        _registrar_handlers(app)
+
+    _arrancar(app)
+
+
 if __name__ == "__main__":
     main()
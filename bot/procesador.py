@@ -0,0 +1,82 @@
+"""
+Procesamiento concurrente de updates con orden estricto por chat.
+
+Chats distintos se atienden en paralelo (hasta BOT_CONCURRENCIA a la vez);
+los updates de un mismo chat esperan su turno en el orden en que llegaron,
+porque los flujos de varios pasos de on_text dependen de context.user_data.
+Cada update se atiende con la planilla de su chat (services.planillas) ya
+fijada, así los handlers no tienen que pasarla.
+
+process_update es @final en PTB: todo va en do_process_update. El semáforo
+de PTB solo acota los updates admitidos (BOT_ADMITIDOS: atendiéndose o
+esperando el turno de su chat); el cupo de BOT_CONCURRENCIA es propio y se
+pide recién con el turno del chat.
+"""
+import asyncio
+import os
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from services import metricas, storage
+
+
+def _clave_chat(update: object):
+    if isinstance(update, Update) and update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+class ProcesadorPorChat(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        admitidos = int(os.getenv("BOT_ADMITIDOS", str(max_concurrent_updates * 8)))
+        super().__init__(max(admitidos, max_concurrent_updates))
+        self._cupos = asyncio.Semaphore(max_concurrent_updates)
+        self._en_curso = 0
+        self._chats = {}  # chat_id -> [asyncio.Lock, updates en curso o esperando]
+        self.procesados = 0  # updates terminados (throughput de bot.trabajadores)
+
+    @property
+    def current_concurrent_updates(self) -> int:
+        # Los que se están atendiendo, no los que esperan el turno de su chat
+        return self._en_curso
+
+    async def _atender(self, coroutine):
+        async with self._cupos:
+            self._en_curso += 1
+            try:
+                await coroutine
+            finally:
+                self._en_curso -= 1
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        try:
+            clave = _clave_chat(update)
+            if clave is None:
+                await self._atender(coroutine)
+                return
+
+            entrada = self._chats.setdefault(clave, [asyncio.Lock(), 0])
+            entrada[1] += 1
+            try:
+                # Primero el turno del chat (FIFO) y después un cupo global: un
+                # chat con cola no ocupa cupos que podrían usar otros chats
+                with metricas.medir_bloque("updates.espera_chat"):
+                    await entrada[0].acquire()
+                try:
+                    with storage.backend().en_planilla(clave):
+                        await self._atender(coroutine)
+                finally:
+                    entrada[0].release()
+            finally:
+                entrada[1] -= 1
+                if not entrada[1]:
+                    self._chats.pop(clave, None)
+        finally:
+            self.procesados += 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
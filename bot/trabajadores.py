@@ -0,0 +1,208 @@
+"""
+Modo multiproceso (BOT_TRABAJADORES=N).
+
+Un proceso frontal recibe los updates (polling o webhook) y los reparte entre
+N procesos trabajadores por chat_id: un chat siempre cae en el mismo
+trabajador, así su user_data (los flujos de varios pasos) vive en un solo
+proceso y sus updates se atienden en orden. Cada trabajador tiene su propio
+Application (sin updater) y su propio archivo de persistencia.
+
+El estado compartido vive en la base local de services.sqlite_store
+(SQLite en WAL, apto para varios procesos), por eso este modo exige
+STORAGE_BACKEND=sqlite. Las tareas de fondo (journal, ingesta, espejo a
+Sheets) corren solo en el frontal. Cada trabajador anota su throughput en
+la tabla meta de esa base; /stats lo muestra desde cualquier proceso.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from telegram import Update
+from telegram.ext import Application, ApplicationHandlerStop, PicklePersistence, PersistenceInput, TypeHandler
+
+from services import metricas, sheets_async, sqlite_store, storage, telegram as salida
+
+_PREFIJO_META = "trabajador:"
+
+
+def cantidad() -> int:
+    """Trabajadores configurados (0 = todo en un solo proceso)."""
+    return int(os.getenv("BOT_TRABAJADORES", "0"))
+
+
+def trabajador_de(chat_id, total: int) -> int:
+    # Estable entre reinicios (a diferencia de hash() de un str). Cambiar N
+    # mueve chats de trabajador: los flujos a medio hacer de esos chats se pierden.
+    return abs(int(chat_id)) % total
+
+
+# -------------------------
+# FRONTAL
+# -------------------------
+def correr(total: int, arrancar):
+    """
+    Arranca el frontal: `arrancar(app)` es el run_polling/run_webhook de
+    bot.main. Los trabajadores se lanzan en post_init y se detienen en
+    post_shutdown.
+    """
+    from bot import main as bot_main
+
+    if storage.nombre_backend() != "sqlite":
+        raise RuntimeError(
+            "BOT_TRABAJADORES necesita STORAGE_BACKEND=sqlite: con Sheets cada proceso "
+            "tendría sus propios índices y candados"
+        )
+
+    ctx = multiprocessing.get_context("spawn")
+    colas = [ctx.Queue() for _ in range(total)]
+    procesos = []
+
+    async def _reenviar(update: Update, context):
+        chat = update.effective_chat
+        n = trabajador_de(chat.id, total) if chat is not None else 0
+        colas[n].put(update.to_dict())
+        metricas.contar(f"trabajadores.reenviados.{n}")
+        raise ApplicationHandlerStop
+
+    async def _post_init(app: Application):
+        for n in range(total):
+            p = ctx.Process(target=_trabajador, args=(n, total, colas[n]), name=f"gastobot-{n}", daemon=True)
+            p.start()
+            procesos.append(p)
+        print(f"🧵 {total} trabajadores: {', '.join(str(p.pid) for p in procesos)}")
+        await bot_main.post_init(app)
+
+    async def _post_shutdown(app: Application):
+        for cola in colas:
+            cola.put(None)
+        for p in procesos:
+            p.join(timeout=float(os.getenv("TRABAJADORES_CIERRE_S", "10")))
+            if p.is_alive():
+                print(f"Trabajador {p.name} no terminó a tiempo, lo detengo")
+                p.terminate()
+        await bot_main.post_shutdown(app)
+
+    with metricas.fase("app"):
+        app = (
+            Application.builder()
+            .token(bot_main.get_token())
+            # El límite global de Telegram es por bot: se reparte entre todos los procesos
+            .rate_limiter(salida.LimiteSalida(procesos=total + 1))
+            .post_init(_post_init)
+            .post_shutdown(_post_shutdown)
+            .build()
+        )
+        app.add_handler(TypeHandler(Update, _reenviar))
+
+    arrancar(app)
+
+
+# -------------------------
+# TRABAJADOR
+# -------------------------
+_VACIO = object()  # la cola no trajo nada en el último segundo
+
+
+def _trabajador(n: int, total: int, cola):
+    # Ctrl+C llega a todo el grupo de procesos: el trabajador espera que el
+    # frontal le mande el fin (None) para cerrar ordenado
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_atender(n, total, cola))
+
+
+async def _atender(n: int, total: int, cola):
+    from bot import main as bot_main
+    from bot.procesador import ProcesadorPorChat
+
+    ruta = os.getenv("BOT_ESTADO_PATH", "data/bot_estado.pickle")
+    app = (
+        Application.builder()
+        .token(bot_main.get_token())
+        .updater(None)
+        .persistence(PicklePersistence(
+            f"{ruta}.{n}",
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+        ))
+        .concurrent_updates(ProcesadorPorChat(int(os.getenv("BOT_CONCURRENCIA", "8"))))
+        .rate_limiter(salida.LimiteSalida(procesos=total + 1))
+        .build()
+    )
+    bot_main._registrar_handlers(app)
+
+    loop = asyncio.get_running_loop()
+    frontal = os.getppid()
+    async with app:
+        await app.start()
+        reporte = asyncio.create_task(_reportar(app, n, total))
+        print(f"🧵 Trabajador {n}/{total} listo (pid {os.getpid()})")
+        try:
+            while True:
+                data = await loop.run_in_executor(None, _recibir, cola)
+                if data is None:
+                    break
+                if data is _VACIO:
+                    if os.getppid() != frontal:
+                        # El frontal murió sin avisar
+                        break
+                    continue
+                await app.update_queue.put(Update.de_json(data, app.bot))
+        finally:
+            reporte.cancel()
+            # stop() atiende lo que ya estaba en la cola antes de cerrar
+            await app.stop()
+    sheets_async.shutdown()
+
+
+def _recibir(cola):
+    try:
+        return cola.get(timeout=1)
+    except queue.Empty:
+        return _VACIO
+
+
+async def _reportar(app: Application, n: int, total: int):
+    """Anota el throughput del trabajador cada TRABAJADORES_REPORTE_S segundos."""
+    intervalo = float(os.getenv("TRABAJADORES_REPORTE_S", "10"))
+    anterior, desde = 0, time.time()
+    while True:
+        await asyncio.sleep(intervalo)
+        try:
+            anterior, desde = await _anotar(app, n, total, desde, anterior)
+        except Exception as e:
+            print(f"Trabajador {n}: no pude anotar el throughput: {e}")
+
+
+async def _anotar(app: Application, n: int, total: int, desde: float, anterior: int):
+    procesados = app.update_processor.procesados
+    ahora = time.time()
+    data = {
+        "pid": os.getpid(),
+        "de": total,
+        "procesados": procesados,
+        "por_s": round((procesados - anterior) / max(ahora - desde, 1e-9), 2),
+        "en_curso": app.update_processor.current_concurrent_updates,
+        "ts": ahora,
+    }
+    await sheets_async.run(sqlite_store.set_meta, f"{_PREFIJO_META}{n}", json.dumps(data))
+    return procesados, ahora
+
+
+def estado() -> dict:
+    """Throughput anotado por cada trabajador: n -> {procesados, por_s, en_curso, hace_s}."""
+    ahora = time.time()
+    resultado = {}
+    for clave, valor in sqlite_store.metas(_PREFIJO_META).items():
+        data = json.loads(valor)
+        if data.get("de") != cantidad():
+            continue   # de una corrida con otro número de trabajadores
+        resultado[int(clave[len(_PREFIJO_META):])] = {
+            "procesados": data["procesados"],
+            "por_s": data["por_s"],
+            "en_curso": data["en_curso"],
+            "hace_s": round(ahora - data["ts"]),
+        }
+    return dict(sorted(resultado.items()))
@@ -0,0 +1,186 @@
+"""
+Totales de Gastos por mes, categoría, alias de comercio y usuario.
+
+Es un acumulador incremental: append_gasto le suma cada fila que escribe
+(por número de fila, así la lectura de la cola no la cuenta otra vez) y
+services.sheets le pasa solo las filas de Gastos posteriores a `cursor`
+(agregadas por otros, p. ej. a mano). Así /resumen y /mes responden sin
+volver a leer toda la historia. Hay un acumulador por planilla (el de la
+planilla actual, ver services.planillas).
+"""
+import bisect
+import re
+import threading
+import time
+
+from services import planillas
+
+_estado = planillas.PorPlanilla(lambda: {
+    "meses": {},         # "YYYY-MM" -> resumen (ver vacio())
+    "cursor": 1,         # última fila de Gastos consumida (1 = encabezado)
+    "adelantadas": set(),  # filas > cursor que ya sumó append_gasto
+    "ts": 0,             # última vez que se leyó la cola de la hoja
+})
+_lock = threading.RLock()
+
+
+def vacio() -> dict:
+    return {"total": 0, "n": 0, "categorias": {}, "usuarios": {}}
+
+
+def monto_int(valor) -> int | None:
+    """ "12.990", "$ 12.990" o 12990 -> 12990 (None si no es un monto)."""
+    if isinstance(valor, int):
+        return valor
+    limpio = re.sub(r"[^\d-]", "", str(valor))
+    try:
+        return int(limpio)
+    except ValueError:
+        return None
+
+
+def acumular(resumen: dict, categoria: str, alias: str, usuario: str, monto: int, n: int = 1):
+    resumen["total"] += monto
+    resumen["n"] += n
+    cat = resumen["categorias"].setdefault(categoria or "Sin categoría", {"total": 0, "n": 0, "alias": {}})
+    cat["total"] += monto
+    cat["n"] += n
+    alias = alias or "?"
+    cat["alias"][alias] = cat["alias"].get(alias, 0) + monto
+    usuario = usuario or "?"
+    resumen["usuarios"][usuario] = resumen["usuarios"].get(usuario, 0) + monto
+
+
+def combinar(resumen: dict, otro: dict):
+    """Suma `otro` (un resumen como el de vacio()) dentro de `resumen`."""
+    resumen["total"] += otro["total"]
+    resumen["n"] += otro["n"]
+    for nombre, cat in otro["categorias"].items():
+        destino = resumen["categorias"].setdefault(nombre, {"total": 0, "n": 0, "alias": {}})
+        destino["total"] += cat["total"]
+        destino["n"] += cat["n"]
+        for alias, monto in cat["alias"].items():
+            destino["alias"][alias] = destino["alias"].get(alias, 0) + monto
+    for usuario, monto in otro["usuarios"].items():
+        resumen["usuarios"][usuario] = resumen["usuarios"].get(usuario, 0) + monto
+
+
+def mes_de(fecha) -> str | None:
+    """ "2024-05-01" -> "2024-05"; None si la fecha no está en formato AAAA-MM-DD."""
+    mes = str(fecha).strip()[:7]
+    return mes if re.fullmatch(r"\d{4}-\d{2}", mes) else None
+
+
+def _sumar(fila: list) -> bool:
+    # Columnas de Gastos: fecha, hora, descripcion, monto, categoria,
+    # comercio_raw, comercio_alias, usuario, chat_id, email_id
+    fila = list(fila) + [""] * (8 - len(fila))
+    monto = monto_int(fila[3])
+    mes = mes_de(fila[0])
+    if monto is None or mes is None:
+        return False
+    resumen = _estado["meses"].setdefault(mes, vacio())
+    acumular(resumen, str(fila[4]).strip(), str(fila[6]).strip(), str(fila[7]).strip(), monto)
+    return True
+
+
+def agregar(fila_num: int | None, fila: list):
+    """
+    Suma una fila recién escrita en Gastos (la llama append_gasto). Sin número
+    de fila no se sabe si la próxima lectura de la cola la va a traer: no se
+    suma aquí, se da la cola por vencida y la cuenta esa lectura (una vez).
+    """
+    with _lock:
+        if fila_num is None:
+            _estado["ts"] = 0
+            return
+        if fila_num <= _estado["cursor"] or fila_num in _estado["adelantadas"]:
+            return
+        _estado["adelantadas"].add(fila_num)
+        _sumar(fila)
+
+
+def consumir(values: list, desde: int):
+    """Suma las filas de Gastos leídas desde la fila `desde` (la cola nueva)."""
+    with _lock:
+        for fila_num, fila in enumerate(values, start=desde):
+            if fila_num <= _estado["cursor"]:
+                continue
+            if fila_num in _estado["adelantadas"]:
+                continue
+            if fila and any(str(c).strip() for c in fila):
+                _sumar(fila)
+        _estado["cursor"] = max(_estado["cursor"], desde + len(values) - 1)
+        _estado["adelantadas"] = {f for f in _estado["adelantadas"] if f > _estado["cursor"]}
+        _estado["ts"] = time.time()
+
+
+def desplazar(borradas: list[int]):
+    """Corre cursor y filas adelantadas tras borrar esas filas de Gastos (archivo de meses)."""
+    quitar = set(borradas)
+    borradas = sorted(quitar)
+    with _lock:
+        _estado["cursor"] -= bisect.bisect_right(borradas, _estado["cursor"])
+        _estado["adelantadas"] = {
+            f - bisect.bisect_left(borradas, f) for f in _estado["adelantadas"] if f not in quitar
+        }
+
+
+def olvidar(meses):
+    """Descarta los totales de esos meses (ya quedaron en el archivo de meses)."""
+    with _lock:
+        for clave in meses:
+            _estado["meses"].pop(clave, None)
+
+
+def rehacer():
+    """Descarta los totales de la planilla actual: se rearman leyendo Gastos entera."""
+    with _lock:
+        _estado.update(meses={}, cursor=1, adelantadas=set(), ts=0)
+
+
+def cursor() -> int:
+    return _estado["cursor"]
+
+
+def vencido(ttl: float) -> bool:
+    """True si pasaron más de `ttl` segundos desde la última lectura de la cola."""
+    return time.time() - _estado["ts"] > ttl
+
+
+def mes(clave: str) -> dict:
+    """Copia del resumen de un mes ("YYYY-MM")."""
+    with _lock:
+        r = _estado["meses"].get(clave) or vacio()
+        return {
+            "total": r["total"],
+            "n": r["n"],
+            "categorias": {c: dict(v, alias=dict(v["alias"])) for c, v in r["categorias"].items()},
+            "usuarios": dict(r["usuarios"]),
+        }
+
+
+def exportar() -> dict:
+    with _lock:
+        return {
+            "meses": {m: mes(m) for m in _estado["meses"]},
+            "cursor": _estado["cursor"],
+            "adelantadas": sorted(_estado["adelantadas"]),
+        }
+
+
+def importar(data: dict) -> bool:
+    """Carga un export (snapshot); no pisa lo ya acumulado."""
+    with _lock:
+        if _estado["cursor"] > 1 or _estado["meses"]:
+            return False
+        _estado["meses"] = data["meses"]
+        _estado["cursor"] = data["cursor"]
+        _estado["adelantadas"] = set(data["adelantadas"])
+        return True
+
+
+def reset():
+    """Olvida los acumuladores de todas las planillas."""
+    with _lock:
+        _estado.reset()
@@ -0,0 +1,164 @@
+"""
+Archivo de meses cerrados de Gastos y Pendientes.
+
+Las hojas vivas solo crecen. compactar() (un job de fondo, cada ARCHIVO_S
+segundos) saca de cada planilla los meses anteriores a los ARCHIVO_MESES
+más recientes: las filas de Gastos pasan a una hoja por mes ("Gastos
+2024-05") y las de Pendientes en OK se borran (ver
+services.sheets.archivar_meses).
+
+Este módulo es el índice local (SQLite, ARCHIVO_PATH) de lo archivado:
+- dónde quedó cada gasto (planilla y hoja), para gasto_registrado;
+- los datos de cada pendiente borrado, para get_pendiente;
+- los totales de cada mes archivado, para resumen_mes.
+Así nada de eso vuelve a leer las hojas de archivo.
+"""
+import json
+import os
+from collections import Counter
+from datetime import date
+
+from services import agregados, candados, cuota, metricas, planillas, sqlite_local
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archivados (
+    email_id TEXT NOT NULL,
+    tipo     TEXT NOT NULL,      -- 'gasto' | 'pendiente'
+    planilla TEXT NOT NULL,
+    hoja     TEXT NOT NULL,      -- hoja de archivo ('' si la fila solo se borró)
+    datos    TEXT,               -- JSON del pendiente borrado
+    PRIMARY KEY (email_id, tipo)
+);
+CREATE TABLE IF NOT EXISTS meses (
+    planilla TEXT NOT NULL,
+    mes      TEXT NOT NULL,      -- YYYY-MM
+    resumen  TEXT NOT NULL,      -- JSON de agregados.vacio()
+    PRIMARY KEY (planilla, mes)
+);
+"""
+
+
+def _path() -> str:
+    return os.getenv("ARCHIVO_PATH", "data/archivo.sqlite3")
+
+
+def _connect():
+    return sqlite_local.conectar(_path(), _SCHEMA)
+
+
+def _hay_archivo() -> bool:
+    # Antes del primer archivado no se crea la base solo para consultarla
+    return os.path.exists(_path())
+
+
+# -------------------------
+# CONSULTAS
+# -------------------------
+def ubicar(email_id: str, tipo: str = "gasto") -> dict | None:
+    """{"planilla", "hoja"} de un email_id archivado, o None."""
+    if not _hay_archivo():
+        return None
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT planilla, hoja FROM archivados WHERE email_id = ? AND tipo = ?",
+            (str(email_id).strip(), tipo),
+        ).fetchone()
+    return {"planilla": row[0], "hoja": row[1]} if row else None
+
+
+def pendiente(email_id: str) -> dict | None:
+    """Datos de un pendiente que se borró de la hoja al archivar, o None."""
+    if not _hay_archivo():
+        return None
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT datos FROM archivados WHERE email_id = ? AND tipo = 'pendiente'",
+            (str(email_id).strip(),),
+        ).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def resumen(planilla: str, mes: str) -> dict | None:
+    """Totales de un mes archivado de la planilla (como agregados.mes), o None."""
+    if not _hay_archivo():
+        return None
+    with _connect() as conn:
+        row = conn.execute("SELECT resumen FROM meses WHERE planilla = ? AND mes = ?", (planilla, mes)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def estado() -> dict:
+    if not _hay_archivo():
+        return {}
+    with _connect() as conn:
+        tipos = dict(conn.execute("SELECT tipo, COUNT(*) FROM archivados GROUP BY tipo").fetchall())
+        meses = conn.execute("SELECT COUNT(*) FROM meses").fetchone()[0]
+    return dict(tipos, meses=meses)
+
+
+# -------------------------
+# ANOTACIONES (las hace services.sheets.archivar_meses)
+# -------------------------
+def anotar(planilla: str, gastos: dict, pendientes: list):
+    """
+    Registra lo archivado de una planilla en una sola transacción.
+    gastos: mes -> (hoja, [fila de Gastos, ...]); pendientes: [data_dict, ...].
+    Los totales de cada mes se suman a los que ya hubiera.
+    """
+    with _connect() as conn:
+        for mes, (hoja, filas) in gastos.items():
+            conn.executemany(
+                "INSERT OR IGNORE INTO archivados (email_id, tipo, planilla, hoja) VALUES (?, 'gasto', ?, ?)",
+                [(str(f[9]).strip(), planilla, hoja) for f in filas if len(f) > 9 and str(f[9]).strip()],
+            )
+            row = conn.execute("SELECT resumen FROM meses WHERE planilla = ? AND mes = ?", (planilla, mes)).fetchone()
+            total = json.loads(row[0]) if row else agregados.vacio()
+            for f in filas:
+                f = list(f) + [""] * (8 - len(f))
+                monto = agregados.monto_int(f[3])
+                if monto is not None:
+                    agregados.acumular(total, str(f[4]).strip(), str(f[6]).strip(), str(f[7]).strip(), monto)
+            conn.execute(
+                "INSERT INTO meses (planilla, mes, resumen) VALUES (?, ?, ?) "
+                "ON CONFLICT (planilla, mes) DO UPDATE SET resumen = excluded.resumen",
+                (planilla, mes, json.dumps(total, ensure_ascii=False)),
+            )
+        conn.executemany(
+            "INSERT OR REPLACE INTO archivados (email_id, tipo, planilla, hoja, datos) VALUES (?, 'pendiente', ?, '', ?)",
+            [(str(p["email_id"]).strip(), planilla, json.dumps(p, ensure_ascii=False)) for p in pendientes],
+        )
+
+
+# -------------------------
+# COMPACTACIÓN
+# -------------------------
+def corte(hoy: date | None = None) -> str:
+    """Primer mes que queda en las hojas vivas ("YYYY-MM"): los ARCHIVO_MESES más recientes."""
+    hoy = hoy or date.today()
+    n = hoy.year * 12 + hoy.month - 1 - (max(int(os.getenv("ARCHIVO_MESES", "3")), 1) - 1)
+    return f"{n // 12:04d}-{n % 12 + 1:02d}"
+
+
+@metricas.medir("archivo.compactar")
+def compactar() -> dict:
+    """Archiva los meses cerrados de cada planilla. Retorna cuántas filas movió."""
+    from services import ingesta, sheets
+
+    desde = corte()
+    total = Counter()
+    with cuota.prioridad(cuota.FONDO):
+        for planilla in sorted(sheets.planillas_registradas(), key=lambda p: p or ""):
+            # El cursor de la ingesta es una fila de Pendientes: se corre con los
+            # borrados, sin un ciclo de ingesta leyendo entre medio
+            with planillas.usar(planilla), candados.tomar([("ingesta", planilla or "")]):
+                try:
+                    r = sheets.archivar_meses(desde)
+                except sheets.FilaDesplazada as e:
+                    # Nada se borró; lo ya copiado al archivo se salta en la próxima pasada
+                    print(f"Archivo: {planilla or 'principal'} cambió durante el archivado ({e}); queda para la próxima")
+                    continue
+                ingesta.desplazar_cursor(r["filas_pendientes"], planilla)
+            total.update(gastos=r["gastos"], pendientes=r["pendientes"])
+    if total:
+        print(f"Archivo: {total['gastos']} gasto(s) y {total['pendientes']} pendiente(s) anteriores a {desde}")
+    return dict(total)
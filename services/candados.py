@@ -0,0 +1,80 @@
+"""
+Locks por clave: ("comercio", RAW), ("chat", chat_id), ("email", email_id).
+
+Dos operaciones sobre la misma clave se hacen una después de la otra; sobre
+claves distintas corren en paralelo. Hay dos sabores:
+- tomar(): locks de hilo, para el código que corre en el pool de
+  services.sheets_async (leer índice -> armar WritePlan -> commit).
+- clave_async(): locks de asyncio, para los handlers que leen, deciden y
+  escriben en varios awaits.
+Los locks se crean al pedirlos y se descartan cuando nadie los usa.
+"""
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+
+class _Registro:
+    def __init__(self, fabrica):
+        self._fabrica = fabrica
+        self._locks = {}  # clave -> [lock, usuarios]
+        self._mutex = threading.Lock()
+
+    def tomar_ref(self, clave):
+        with self._mutex:
+            entrada = self._locks.setdefault(clave, [self._fabrica(), 0])
+            entrada[1] += 1
+            return entrada[0]
+
+    def soltar_ref(self, clave):
+        with self._mutex:
+            entrada = self._locks[clave]
+            entrada[1] -= 1
+            if not entrada[1]:
+                del self._locks[clave]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+# RLock: una función que ya tiene la clave puede llamar a otra que la pide
+_hilos = _Registro(threading.RLock)
+_async = _Registro(asyncio.Lock)
+
+
+@contextmanager
+def tomar(claves):
+    """
+    Toma los locks de hilo de varias claves [(tipo, clave), ...]. Se toman
+    siempre en el mismo orden (ordenadas), así dos lotes no se bloquean entre sí.
+    """
+    tomados = []
+    try:
+        for k in sorted({(tipo, str(clave)) for tipo, clave in claves}):
+            lock = _hilos.tomar_ref(k)
+            try:
+                lock.acquire()
+            except BaseException:
+                _hilos.soltar_ref(k)
+                raise
+            tomados.append((k, lock))
+        yield
+    finally:
+        for k, lock in reversed(tomados):
+            lock.release()
+            _hilos.soltar_ref(k)
+
+
+@asynccontextmanager
+async def clave_async(tipo: str, clave):
+    k = (tipo, str(clave))
+    lock = _async.tomar_ref(k)
+    try:
+        async with lock:
+            yield
+    finally:
+        _async.soltar_ref(k)
+
+
+def estado() -> dict:
+    return {"hilos": len(_hilos), "async": len(_async)}
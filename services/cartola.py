@@ -0,0 +1,278 @@
+"""
+Importación de cartolas (CSV del banco) a Gastos.
+
+Para cargar meses de historia de una vez, sin pasar por Pendientes:
+- el archivo se lee en streaming (csv.reader sobre el archivo abierto): en
+  memoria queda solo el lote en curso y un contador por (fecha, comercio,
+  monto), no las líneas;
+- el comercio de cada línea se busca en el índice de Comercios
+  (get_mapping, en memoria con Sheets);
+- las líneas con comercio conocido se escriben en lotes de CARTOLA_LOTE
+  filas: un solo append a Gastos por lote (importar_gastos del backend);
+- las de comercio desconocido no se escriben: se agrupan por comercio
+  (cuántas líneas y cuánto suman) para clasificarlos de una vez y volver a
+  importar el mismo archivo;
+- solo se importan cargos: los abonos (depósitos, devoluciones, pagos de la
+  tarjeta) se saltan y se informan en el resumen.
+
+Cada línea lleva un email_id estable ("cartola:<hash>"): reimportar la misma
+cartola, o una que se solapa, no duplica gastos.
+
+Uso desde la terminal:
+    python -m services.cartola cartola.csv --chat 123456789
+"""
+import argparse
+import csv
+import hashlib
+import os
+import re
+import sys
+import unicodedata
+from collections import Counter
+from datetime import datetime
+
+from services import agregados, cuota, metricas, storage
+
+# Nombres de columna aceptados (sin tildes, en minúscula)
+_COLUMNAS = {
+    "fecha": ("fecha", "fecha operacion", "fecha transaccion", "fecha de operacion", "date"),
+    "hora": ("hora", "time"),
+    "comercio": ("descripcion", "detalle", "glosa", "comercio", "description"),
+    # Columna de cargos: positivos (un negativo es una reversa)
+    "cargo": ("cargo", "cargos"),
+    "abono": ("abono", "abonos"),
+    # Columna con signo: los cargos en negativo, los abonos en positivo
+    "monto": ("monto", "importe", "amount"),
+}
+_FORMATOS_FECHA = ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d/%m/%y", "%d-%m-%y")
+# Líneas que se miran buscando el encabezado (antes suele venir el número de cuenta)
+_MAX_PREAMBULO = 20
+
+
+class CartolaInvalida(Exception):
+    """El archivo no parece una cartola (no hay encabezado reconocible)."""
+
+
+def _lote() -> int:
+    return max(int(os.getenv("CARTOLA_LOTE", "500")), 1)
+
+
+# -------------------------
+# LECTURA
+# -------------------------
+def _abrir(path: str):
+    # Los bancos exportan en UTF-8 o en Latin-1: se decide con el primer bloque
+    with open(path, "rb") as f:
+        inicio = f.read(64 * 1024)
+    try:
+        inicio.decode("utf-8-sig")
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError as e:
+        # Un bloque cortado a mitad de un carácter sigue siendo UTF-8
+        encoding = "utf-8-sig" if e.start >= len(inicio) - 3 else "latin-1"
+    return open(path, "r", encoding=encoding, newline="")
+
+
+def _norm_columna(nombre: str) -> str:
+    sin_tildes = unicodedata.normalize("NFKD", nombre).encode("ascii", "ignore").decode()
+    return re.sub(r"[^a-z ]", "", sin_tildes.lower()).strip()
+
+
+def _columnas(encabezado: list) -> dict | None:
+    """nombre lógico -> índice, o None si faltan fecha, comercio o monto (o cargo)."""
+    idx = {}
+    for i, nombre in enumerate(encabezado):
+        nombre = _norm_columna(nombre)
+        for clave, variantes in _COLUMNAS.items():
+            if clave not in idx and nombre in variantes:
+                idx[clave] = i
+    if "cargo" in idx:
+        # Con columna de cargos, un "monto" aparte (saldo, total) no se usa
+        idx.pop("monto", None)
+    if {"fecha", "comercio"} <= idx.keys() and ("cargo" in idx or "monto" in idx):
+        return idx
+    return None
+
+
+def _fecha(valor: str) -> str | None:
+    valor = valor.strip()
+    for formato in _FORMATOS_FECHA:
+        try:
+            return datetime.strptime(valor, formato).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+
+def _monto(valor: str) -> int | None:
+    # "12.990", "$ -12.990", "12990,00", "(12.990)": pesos enteros, con signo
+    valor = valor.strip()
+    negativo = valor.startswith("(") and valor.endswith(")")
+    valor = re.sub(r"[.,]\d{1,2}$", "", valor.strip("()"))
+    monto = agregados.monto_int(valor) if re.search(r"\d", valor) else None
+    if not monto:
+        return None
+    return -abs(monto) if negativo else monto
+
+
+def leer(f, saltadas: Counter | None = None):
+    """
+    Recorre una cartola abierta en modo texto. Produce
+    (fecha, hora, comercio_raw, monto) por línea de cargo, con el monto en
+    positivo. Los abonos se cuentan en saltadas["abonos"]; las demás líneas
+    (totales, sin monto o en blanco), en saltadas["ignoradas"]. Ambas también
+    en metricas.
+    """
+    saltadas = saltadas if saltadas is not None else Counter()
+    # El separador más frecuente del comienzo (csv.Sniffer se confunde con el
+    # preámbulo de cuenta que traen muchas cartolas)
+    muestra = f.read(8192)
+    f.seek(0)
+    separador = max(";,\t", key=muestra.count)
+    lector = csv.reader(f, delimiter=separador)
+
+    cols = None
+    for _ in range(_MAX_PREAMBULO):
+        encabezado = next(lector, None)
+        if encabezado is None:
+            break
+        cols = _columnas(encabezado)
+        if cols:
+            break
+    if not cols:
+        raise CartolaInvalida("no encontré las columnas de fecha, descripción y monto")
+
+    # En una columna de cargos el cargo es positivo; en una con signo, negativo
+    col_monto, signo_cargo = (cols["cargo"], 1) if "cargo" in cols else (cols["monto"], -1)
+    for fila in lector:
+        if len(fila) <= max(cols.values()):
+            saltadas["ignoradas"] += 1
+            metricas.contar("cartola.lineas_ignoradas")
+            continue
+        fecha = _fecha(fila[cols["fecha"]])
+        monto = _monto(fila[col_monto])
+        comercio = " ".join(fila[cols["comercio"]].split())
+        if not monto and "abono" in cols and _monto(fila[cols["abono"]]):
+            saltadas["abonos"] += 1
+            metricas.contar("cartola.abonos")
+            continue
+        if not fecha or not monto or not comercio:
+            saltadas["ignoradas"] += 1
+            metricas.contar("cartola.lineas_ignoradas")
+            continue
+        if monto * signo_cargo < 0:
+            saltadas["abonos"] += 1
+            metricas.contar("cartola.abonos")
+            continue
+        monto = abs(monto)
+        hora = fila[cols["hora"]].strip() if "hora" in cols else ""
+        yield fecha, hora, comercio, monto
+
+
+def _email_id(fecha: str, comercio: str, monto: int, n: int) -> str:
+    # n separa compras idénticas (dos cafés el mismo día): es cuántas iguales
+    # vinieron antes en el archivo, estén o no seguidas
+    clave = f"{fecha}|{comercio.upper()}|{monto}|{n}"
+    return "cartola:" + hashlib.sha1(clave.encode("utf-8")).hexdigest()[:16]
+
+
+# -------------------------
+# IMPORTACIÓN
+# -------------------------
+@metricas.medir("cartola.importar")
+def importar(path: str, chat_id, usuario: str = "cartola") -> dict:
+    """
+    Importa la cartola en la planilla actual (ver services.planillas). Retorna
+    {"importados", "repetidos", "sin_comercio", "abonos", "desconocidos": [(comercio, líneas, total), ...]},
+    con los comercios desconocidos de más a menos líneas.
+    """
+    backend = storage.backend()
+    lote, lote_max = [], _lote()
+    total = Counter()
+    desconocidos = {}   # comercio -> [líneas, total]
+    vistas = Counter()  # (fecha, comercio, monto) -> líneas iguales ya leídas
+
+    def _escribir():
+        escritos = backend.importar_gastos(lote, flujo="cartola")
+        total.update(importados=escritos, repetidos=len(lote) - escritos)
+        lote.clear()
+
+    with cuota.prioridad(cuota.FONDO), _abrir(path) as f:
+        for fecha, hora, comercio, monto in leer(f, total):
+            clave = (fecha, comercio.upper(), monto)
+            repeticion = vistas[clave]
+            vistas[clave] += 1
+
+            alias, categoria = backend.get_mapping(comercio)
+            if not categoria:
+                grupo = desconocidos.setdefault(comercio.upper(), [0, 0])
+                grupo[0] += 1
+                grupo[1] += monto
+                total["sin_comercio"] += 1
+                continue
+
+            lote.append({
+                "fecha": fecha, "hora": hora, "descripcion": "Cartola", "monto": monto,
+                "categoria": categoria, "comercio_raw": comercio, "comercio_alias": alias or comercio.title(),
+                "usuario": usuario, "chat_id": str(chat_id),
+                "email_id": _email_id(fecha, comercio, monto, repeticion),
+            })
+            if len(lote) >= lote_max:
+                _escribir()
+        if lote:
+            _escribir()
+
+    metricas.contar("cartola.importados", total["importados"])
+    return {
+        "importados": total["importados"],
+        "repetidos": total["repetidos"],
+        "sin_comercio": total["sin_comercio"],
+        "abonos": total["abonos"],
+        "desconocidos": sorted(
+            ((c, n, t) for c, (n, t) in desconocidos.items()),
+            key=lambda d: (-d[1], -d[2]),
+        ),
+    }
+
+
+def texto_reporte(r: dict, limite: int = 30) -> str:
+    """Resumen en texto plano (la CLI; el bot arma el suyo en HTML)."""
+    lineas = [
+        f"Importados: {r['importados']} · ya estaban: {r['repetidos']} · sin comercio: {r['sin_comercio']}"
+        f" · abonos saltados: {r['abonos']}"
+    ]
+    if r["desconocidos"]:
+        lineas.append(f"\nComercios por clasificar ({len(r['desconocidos'])}):")
+        for comercio, n, total in r["desconocidos"][:limite]:
+            pesos = f"${total:,}".replace(",", ".")
+            lineas.append(f"  {comercio}  ({n} línea(s), {pesos})")
+        if len(r["desconocidos"]) > limite:
+            lineas.append(f"  … y {len(r['desconocidos']) - limite} más")
+    return "\n".join(lineas)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Importa una cartola (CSV del banco) a Gastos")
+    parser.add_argument("archivo", help="ruta del CSV")
+    parser.add_argument("--chat", required=True, help="chat_id dueño de los gastos (define su planilla)")
+    parser.add_argument("--usuario", default="cartola", help="valor de la columna usuario")
+    args = parser.parse_args(argv)
+
+    # Misma configuración (.env) que el bot
+    from bot import main as bot_main
+    bot_main.load_env()
+
+    backend = storage.backend()
+    backend.refresh_usuarios()
+    try:
+        with backend.en_planilla(args.chat):
+            r = importar(args.archivo, args.chat, usuario=args.usuario)
+    except CartolaInvalida as e:
+        print(f"❌ {args.archivo}: {e}", file=sys.stderr)
+        return 1
+    print(texto_reporte(r))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
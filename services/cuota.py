@@ -0,0 +1,159 @@
+"""
+Scheduler de cuota para la API de Google Sheets.
+
+Toda llamada a Sheets pasa por llamar(): toma un token del bucket de lectura
+o de escritura (con prioridad: las consultas interactivas pasan antes que
+las sincronizaciones de fondo) y si Google responde 429/5xx reintenta con
+backoff exponencial con jitter, pausando el bucket para todos mientras tanto.
+Un append ("append": bucket de escritura) solo se reintenta con 429: tras un
+5xx las filas pudieron quedar escritas, y repetirlo las duplicaría.
+"""
+import contextvars
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import gspread
+
+INTERACTIVA = 0
+FONDO = 1
+
+_prioridad = contextvars.ContextVar("cuota_prioridad", default=INTERACTIVA)
+
+
+@contextmanager
+def prioridad(nivel: int):
+    """Las llamadas a Sheets dentro del bloque usan esta prioridad."""
+    token = _prioridad.set(nivel)
+    try:
+        yield
+    finally:
+        _prioridad.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, nombre: str, por_minuto: float, capacidad: float):
+        self.nombre = nombre
+        self.rate = por_minuto / 60.0
+        self.capacidad = capacidad
+        self.tokens = capacidad
+        self.ts = time.monotonic()
+        self.pausa_hasta = 0.0
+        self.cond = threading.Condition()
+        self.cola = []  # heap de (prioridad, seq)
+        self.seq = itertools.count()
+        self.usados = 0
+        self.esperas = 0
+
+    def _rellenar(self, ahora: float):
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.ts) * self.rate)
+        self.ts = ahora
+
+    def acquire(self, nivel: int):
+        with self.cond:
+            turno = (nivel, next(self.seq))
+            heapq.heappush(self.cola, turno)
+            try:
+                while True:
+                    ahora = time.monotonic()
+                    self._rellenar(ahora)
+                    espera = 0.0
+                    if self.pausa_hasta > ahora:
+                        espera = self.pausa_hasta - ahora
+                    elif self.cola[0] != turno:
+                        espera = None  # no es nuestro turno: esperar aviso
+                    elif self.tokens >= 1:
+                        self.tokens -= 1
+                        self.usados += 1
+                        return
+                    else:
+                        espera = (1 - self.tokens) / self.rate
+                    self.esperas += 1
+                    self.cond.wait(espera)
+            finally:
+                self.cola.remove(turno)
+                heapq.heapify(self.cola)
+                self.cond.notify_all()
+
+    def pausar(self, segundos: float):
+        with self.cond:
+            self.pausa_hasta = max(self.pausa_hasta, time.monotonic() + segundos)
+            self.cond.notify_all()
+
+    def estado(self) -> dict:
+        with self.cond:
+            ahora = time.monotonic()
+            self._rellenar(ahora)
+            return {
+                "tokens": round(self.tokens, 2),
+                "capacidad": self.capacidad,
+                "por_minuto": round(self.rate * 60, 1),
+                "en_cola": len(self.cola),
+                "pausa_s": round(max(0.0, self.pausa_hasta - ahora), 2),
+                "usados": self.usados,
+                "esperas": self.esperas,
+            }
+
+
+_buckets: dict[str, TokenBucket] = {}
+_buckets_lock = threading.Lock()
+_stats = {"reintentos": 0, "errores_cuota": 0}
+
+
+def _bucket(tipo: str) -> TokenBucket:
+    with _buckets_lock:
+        b = _buckets.get(tipo)
+        if b is None:
+            por_minuto = float(os.getenv(f"SHEETS_{tipo.upper()}S_PER_MIN", "55"))
+            capacidad = float(os.getenv("SHEETS_BURST", "10"))
+            b = _buckets[tipo] = TokenBucket(tipo, por_minuto, capacidad)
+        return b
+
+
+def _reintentable(e: Exception, tipo: str) -> bool:
+    if not isinstance(e, gspread.exceptions.APIError):
+        return False
+    if e.code == 429:
+        return True
+    # Un 429 se rechaza antes de escribir; un 5xx en un append no se sabe
+    return tipo != "append" and 500 <= e.code < 600
+
+
+def llamar(tipo: str, fn, *args, **kwargs):
+    """
+    Ejecuta fn(*args, **kwargs) como una request de Sheets de tipo "read",
+    "write" o "append" (escritura que agrega filas), respetando la cuota y
+    reintentando errores de cuota/servidor.
+    """
+    bucket = _bucket("write" if tipo == "append" else tipo)
+    nivel = _prioridad.get()
+    max_reintentos = int(os.getenv("SHEETS_MAX_RETRIES", "5"))
+
+    intento = 0
+    while True:
+        bucket.acquire(nivel)
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if not _reintentable(e, tipo) or intento >= max_reintentos:
+                raise
+            if e.code == 429:
+                _stats["errores_cuota"] += 1
+            # Full jitter: entre 0 y min(64, 2^intento) segundos
+            espera = random.uniform(0, min(64.0, 2.0 ** intento))
+            bucket.pausar(espera)
+            _stats["reintentos"] += 1
+            intento += 1
+
+
+def estado() -> dict:
+    """Margen de cuota y profundidad de cola de cada bucket."""
+    return {
+        "read": _bucket("read").estado(),
+        "write": _bucket("write").estado(),
+        **_stats,
+    }
@@ -0,0 +1,178 @@
+"""
+Ingesta en segundo plano de Pendientes.
+
+Cada ciclo lee solo las filas de Pendientes posteriores al cursor guardado,
+busca cada comercio en el índice de Comercios y:
+- si es conocido (alias y categoría), anota el gasto en el journal, que lo
+  escribe en Gastos y marca OK en Pendientes en un mismo lote;
+- si no, lo deja "en espera" y pide clasificarlo UNA vez por comercio. Los
+  demás gastos de ese comercio se registran solos cuando se aprenda.
+
+El cursor y la lista de espera viven en SQLite (INGESTA_PATH), así un
+reinicio no vuelve a procesar ni a preguntar lo mismo. Cada planilla (ver
+services.planillas) tiene su propio cursor y su propia lista de espera.
+"""
+import os
+
+from services import candados, cuota, journal, metricas, planillas, sqlite_local, storage
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    clave TEXT PRIMARY KEY,
+    valor TEXT
+);
+CREATE TABLE IF NOT EXISTS espera (
+    email_id TEXT PRIMARY KEY,
+    comercio TEXT NOT NULL,      -- comercio_raw normalizado (strip + upper)
+    avisado  INTEGER NOT NULL DEFAULT 0,
+    planilla TEXT NOT NULL DEFAULT ''   -- '' = la principal
+);
+CREATE INDEX IF NOT EXISTS espera_comercio ON espera (comercio);
+"""
+
+
+def _migrar(conn):
+    # Bases creadas antes de que hubiera planillas por chat
+    columnas = {r[1] for r in conn.execute("PRAGMA table_info(espera)")}
+    if "planilla" not in columnas:
+        conn.execute("ALTER TABLE espera ADD COLUMN planilla TEXT NOT NULL DEFAULT ''")
+    conn.execute("CREATE INDEX IF NOT EXISTS espera_planilla ON espera (planilla, comercio)")
+
+
+def _path() -> str:
+    return os.getenv("INGESTA_PATH", "data/ingesta.sqlite3")
+
+
+def _connect():
+    return sqlite_local.conectar(_path(), _SCHEMA, _migrar)
+
+
+def _clave_cursor(planilla: str | None) -> str:
+    # La principal conserva la clave de antes de que hubiera planillas por chat
+    return f"cursor:{planilla}" if planilla else "cursor"
+
+
+def get_cursor(planilla: str | None = None) -> int | None:
+    with _connect() as conn:
+        row = conn.execute("SELECT valor FROM meta WHERE clave = ?", (_clave_cursor(planilla),)).fetchone()
+    return int(row[0]) if row else None
+
+
+def set_cursor(fila: int, planilla: str | None = None):
+    with _connect() as conn:
+        conn.execute(
+            "INSERT INTO meta (clave, valor) VALUES (?, ?) "
+            "ON CONFLICT (clave) DO UPDATE SET valor = excluded.valor",
+            (_clave_cursor(planilla), str(fila)),
+        )
+
+
+def desplazar_cursor(borradas: list[int], planilla: str | None = None):
+    """
+    Corre el cursor tras borrar esas filas de Pendientes (archivo de meses).
+    Se llama con el candado ("ingesta", planilla) tomado desde antes del borrado.
+    """
+    cursor = get_cursor(planilla)
+    if cursor is None or not borradas:
+        return
+    set_cursor(cursor - sum(1 for b in borradas if b <= cursor), planilla)
+
+
+def en_espera() -> int:
+    """Gastos esperando clasificación, en todas las planillas."""
+    with _connect() as conn:
+        return conn.execute("SELECT COUNT(*) FROM espera").fetchone()[0]
+
+
+def _gasto(row_index: int, p: dict, alias: str, categoria: str, planilla: str | None) -> dict:
+    return {
+        "row_index": row_index,
+        "fecha": p["fecha_email"], "hora": p["hora_email"], "descripcion": p["desc"], "monto": p["monto"],
+        "categoria": categoria, "comercio_raw": p["comercio_raw"], "comercio_alias": alias,
+        "usuario": "auto", "chat_id": "", "email_id": p["email_id"],
+        # El journal lo envía después, fuera de este contexto: la planilla va en el gasto
+        "planilla": planilla,
+    }
+
+
+@metricas.medir("ingesta.ingerir")
+def ingerir(planilla: str | None = None) -> dict:
+    """
+    Un ciclo de ingesta de la planilla `planilla` (None = la principal).
+    Retorna {"registrados": [gasto, ...], "preguntar": [(row_index, pendiente,
+    otros_del_comercio), ...], "en_espera": n} con un pendiente a preguntar por
+    cada comercio desconocido nuevo.
+    """
+    resumen = {"registrados": [], "preguntar": [], "en_espera": 0}
+    be = storage.backend()
+    clave = planilla or ""
+
+    # ("ingesta", planilla): el archivo de meses no borra filas de Pendientes
+    # ni corre el cursor a mitad de un ciclo (ver archivo.compactar)
+    with cuota.prioridad(cuota.FONDO), planillas.usar(planilla), candados.tomar([("ingesta", clave)]):
+        cursor = get_cursor(planilla)
+        if cursor is None:
+            # Primer arranque: por defecto se parte desde el final de la hoja
+            # (lo anterior se sigue clasificando a mano); INGESTA_DESDE fija la fila.
+            desde = os.getenv("INGESTA_DESDE")
+            if desde is None:
+                _, ultima = be.pendientes_nuevos(0)
+                set_cursor(ultima, planilla)
+                return resumen
+            cursor = int(desde) - 1
+
+        nuevos, ultima = be.pendientes_nuevos(cursor)
+
+        with _connect() as conn:
+            espera = conn.execute(
+                "SELECT email_id, comercio, avisado FROM espera WHERE planilla = ?", (clave,)
+            ).fetchall()
+
+        # Candidatos: lo que quedó esperando a que se aprenda su comercio + lo nuevo
+        candidatos = {}
+        for email_id, _, _ in espera:
+            row_index, p = be.get_pendiente(email_id)
+            candidatos[email_id] = (row_index, p)
+        for row_index, p in nuevos:
+            candidatos.setdefault(str(p["email_id"]).strip(), (row_index, p))
+
+        gastos = []
+        desconocidos = {}   # comercio normalizado -> [(row_index, pendiente), ...]
+        resueltos = set()
+        for email_id, (row_index, p) in candidatos.items():
+            if not p or (p.get("estado") or "").strip().upper() == "OK" or be.gasto_registrado(email_id):
+                resueltos.add(email_id)
+                continue
+            alias, categoria = be.get_mapping(p["comercio_raw"])
+            if alias and categoria:
+                gastos.append(_gasto(row_index, p, alias, categoria, planilla))
+                resueltos.add(email_id)
+            else:
+                desconocidos.setdefault(storage.norm_comercio(p["comercio_raw"]), []).append((row_index, p))
+
+        # El journal descarta los email_id ya anotados (p. ej. clasificados a mano)
+        nuevos_ids = journal.registrar_varios(gastos, flujo="ingesta") if gastos else set()
+        resumen["registrados"] = [g for g in gastos if g["email_id"] in nuevos_ids]
+
+        avisados = {comercio for _, comercio, avisado in espera if avisado}
+        with _connect() as conn:
+            conn.executemany("DELETE FROM espera WHERE email_id = ?", [(e,) for e in resueltos])
+            for comercio, items in desconocidos.items():
+                conn.executemany(
+                    "INSERT OR IGNORE INTO espera (email_id, comercio, avisado, planilla) VALUES (?, ?, 0, ?)",
+                    [(str(p["email_id"]).strip(), comercio, clave) for _, p in items],
+                )
+                if comercio in avisados:
+                    continue
+                conn.execute("UPDATE espera SET avisado = 1 WHERE comercio = ? AND planilla = ?", (comercio, clave))
+                row_index, p = items[0]
+                resumen["preguntar"].append((row_index, p, len(items) - 1))
+            resumen["en_espera"] = conn.execute(
+                "SELECT COUNT(*) FROM espera WHERE planilla = ?", (clave,)
+            ).fetchone()[0]
+
+        set_cursor(ultima, planilla)
+
+    metricas.contar("ingesta.registrados", len(resumen["registrados"]))
+    metricas.contar("ingesta.preguntas", len(resumen["preguntar"]))
+    return resumen
@@ -0,0 +1,240 @@
+"""
+Journal local (SQLite) de gastos por escribir en Sheets.
+
+El handler anota el gasto aquí (desde el pool de services.sheets_async) y
+responde de inmediato; un loop en segundo plano manda lo pendiente al backend
+en lotes (registrar_gastos), un lote por planilla de destino, con reintentos
+y backoff por lote (hasta 5 minutos). Los errores pasajeros (cuota, 5xx, red)
+se reintentan siempre; solo un error permanente (sin permisos, planilla
+borrada, datos inválidos) repetido JOURNAL_MAX_INTENTOS veces deja el gasto
+en ERROR (se ve en /stats). Lo que quede sin enviar, y lo que esté en ERROR,
+se vuelve a encolar al reiniciar; un gasto en ERROR también vuelve a la cola
+si se registra de nuevo. La clave es el email_id, así un mismo gasto no se
+anota dos veces.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+
+import gspread
+
+from services import cuota, sqlite_local, storage
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    email_id TEXT PRIMARY KEY,
+    payload  TEXT NOT NULL,
+    estado   TEXT NOT NULL DEFAULT 'PENDIENTE',
+    intentos INTEGER NOT NULL DEFAULT 0,
+    proximo  REAL NOT NULL DEFAULT 0,
+    creado   REAL NOT NULL,
+    error    TEXT
+);
+CREATE INDEX IF NOT EXISTS journal_pendientes ON journal (estado, proximo);
+"""
+
+_despertar: asyncio.Event | None = None
+_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _path() -> str:
+    return os.getenv("JOURNAL_PATH", "data/journal.sqlite3")
+
+
+def _connect():
+    return sqlite_local.conectar(_path(), _SCHEMA)
+
+
+def _avisar():
+    """Despierta a flush_loop; se llama desde los hilos del pool."""
+    if _despertar is not None and _loop is not None and not _loop.is_closed():
+        _loop.call_soon_threadsafe(_despertar.set)
+
+
+# Un email_id en ERROR que se vuelve a registrar vuelve a la cola (con los datos nuevos)
+_INSERTAR = (
+    "INSERT INTO journal (email_id, payload, creado) VALUES (?, ?, ?) "
+    "ON CONFLICT (email_id) DO UPDATE SET estado = 'PENDIENTE', payload = excluded.payload, "
+    "intentos = 0, proximo = 0, error = NULL WHERE journal.estado = 'ERROR'"
+)
+
+
+def registrar(row_index: int, email_id: str, flujo: str = "registrar_gasto", **gasto) -> bool:
+    """
+    Anota un gasto para enviarlo a Sheets. Retorna False si ese email_id ya
+    estaba en el journal (enviado o por enviar); uno en ERROR vuelve a la cola.
+    """
+    payload = dict(gasto, row_index=row_index, email_id=email_id, flujo=flujo)
+    with _connect() as conn:
+        cur = conn.execute(_INSERTAR, (email_id, json.dumps(payload, ensure_ascii=False), time.time()))
+    if cur.rowcount:
+        _avisar()
+    return bool(cur.rowcount)
+
+
+def registrar_varios(gastos: list[dict], flujo: str = "registrar_gastos") -> set[str]:
+    """
+    Como registrar() para varios gastos (cada dict trae row_index y email_id)
+    en una sola transacción. Retorna los email_id que no estaban anotados.
+    """
+    nuevos = set()
+    with _connect() as conn:
+        for gasto in gastos:
+            payload = dict(gasto, flujo=flujo)
+            cur = conn.execute(_INSERTAR, (gasto["email_id"], json.dumps(payload, ensure_ascii=False), time.time()))
+            if cur.rowcount:
+                nuevos.add(gasto["email_id"])
+    if nuevos:
+        _avisar()
+    return nuevos
+
+
+def pendientes() -> int:
+    with _connect() as conn:
+        return conn.execute("SELECT COUNT(*) FROM journal WHERE estado = 'PENDIENTE'").fetchone()[0]
+
+
+def estado() -> dict:
+    """{"pendientes": n, "error": n, "ultimo_error": texto}; para /stats."""
+    with _connect() as conn:
+        por_estado = dict(conn.execute(
+            "SELECT estado, COUNT(*) FROM journal WHERE estado IN ('PENDIENTE', 'ERROR') GROUP BY estado"
+        ).fetchall())
+        ultimo = conn.execute(
+            "SELECT email_id, error FROM journal WHERE estado = 'ERROR' ORDER BY creado DESC LIMIT 1"
+        ).fetchone()
+    r = {"pendientes": por_estado.get("PENDIENTE", 0), "error": por_estado.get("ERROR", 0)}
+    if ultimo:
+        r["ultimo_error"] = f"{ultimo[0]}: {ultimo[1]}"
+    return r
+
+
+def _destino(gasto: dict) -> tuple:
+    # La planilla a la que va el gasto: la explícita (ingesta) o la de su chat
+    if "planilla" in gasto:
+        return ("planilla", gasto["planilla"] or "")
+    return ("chat", str(gasto.get("chat_id") or ""))
+
+
+def _permanente(e: Exception) -> bool:
+    """True si reintentar no lo va a arreglar solo (hace falta que alguien intervenga)."""
+    if isinstance(e, (gspread.exceptions.SpreadsheetNotFound, gspread.exceptions.WorksheetNotFound)):
+        return True
+    if isinstance(e, gspread.exceptions.APIError):
+        # 401 se re-autoriza, 408/429 son de tiempo o cuota; 5xx es de Google
+        return 400 <= e.code < 500 and e.code not in (401, 408, 429)
+    # Un payload que el backend no entiende
+    return isinstance(e, (KeyError, ValueError, TypeError))
+
+
+def _fallo(lote: list, error: Exception, ahora: float):
+    """
+    Backoff para los gastos del lote. Con un error pasajero se reintenta
+    siempre; con uno permanente, los que agotaron JOURNAL_MAX_INTENTOS pasan a ERROR.
+    """
+    maximo = max(int(os.getenv("JOURNAL_MAX_INTENTOS", "10")), 1)
+    permanente = _permanente(error)
+    agotados = []
+    with _connect() as conn:
+        for email_id, intentos, _ in lote:
+            if permanente and intentos + 1 >= maximo:
+                agotados.append(email_id)
+                conn.execute(
+                    "UPDATE journal SET estado = 'ERROR', intentos = intentos + 1, error = ? WHERE email_id = ?",
+                    (str(error), email_id),
+                )
+                continue
+            espera = min(300, 2 ** min(intentos, 9)) * random.uniform(0.5, 1.5)
+            conn.execute(
+                "UPDATE journal SET intentos = intentos + 1, proximo = ?, error = ? WHERE email_id = ?",
+                (ahora + espera, str(error), email_id),
+            )
+    tipo = "permanente" if permanente else "pasajero"
+    print(f"Journal: falló el envío de {len(lote)} gastos ({len(lote) - len(agotados)} se reintentarán), error {tipo}: {error}")
+    if agotados:
+        print(f"Journal: {len(agotados)} gasto(s) en ERROR tras {maximo} intentos: {', '.join(agotados)}")
+
+
+def reencolar_errores() -> int:
+    """Vuelve a la cola los gastos en ERROR (al arrancar). Retorna cuántos."""
+    with _connect() as conn:
+        cur = conn.execute(
+            "UPDATE journal SET estado = 'PENDIENTE', intentos = 0, proximo = 0 WHERE estado = 'ERROR'"
+        )
+    if cur.rowcount:
+        print(f"Journal: {cur.rowcount} gasto(s) en ERROR vuelven a la cola")
+    return cur.rowcount
+
+
+def flush(limite: int | None = None) -> int:
+    """
+    Envía al backend los gastos pendientes cuyo reintento ya venció, un lote
+    por planilla de destino: si una planilla falla (sin permisos, borrada),
+    solo sus gastos esperan el backoff. Retorna cuántos se enviaron.
+    """
+    limite = limite or int(os.getenv("JOURNAL_BATCH", "50"))
+    ahora = time.time()
+    with _connect() as conn:
+        filas = conn.execute(
+            "SELECT email_id, payload, intentos FROM journal "
+            "WHERE estado = 'PENDIENTE' AND proximo <= ? ORDER BY creado LIMIT ?",
+            (ahora, limite),
+        ).fetchall()
+    if not filas:
+        return 0
+
+    lotes = {}   # destino -> [(email_id, intentos, gasto)]
+    for email_id, payload, intentos in filas:
+        gasto = json.loads(payload)
+        gasto.pop("flujo", None)
+        lotes.setdefault(_destino(gasto), []).append((email_id, intentos, gasto))
+
+    enviados = 0
+    for lote in lotes.values():
+        try:
+            # Es sincronización de fondo: cede la cuota a las consultas interactivas
+            with cuota.prioridad(cuota.FONDO):
+                storage.backend().registrar_gastos([gasto for _, _, gasto in lote], flujo="journal")
+        except Exception as e:
+            _fallo(lote, e, ahora)
+            continue
+
+        with _connect() as conn:
+            conn.executemany(
+                "UPDATE journal SET estado = 'ENVIADO', error = NULL WHERE email_id = ?",
+                [(email_id,) for email_id, _, _ in lote],
+            )
+        enviados += len(lote)
+    return enviados
+
+
+async def flush_loop():
+    """Loop de fondo: envía el journal cada JOURNAL_FLUSH_S segundos o cuando llega un gasto."""
+    from services import sheets_async
+
+    global _despertar, _loop
+    _despertar = asyncio.Event()
+    _loop = asyncio.get_running_loop()
+    intervalo = float(os.getenv("JOURNAL_FLUSH_S", "5"))
+    try:
+        # Lo que quedó en ERROR en la corrida anterior se vuelve a intentar
+        await sheets_async.run(reencolar_errores)
+    except Exception as e:
+        print(f"Journal: no pude reencolar los errores: {e}")
+
+    while True:
+        try:
+            enviados = await sheets_async.run(flush)
+            if enviados:
+                # Puede haber más en cola: seguimos sin esperar
+                continue
+        except Exception as e:
+            print(f"Journal: error en flush: {e}")
+
+        try:
+            await asyncio.wait_for(_despertar.wait(), timeout=intervalo)
+        except asyncio.TimeoutError:
+            pass
+        _despertar.clear()
@@ -0,0 +1,191 @@
+"""
+Instrumentación del bot: histogramas de latencia, conteo de llamadas,
+errores y filas leídas por operación (handlers y funciones de storage).
+
+Se consulta con /stats (solo ADMIN_CHAT_ID) y, si METRICS_PORT está
+definido, en formato Prometheus en http://127.0.0.1:<METRICS_PORT>/metrics.
+"""
+import functools
+import inspect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Límites superiores de los buckets del histograma, en segundos
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+_ops = {}        # nombre -> {"n", "errores", "suma", "filas", "buckets": [..]}
+_contadores = {}  # nombre -> int
+_lock = threading.Lock()
+
+
+def _op(nombre: str) -> dict:
+    op = _ops.get(nombre)
+    if op is None:
+        op = _ops[nombre] = {"n": 0, "errores": 0, "suma": 0.0, "filas": 0, "buckets": [0] * len(BUCKETS)}
+    return op
+
+
+def observar(nombre: str, segundos: float, error: bool = False):
+    with _lock:
+        op = _op(nombre)
+        op["n"] += 1
+        op["suma"] += segundos
+        if error:
+            op["errores"] += 1
+        for i, limite in enumerate(BUCKETS):
+            if segundos <= limite:
+                op["buckets"][i] += 1
+                break
+
+
+def filas_leidas(nombre: str, filas: int):
+    with _lock:
+        _op(nombre)["filas"] += filas
+
+
+def contar(nombre: str, n: int = 1):
+    with _lock:
+        _contadores[nombre] = _contadores.get(nombre, 0) + n
+
+
+@contextmanager
+def medir_bloque(nombre: str):
+    """Mide la latencia del bloque (sirve también alrededor de awaits)."""
+    t0 = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        observar(nombre, time.perf_counter() - t0, error)
+
+
+def medir(nombre: str):
+    """Decorador: mide cada llamada a la función (sync o async)."""
+    def deco(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with medir_bloque(nombre):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with medir_bloque(nombre):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+# Fases del arranque, en orden: [(fase, segundos), ...]
+_arranque = []
+
+
+@contextmanager
+def fase(nombre: str):
+    """Mide una fase del arranque (queda en arranque_texto() y en arranque.<fase>)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        segundos = time.perf_counter() - t0
+        _arranque.append((nombre, segundos))
+        observar(f"arranque.{nombre}", segundos)
+
+
+def arranque_texto() -> str:
+    total = sum(s for _, s in _arranque)
+    fases = " · ".join(f"{nombre} {s * 1000:.0f}ms" for nombre, s in _arranque)
+    return f"{total * 1000:.0f}ms ({fases})"
+
+
+def _percentil(op: dict, p: float) -> float:
+    """Cota superior del percentil p según los buckets (inf si cae en el último)."""
+    objetivo = op["n"] * p
+    acumulado = 0
+    for limite, n in zip(BUCKETS, op["buckets"]):
+        acumulado += n
+        if acumulado >= objetivo:
+            return limite
+    return BUCKETS[-1]
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            "ops": {nombre: dict(op, buckets=list(op["buckets"])) for nombre, op in _ops.items()},
+            "contadores": dict(_contadores),
+        }
+
+
+def resumen_texto(limite: int = 25) -> str:
+    """Tabla compacta para /stats: las operaciones con más tiempo acumulado."""
+    snap = snapshot()
+    ops = sorted(snap["ops"].items(), key=lambda kv: kv[1]["suma"], reverse=True)[:limite]
+    lineas = [f"{'op':<32}{'n':>6}{'err':>5}{'avg ms':>8}{'p95<=':>8}{'filas':>8}"]
+    for nombre, op in ops:
+        avg = op["suma"] / op["n"] * 1000 if op["n"] else 0
+        p95 = _percentil(op, 0.95)
+        p95_txt = "inf" if p95 == float("inf") else f"{p95 * 1000:.0f}"
+        lineas.append(f"{nombre[:32]:<32}{op['n']:>6}{op['errores']:>5}{avg:>8.1f}{p95_txt:>8}{op['filas']:>8}")
+    for nombre, n in sorted(snap["contadores"].items()):
+        lineas.append(f"{nombre}: {n}")
+    return "\n".join(lineas)
+
+
+def _le(limite: float) -> str:
+    return "+Inf" if limite == float("inf") else repr(limite)
+
+
+def texto_prometheus() -> str:
+    snap = snapshot()
+    out = [
+        "# HELP gastobot_latencia_segundos Latencia por operación (handlers y storage).",
+        "# TYPE gastobot_latencia_segundos histogram",
+    ]
+    for nombre, op in sorted(snap["ops"].items()):
+        acumulado = 0
+        for limite, n in zip(BUCKETS, op["buckets"]):
+            acumulado += n
+            out.append(f'gastobot_latencia_segundos_bucket{{op="{nombre}",le="{_le(limite)}"}} {acumulado}')
+        out.append(f'gastobot_latencia_segundos_sum{{op="{nombre}"}} {op["suma"]}')
+        out.append(f'gastobot_latencia_segundos_count{{op="{nombre}"}} {op["n"]}')
+    out += ["# HELP gastobot_errores_total Errores por operación.", "# TYPE gastobot_errores_total counter"]
+    out += [f'gastobot_errores_total{{op="{n}"}} {op["errores"]}' for n, op in sorted(snap["ops"].items())]
+    out += ["# HELP gastobot_filas_leidas_total Filas leídas de Sheets por operación.", "# TYPE gastobot_filas_leidas_total counter"]
+    out += [f'gastobot_filas_leidas_total{{op="{n}"}} {op["filas"]}' for n, op in sorted(snap["ops"].items()) if op["filas"]]
+    out += ["# HELP gastobot_eventos_total Contadores varios.", "# TYPE gastobot_eventos_total counter"]
+    out += [f'gastobot_eventos_total{{nombre="{n}"}} {v}' for n, v in sorted(snap["contadores"].items())]
+    return "\n".join(out) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        cuerpo = texto_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+
+def servir_prometheus(port: int | None = None, host: str = "127.0.0.1") -> ThreadingHTTPServer | None:
+    """Levanta /metrics en un hilo si METRICS_PORT (o `port`) está definido."""
+    port = port or int(os.getenv("METRICS_PORT", "0"))
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metricas", daemon=True).start()
+    print(f"📈 Métricas Prometheus en http://{host}:{port}/metrics")
+    return server
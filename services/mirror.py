@@ -0,0 +1,112 @@
+"""
+Espejo entre el backend SQLite y el spreadsheet.
+
+Con STORAGE_BACKEND=sqlite el bot lee y escribe solo en local; este job
+(opcional, SQLITE_MIRROR=1) mantiene la planilla al día para que la familia
+la siga viendo en Sheets:
+- pull: trae las filas nuevas de Pendientes (las escribe el lector de correos).
+- push: replica en Sheets los cambios locales de Gastos, Comercios, Usuarios
+  y Pendientes en un solo WritePlan.
+"""
+import os
+
+from services import candados, cuota, sheets, sqlite_store
+
+
+def importar_inicial():
+    """Si la base local está vacía, copia Usuarios y Comercios desde Sheets."""
+    if sqlite_store.vacia("usuarios"):
+        for chat_id, u in sheets.refresh_usuarios()["rows"].items():
+            sqlite_store.upsert_usuario(chat_id, u["nombre"], u["estado"] or "")
+    if sqlite_store.vacia("comercios"):
+        for raw, c in sheets.refresh_comercios()["rows"].items():
+            sqlite_store.upsert_mapping(raw, c["alias"] or "", c["categoria"])
+    # Lo importado ya está en Sheets: no hay nada que replicar
+    sqlite_store.borrar_cambios([c["id"] for c in sqlite_store.cambios(limite=1_000_000)])
+
+
+def pull_pendientes() -> int:
+    """Trae a SQLite las filas de Pendientes agregadas desde el último pull."""
+    ultima = int(sqlite_store.get_meta("pendientes_fila", "1"))
+    registros, ultima = sheets.leer_pendientes_desde(ultima + 1)
+    nuevos = sqlite_store.insertar_pendientes(registros)
+    sqlite_store.set_meta("pendientes_fila", ultima)
+    return nuevos
+
+
+def push(limite: int = 500) -> int:
+    """Replica en Sheets los cambios locales pendientes. Retorna cuántos envió."""
+    cambios = sqlite_store.cambios(limite)
+    if not cambios:
+        return 0
+
+    # Las filas de Comercios y Usuarios que toca el plan quedan tomadas hasta el
+    # commit, y las de Pendientes no se corren (archivo) entre resolverlas y marcarlas
+    claves = [
+        ("comercio", c["clave"]) if c["tabla"] == "comercios" else ("usuario", c["clave"])
+        for c in cambios if c["tabla"] in ("comercios", "usuarios")
+    ]
+    with candados.tomar(claves), sheets._filas_pendientes_lock:
+        _push(cambios)
+    sqlite_store.borrar_cambios([c["id"] for c in cambios])
+    return len(cambios)
+
+
+def _push(cambios: list):
+    plan = sheets.WritePlan("mirror")
+    if any(c["tabla"] == "gastos" for c in cambios):
+        # Un push anterior pudo agregar la fila a Gastos y fallar después (sin
+        # borrar los cambios): con la cola al día no se agrega otra vez
+        sheets.refresh_gastos()
+    vistos = set()
+    enviados = set()   # email_id de Gastos que ya van en este plan
+    for c in cambios:
+        tabla, clave = c["tabla"], c["clave"]
+        # Varios cambios de la misma fila: basta con escribir su estado final
+        if tabla != "gastos" and (tabla, clave) in vistos:
+            continue
+        vistos.add((tabla, clave))
+
+        if tabla == "gastos":
+            g = sqlite_store.leer("gastos", "id", int(clave))
+            email_id = g["email_id"] if g else None
+            if not g or (email_id and (email_id in enviados or sheets.gasto_registrado(email_id))):
+                continue
+            enviados.add(email_id)
+            sheets.append_gasto(
+                fecha=g["fecha"], hora=g["hora"], descripcion=g["descripcion"], monto=g["monto"],
+                categoria=g["categoria"], comercio_raw=g["comercio_raw"], comercio_alias=g["comercio_alias"],
+                usuario=g["usuario"], chat_id=g["chat_id"], email_id=email_id, plan=plan,
+            )
+        elif tabla == "comercios":
+            m = sqlite_store.leer("comercios", "clave", clave)
+            if m:
+                sheets.upsert_mapping(m["comercio_raw"], m["alias"], m["categoria"] or None, plan=plan)
+        elif tabla == "usuarios":
+            u = sqlite_store.leer("usuarios", "chat_id", clave)
+            if u:
+                sheets.upsert_usuario(u["chat_id"], u["nombre"], u["estado"] or "", plan=plan)
+        elif tabla == "pendientes":
+            p = sqlite_store.leer("pendientes", "id", int(clave))
+            if p and p["sheet_row"] and p["estado"] == "OK":
+                # sheet_row es la fila del pull: si se archivó algo antes, ya no es esa
+                fila, _ = sheets.get_pendiente(p["email_id"])
+                if fila:
+                    sheets.mark_pendiente_ok(fila, plan=plan)
+
+    plan.commit()
+
+
+def sincronizar():
+    """Un ciclo completo del espejo (pull + push), con prioridad de fondo."""
+    with cuota.prioridad(cuota.FONDO):
+        pull_pendientes()
+        while push():
+            pass
+
+
+def activo() -> bool:
+    return (
+        os.getenv("STORAGE_BACKEND", "sheets").strip().lower() == "sqlite"
+        and os.getenv("SQLITE_MIRROR", "0") == "1"
+    )
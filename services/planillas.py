@@ -0,0 +1,100 @@
+"""
+Planillas (spreadsheets) por chat u hogar.
+
+La planilla principal (GOOGLE_SHEET_ID) tiene el registro de Usuarios; la
+columna E de cada usuario dice en qué planilla viven sus Gastos, Comercios y
+Pendientes (vacía = la principal). Varios chats con el mismo id comparten
+planilla (un hogar).
+
+La planilla "actual" es un contextvar: ProcesadorPorChat la fija al atender
+un update y services.sheets_async la copia al hilo que hace la I/O, así el
+código de services.sheets no recibe el id en cada llamada. Los índices en
+memoria se separan por planilla con PorPlanilla.
+"""
+import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_actual: ContextVar[str | None] = ContextVar("planilla", default=None)
+
+
+def principal() -> str:
+    sheet_id = os.getenv("GOOGLE_SHEET_ID")
+    if not sheet_id:
+        raise RuntimeError("Falta GOOGLE_SHEET_ID en .env")
+    return sheet_id
+
+
+def actual() -> str:
+    return _actual.get() or principal()
+
+
+def es_principal() -> bool:
+    return actual() == principal()
+
+
+@contextmanager
+def usar(sheet_id: str | None):
+    """Dentro del bloque, services.sheets lee y escribe en `sheet_id` (None = la principal)."""
+    token = _actual.set(sheet_id or None)
+    try:
+        yield
+    finally:
+        _actual.reset(token)
+
+
+class PorPlanilla:
+    """
+    Un dict de estado por planilla con la misma interfaz que el dict suelto
+    que reemplaza (estado["rows"], estado.update(...)): cada acceso va al de
+    la planilla actual, que se crea con `fabrica()` la primera vez.
+    """
+
+    def __init__(self, fabrica):
+        self._fabrica = fabrica
+        self._estados = {}
+        self._mutex = threading.Lock()
+
+    def de(self, sheet_id: str | None = None) -> dict:
+        sheet_id = sheet_id or actual()
+        estado = self._estados.get(sheet_id)
+        if estado is None:
+            with self._mutex:
+                estado = self._estados.setdefault(sheet_id, self._fabrica())
+        return estado
+
+    def __getitem__(self, clave):
+        return self.de()[clave]
+
+    def __setitem__(self, clave, valor):
+        self.de()[clave] = valor
+
+    def get(self, clave, default=None):
+        return self.de().get(clave, default)
+
+    def update(self, *args, **kwargs):
+        self.de().update(*args, **kwargs)
+
+    def planillas(self) -> list[str]:
+        """Planillas que ya tienen estado en este proceso."""
+        return list(self._estados)
+
+    def reset(self):
+        with self._mutex:
+            self._estados.clear()
+
+
+class LockPorPlanilla:
+    """RLock separado por planilla: cargar una planilla no frena a las demás."""
+
+    def __init__(self):
+        self._locks = PorPlanilla(threading.RLock)
+
+    def __enter__(self):
+        self._locks.de().acquire()
+        return self
+
+    def __exit__(self, *exc):
+        # usar() se anida con los with: la planilla actual es la misma que al entrar
+        self._locks.de().release()
@@ -1,138 +1,887 @@
+import itertools
 import os
+import re
+import threading
+import time
+from collections import Counter
+
 import gspread
+from gspread.utils import absolute_range_name
 from google.oauth2.service_account import Credentials
 
-SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+from services import agregados, archivo, candados, cuota, metricas, planillas
+from services.storage import CATEGORIAS_BASE, norm_comercio
+
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    # Solo para leer modifiedTime de la planilla (sondeo de cambios)
+    "https://www.googleapis.com/auth/drive.metadata.readonly",
+]
+
+# -------------------------
+# USUARIOS
+# -------------------------
+# Estado de cada chat (AUTORIZADO / PENDIENTE / RECHAZADO) en memoria. Un chat
+# que no está en el índice es desconocido (caché negativa: no se vuelve a leer
+# la hoja por él). upsert_usuario lo actualiza al escribir y refresh_usuarios()
+# lo recarga en segundo plano.
+# Usuarios vive solo en la planilla principal y es el registro de planillas:
+# la columna E dice dónde están los datos de cada chat (ver services.planillas).
+# Se consulta desde el event loop (is_authorized, el ruteo por planilla): las
+# lecturas no toman _usuarios_lock, y ese lock nunca se tiene durante I/O. Una
+# recarga lee la hoja sin lock y reemplaza "rows" de una vez.
+_usuarios = {
+    "rows": {},       # chat_id (str) -> {"row", "nombre", "estado", "planilla": str | None}
+    "next_row": 2,
+    "ts": 0,
+    "version": 0,     # sube con cada escritura propia (ver _usuarios_escrito)
+}
+# Orden de los locks (en todo el módulo, para no bloquearse entre hilos):
+#   candados -> _filas_pendientes_lock -> _comercios_lock -> _pendientes_lock
+#   -> _gastos_lock -> _usuarios_lock
+# _usuarios_lock es la hoja: con él tomado no se pide ningún otro lock.
+# _usuarios_carga (I/O) nunca se pide con un lock de índice tomado.
+_usuarios_lock = threading.RLock()
+_usuarios_carga = threading.Lock()   # una recarga a la vez
+
 
+@metricas.medir("sheets.refresh_usuarios")
+def refresh_usuarios():
+    """Recarga completa del índice de Usuarios desde la hoja."""
+    with _usuarios_carga, planillas.usar(planillas.principal()):
+        for _ in range(3):
+            version = _usuarios["version"]
+            values = leer_rangos([("Usuarios", COLS_USUARIOS, 2)])[0]
+            indice = _indexar_usuarios(values, 2, version)
+            if indice is not None:
+                return indice
+        # Escrituras propias en cada lectura: el índice actual ya las tiene
+        print("Sheets: Usuarios cambió durante la recarga; se mantiene el índice en memoria")
+        return _usuarios
+
+
+def _indexar_usuarios(values: list, desde: int, version: int | None = None):
+    """
+    Reemplaza el índice con `values`. Con `version` (la de antes de leer), no
+    lo toca y retorna None si entretanto hubo una escritura propia: la
+    lectura podría no incluirla.
+    """
+    rows = {}
+    for idx, row in enumerate(values, start=desde):
+        chat_id = str(row[0]).strip() if row else ""
+        if not chat_id or chat_id in rows:
+            continue
+        rows[chat_id] = {
+            "row": idx,
+            "nombre": row[1] if len(row) > 1 else "",
+            "estado": row[2].strip().upper() if len(row) > 2 else None,
+            "planilla": (row[4] if len(row) > 4 else "").strip() or None,
+        }
+
+    with _usuarios_lock:
+        if version is not None and version != _usuarios["version"]:
+            return None
+        _usuarios["rows"] = rows
+        _usuarios["next_row"] = desde + len(values)
+        _usuarios["ts"] = time.time()
+        return _usuarios
+
+
+def usuarios_cargados() -> bool:
+    return _usuarios["ts"] > 0
+
+
+def _usuarios_escrito():
+    # Lo llaman los callbacks de escritura, con _usuarios_lock tomado
+    _usuarios["version"] += 1
+
+
+def _usuarios_index():
+    # Sin lock: ya cargado, es solo leer una referencia
+    if not usuarios_cargados():
+        return refresh_usuarios()
+    return _usuarios
+
+
+@metricas.medir("sheets.get_estado_usuario")
 def get_estado_usuario(chat_id: int) -> str | None:
-    ws = _open_ws("Usuarios")
-    values = ws.get_all_values()
-    target = str(chat_id)
-    for row in values[1:]:
-        if str(row[0]).strip() == target:
-            return row[2].strip().upper() if len(row) > 2 else None
-    return None
+    entry = _usuarios_index()["rows"].get(str(chat_id))
+    return entry["estado"] if entry else None
 
+@metricas.medir("sheets.get_usuarios_autorizados")
 def get_usuarios_autorizados() -> set[int]:
-    ws = _open_ws("Usuarios")
-    values = ws.get_all_values()
+    # list() copia de una vez (sin soltar el GIL): una escritura concurrente no la corta
+    rows = list(_usuarios_index()["rows"].items())
     return {
-        int(row[0]) for row in values[1:]
-        if len(row) > 2 and row[2].strip().upper() == "AUTORIZADO"
+        int(chat_id) for chat_id, entry in rows
+        if entry["estado"] == "AUTORIZADO" and chat_id.lstrip("-").isdigit()
     }
 
-def upsert_usuario(chat_id: int, nombre: str, estado: str):
+@metricas.medir("sheets.upsert_usuario")
+def upsert_usuario(
+    chat_id: int, nombre: str, estado: str, plan: "WritePlan | None" = None, si_estado: str | None = None,
+) -> bool:
+    """
+    Con `plan` solo agrega las escrituras (quien lo commitea debe tener la
+    clave ("usuario", chat_id) tomada con candados.tomar).
+    Con si_estado solo escribe si el estado actual es ese ("" = el chat no
+    está registrado); sobre una fila existente el estado de la hoja se
+    verifica en el mismo commit (otro proceso pudo cambiarlo). Retorna si escribió.
+    """
+    if plan is not None:
+        _plan_usuario(plan, chat_id, nombre, estado)
+        return True
+
+    def _escribir():
+        entry = _usuarios_index()["rows"].get(str(chat_id))
+        if si_estado is not None and ((entry or {}).get("estado") or "") != si_estado.strip().upper():
+            return False
+        plan = WritePlan("upsert_usuario", sheet_id=planillas.principal())
+        _plan_usuario(plan, chat_id, nombre, estado, si_estado)
+        plan.commit()
+        return True
+
+    with candados.tomar([("usuario", chat_id)]):
+        try:
+            return _reintentar_desplazada(_escribir)
+        except FilaDesplazada:
+            # Cambió dos veces seguidas: para una transición condicional, no escribió
+            if si_estado is None:
+                raise
+            return False
+
+
+def _plan_usuario(plan: "WritePlan", chat_id: int, nombre: str, estado: str, si_estado: str | None = None):
     from datetime import date
-    ws = _open_ws("Usuarios")
-    values = ws.get_all_values()
     target = str(chat_id)
+    index = _usuarios_index()
 
-    for idx, row in enumerate(values[1:], start=2):
-        if str(row[0]).strip() == target:
-            ws.update_acell(f"B{idx}", nombre)
-            ws.update_acell(f"C{idx}", estado)
-            return
+    with _usuarios_lock:
+        entry = index["rows"].get(target)
+
+        if entry:
+            idx = entry["row"]
+            # La fila tiene que seguir siendo la de este chat (alguien pudo
+            # insertar o borrar filas a mano)
+            plan.verificar("Usuarios", f"A{idx}", target, al_fallar=refresh_usuarios)
+            if si_estado is not None:
+                plan.verificar("Usuarios", f"C{idx}", si_estado, al_fallar=refresh_usuarios)
+            plan.update("Usuarios", f"B{idx}", nombre)
+            plan.update("Usuarios", f"C{idx}", estado)
+
+            def _actualizar():
+                with _usuarios_lock:
+                    # Una recarga pudo reemplazar la entrada mientras tanto
+                    actual = _usuarios["rows"].get(target, entry)
+                    actual["nombre"] = nombre
+                    actual["estado"] = estado.strip().upper()
+                    _usuarios_escrito()
 
-    ws.append_row(
-        [str(chat_id), nombre, estado, str(date.today())],
-        value_input_option="USER_ENTERED"
-    )
+            plan.after_commit(_actualizar)
+        else:
+            def _agregar(idx):
+                with _usuarios_lock:
+                    idx = idx or index["next_row"]
+                    index["rows"][target] = {
+                        "row": idx, "nombre": nombre, "estado": estado.strip().upper(), "planilla": None,
+                    }
+                    index["next_row"] = max(index["next_row"], idx + 1)
+                    _usuarios_escrito()
+
+            plan.append("Usuarios", [target, nombre, estado, str(date.today())], on_row=_agregar)
+
+
+def planilla_de(chat_id) -> str | None:
+    """
+    Planilla registrada para el chat (None = la principal). No lee la hoja:
+    el índice de Usuarios ya está cargado antes de atender updates.
+    """
+    entry = _usuarios["rows"].get(str(chat_id).strip())
+    return entry.get("planilla") if entry else None
+
+
+def en_planilla(chat_id):
+    """Context manager: lo que se haga dentro usa la planilla del chat."""
+    return planillas.usar(planilla_de(chat_id))
+
+
+def planillas_registradas() -> set[str | None]:
+    """None (la principal) más todas las que aparecen en el registro de Usuarios."""
+    return {None} | {
+        e["planilla"] for e in list(_usuarios["rows"].values()) if e.get("planilla")
+    }
 
 
+@metricas.medir("sheets.set_planilla")
+def set_planilla(chat_id: int, sheet_id: str | None):
+    """
+    Asigna la planilla de un chat (None o vacío = la principal). La planilla
+    tiene que estar compartida con la Service Account y tener las hojas
+    Gastos, Comercios y Pendientes: se abre y se cargan sus índices antes de
+    registrarla, así una planilla que no sirve no queda asignada.
+    """
+    target = str(chat_id)
+    sheet_id = (sheet_id or "").strip() or None
+    if sheet_id == planillas.principal():
+        sheet_id = None
+    if sheet_id:
+        # Falla aquí (sin permisos, falta una hoja) sin haber tocado Usuarios;
+        # de paso los índices quedan listos antes del primer mensaje del chat
+        _open_sheet(sheet_id)
+        with planillas.usar(sheet_id):
+            cargar_planilla()
+
+    def _escribir():
+        entry = _usuarios_index()["rows"].get(target)
+        if not entry:
+            raise KeyError(f"El chat {chat_id} no está en Usuarios")
+        idx = entry["row"]
+        plan = WritePlan("set_planilla", sheet_id=planillas.principal())
+        plan.verificar("Usuarios", f"A{idx}", target, al_fallar=refresh_usuarios)
+        plan.update("Usuarios", f"E{idx}", sheet_id or "")
+
+        def _actualizar():
+            with _usuarios_lock:
+                # Una recarga pudo reemplazar la entrada mientras tanto
+                _usuarios["rows"].get(target, entry)["planilla"] = sheet_id
+                _usuarios_escrito()
+
+        plan.after_commit(_actualizar)
+        plan.commit()
+
+    with candados.tomar([("usuario", chat_id)]):
+        _reintentar_desplazada(_escribir)
+
+
+@metricas.medir("sheets.get_unique_categories")
 def get_unique_categories():
     """
     Retorna una lista de categorías únicas encontradas en la hoja 'Comercios' (Columna C),
     más las básicas por defecto.
     """
-    map_tab = os.getenv("GOOGLE_MAP_TAB", "Comercios")
-    ws = _open_ws(map_tab)
+    # Las categorías vienen precalculadas en el índice de Comercios
+    categorias_encontradas = {cat for cat, n in _comercios_index()["cats"].items() if n > 0}
     
-    # Obtenemos toda la columna C (Categorías)
-    # Asumimos que la columna C es la 3ra (índice 2, pero gspread usa 1-based para col_values o get_all_values)
-    # Es más seguro traer todo y procesar en python
-    values = ws.get_all_values()
-    
-    categorias_encontradas = set()
-    
-    # Recorremos desde la fila 1 (saltando encabezado)
-    for row in values[1:]:
-        if len(row) > 2:
-            cat = row[2].strip()
-            if cat:
-                categorias_encontradas.add(cat)
-    
-    # Categorías base que SIEMPRE queremos que estén
-    base = ["Comida", "Supermercado", "Salud", "Transporte", "Hogar", "Ocio"]
-    
-    # Unimos las base con las encontradas
-    todas = set(base).union(categorias_encontradas)
+    # Unimos las base (CATEGORIAS_BASE, siempre presentes) con las encontradas
+    todas = set(CATEGORIAS_BASE).union(categorias_encontradas)
     
     return sorted(list(todas))
 
+# -------------------------
+# POOL (cliente / spreadsheet / worksheets)
+# -------------------------
+# Un solo cliente autorizado por proceso. Cada spreadsheet (la principal y las
+# de cada chat u hogar) y cada una de sus hojas se abren una vez y se
+# reutilizan; si una hoja desaparece o cambia de nombre se invalida su handle
+# y se vuelve a abrir en el siguiente uso.
+_pool = {
+    "client": None,
+    "sa_path": None,
+    "sheets": {},   # sheet_id -> Spreadsheet
+    "ws": {},       # (sheet_id, tab_name) -> Worksheet
+    "generacion": 0,  # sube con cada invalidación: un handle abierto antes no se guarda
+    "stats": {
+        "auth": 0,              # autorizaciones reales
+        "auth_evitadas": 0,     # autorizaciones ahorradas por el pool
+        "open": 0,              # open_by_key reales
+        "open_evitados": 0,
+        "ws": 0,                # sh.worksheet() reales (metadata)
+        "ws_evitados": 0,
+        "invalidaciones": 0,
+        "llamadas": 0,          # veces que se pidió una hoja
+    },
+}
+# services.sheets_async llama a estas funciones desde varios hilos. _pool_lock
+# solo cuida los diccionarios: open_by_key y worksheet() (red, y reintentos de
+# cuota) se hacen fuera, con un lock por handle para que dos hilos que piden el
+# mismo no lo abran dos veces mientras los demás siguen usando el pool.
+_pool_lock = threading.RLock()
+_abriendo: dict = {}    # ("sheets", sheet_id) o ("ws", (sheet_id, tab)) -> Lock
+
+
 def get_client():
-    sa_path = os.getenv("GOOGLE_SA_JSON", "secrets/service_account.json")
-    if not os.path.exists(sa_path):
-        raise FileNotFoundError(f"No existe el JSON de Service Account en: {sa_path}")
+    """Retorna el cliente gspread del proceso, autorizando solo la primera vez."""
+    with _pool_lock:
+        sa_path = os.getenv("GOOGLE_SA_JSON", "secrets/service_account.json")
+        stats = _pool["stats"]
 
-    creds = Credentials.from_service_account_file(sa_path, scopes=SCOPES)
-    return gspread.authorize(creds)
+        if _pool["client"] is not None and _pool["sa_path"] == sa_path:
+            stats["auth_evitadas"] += 1
+            return _pool["client"]
 
+        if not os.path.exists(sa_path):
+            raise FileNotFoundError(f"No existe el JSON de Service Account en: {sa_path}")
 
-def _open_ws(tab_name: str):
-    sheet_id = os.getenv("GOOGLE_SHEET_ID")
-    if not sheet_id:
-        raise RuntimeError("Falta GOOGLE_SHEET_ID en .env")
+        # google-auth refresca el token solo (AuthorizedSession) cuando expira
+        creds = Credentials.from_service_account_file(sa_path, scopes=SCOPES)
+        gc = gspread.authorize(creds)
+
+        reset_pool()
+        _pool["client"] = gc
+        _pool["sa_path"] = sa_path
+        stats["auth"] += 1
+        return gc
 
+
+def _get_sheet_id() -> str:
+    """La planilla en uso (la del chat que se atiende, o la principal)."""
+    return planillas.actual()
+
+
+def _del_pool(cache: str, key, evitados: str):
+    """Handle cacheado o None (con _pool_lock tomado)."""
+    obj = _pool[cache].get(key)
+    if obj is not None:
+        _pool["stats"][evitados] += 1
+    return obj
+
+
+def _abrir(cache: str, key, evitados: str, reales: str, abrir):
+    """
+    Handle de _pool[cache][key]; si no está, lo abre con abrir() fuera de
+    _pool_lock. Un solo hilo abre cada key: los demás esperan y usan el suyo.
+    """
+    with _pool_lock:
+        obj = _del_pool(cache, key, evitados)
+        if obj is not None:
+            return obj
+        lock = _abriendo.setdefault((cache, key), threading.Lock())
+
+    with lock:
+        with _pool_lock:
+            # Otro hilo pudo abrirlo mientras se esperaba
+            obj = _del_pool(cache, key, evitados)
+            if obj is not None:
+                return obj
+            generacion = _pool["generacion"]
+        obj = abrir()
+        with _pool_lock:
+            _pool["stats"][reales] += 1
+            if _pool["generacion"] == generacion:
+                _pool[cache][key] = obj
+        return obj
+
+
+def _open_sheet(sheet_id: str):
     gc = get_client()
-    sh = gc.open_by_key(sheet_id)
-    return sh.worksheet(tab_name)
+    return _abrir("sheets", sheet_id, "open_evitados", "open",
+                  lambda: cuota.llamar("read", gc.open_by_key, sheet_id))
+
+
+def _open_ws(tab_name: str):
+    sheet_id = _get_sheet_id()
+    with _pool_lock:
+        _pool["stats"]["llamadas"] += 1
+
+    def _abrir_ws():
+        sh = _open_sheet(sheet_id)
+        try:
+            return cuota.llamar("read", sh.worksheet, tab_name)
+        except gspread.exceptions.WorksheetNotFound:
+            invalidate_ws(tab_name)
+            raise
+
+    return _abrir("ws", (sheet_id, tab_name), "ws_evitados", "ws", _abrir_ws)
+
+
+def invalidate_ws(tab_name: str | None = None):
+    """Olvida el handle de una hoja (o de todas si tab_name es None)."""
+    with _pool_lock:
+        sheet_id = _get_sheet_id()
+        if tab_name is None:
+            _pool["ws"].clear()
+            _pool["sheets"].clear()
+        else:
+            _pool["ws"].pop((sheet_id, tab_name), None)
+        _pool["stats"]["invalidaciones"] += 1
+        _pool["generacion"] += 1
+
+
+def reset_pool():
+    """Descarta cliente y handles. El siguiente uso vuelve a autorizar."""
+    with _pool_lock:
+        _pool["client"] = None
+        _pool["sa_path"] = None
+        _pool["sheets"].clear()
+        _pool["ws"].clear()
+        _pool["generacion"] += 1
+
+
+def set_client(gc):
+    """Usa `gc` como cliente del proceso en vez de autorizar (p. ej. el falso de bench/)."""
+    with _pool_lock:
+        reset_pool()
+        _pool["client"] = gc
+        _pool["sa_path"] = os.getenv("GOOGLE_SA_JSON", "secrets/service_account.json")
+
+
+def pool_stats() -> dict:
+    """Contadores de round trips hechos y ahorrados por el pool."""
+    stats = dict(_pool["stats"])
+    stats["planillas"] = len(_pool["sheets"])
+    # Sin pool cada hoja pedida costaba authorize + open_by_key + worksheet
+    sin_pool = 3 * stats["llamadas"]
+    stats["ahorrados"] = sin_pool - (stats["auth"] + stats["open"] + stats["ws"])
+    return stats
+
+
+def _olvidar_planilla(sheet_id: str):
+    """Olvida el handle del spreadsheet y los de sus hojas."""
+    with _pool_lock:
+        _pool["sheets"].pop(sheet_id, None)
+        for key in [k for k in _pool["ws"] if k[0] == sheet_id]:
+            del _pool["ws"][key]
+        _pool["stats"]["invalidaciones"] += 1
+        _pool["generacion"] += 1
+
+
+def _llamar_planilla(sheet_id: str, tipo: str, metodo: str, *args, **kwargs):
+    """
+    Ejecuta sh.<metodo>(...) sobre el spreadsheet cacheado (tipo: "read" o
+    "write", para la cuota). Si el token fue revocado (401) se re-autoriza y se
+    reintenta una vez; si el handle ya no sirve (404) se vuelve a abrir y se
+    reintenta. Si una hoja del rango fue borrada o renombrada (400 "Unable to
+    parse range") se olvidan sus handles y se propaga el error: reintentar no
+    lo arregla.
+    """
+    sh = _open_sheet(sheet_id)
+    try:
+        return cuota.llamar(tipo, getattr(sh, metodo), *args, **kwargs)
+    except gspread.exceptions.APIError as e:
+        if e.code == 401:
+            print("Sheets: token revocado (401), re-autorizo")
+            reset_pool()
+        elif e.code == 404:
+            _olvidar_planilla(sheet_id)
+        else:
+            if e.code == 400 and "Unable to parse range" in str(e):
+                _olvidar_planilla(sheet_id)
+            raise
+    metricas.contar("sheets.reintentos_handle")
+    sh = _open_sheet(sheet_id)
+    return cuota.llamar(tipo, getattr(sh, metodo), *args, **kwargs)
+
+
+# -------------------------
+# LECTURAS POR RANGO
+# -------------------------
+# Solo pedimos las columnas que usa cada hoja, y desde la fila que haga falta.
+COLS_USUARIOS = "A:E"     # chat_id, nombre, estado, fecha, planilla
+COLS_COMERCIOS = "A:C"    # comercio_raw, alias, categoria
+COLS_PENDIENTES = "A:G"   # email_id .. estado
+COLS_GASTOS = "A:H"       # fecha .. usuario (lo que usan los resúmenes)
+COLS_GASTOS_ID = "J:J"    # email_id
+
+
+def _rango(tab_name: str, columnas: str, desde: int, hasta: int | None = None) -> str:
+    """("Comercios", "A:C", 2) -> "'Comercios'!A2:C"; con hasta=5 -> "'Comercios'!A2:C5"."""
+    col_ini, col_fin = columnas.split(":")
+    return absolute_range_name(tab_name, f"{col_ini}{desde}:{col_fin}{hasta or ''}")
+
+
+def leer_rangos(pedidos: list) -> list[list]:
+    """
+    Lee varios rangos (de una o más hojas) en una sola request values_batch_get.
+    Cada pedido es (tab, columnas, fila_desde[, fila_hasta]); retorna las filas
+    de cada uno, en el mismo orden y sin rellenar (las celdas vacías del final
+    no vienen).
+    """
+    rangos = [_rango(*pedido) for pedido in pedidos]
+    with metricas.medir_bloque("sheets.api.values_batch_get"):
+        resp = _llamar_planilla(_get_sheet_id(), "read", "values_batch_get", rangos)
+
+    resultados = [vr.get("values", []) for vr in resp.get("valueRanges", [])]
+    metricas.filas_leidas("sheets.api.values_batch_get", sum(len(v) for v in resultados))
+    return resultados
+
+
+# -------------------------
+# ESCRITURAS EN LOTE
+# -------------------------
+# Un WritePlan junta las escrituras de un flujo (celdas y filas nuevas, en
+# cualquier hoja) y las manda en el mínimo de requests: todas las celdas en un
+# solo values_batch_update y un values_append por hoja con filas nuevas.
+_plan_stats = {}  # flujo -> {"planes", "requests", "escrituras"}
+_escrituras_propias = Counter()  # sheet_id -> commits de este proceso (para la revalidación)
+_plan_stats_lock = threading.Lock()
+
+
+class FilaDesplazada(Exception):
+    """Una fila que el plan iba a actualizar ya no tiene la clave esperada."""
+
+
+def _reintentar_desplazada(fn):
+    """Corre fn(); si una fila se había movido, la repite (el índice ya se recargó)."""
+    try:
+        return fn()
+    except FilaDesplazada as e:
+        print(f"Sheets: {e}; reintento con el índice recargado")
+        return fn()
+
+
+class WritePlan:
+    def __init__(self, flujo: str = "otro", sheet_id: str | None = None):
+        self.flujo = flujo
+        # Un plan escribe en una sola planilla: la actual al crearlo
+        self.sheet_id = sheet_id or _get_sheet_id()
+        self.verificaciones = []  # (tab, a1, esperado, al_fallar)
+        self.updates = []   # (tab, a1, valor)
+        self.appends = {}   # tab -> [(fila, on_row)]
+        self.on_commit = []
+        self.requests = 0
+
+    def update(self, tab_name: str, a1: str, valor):
+        self.updates.append((tab_name, a1, valor))
+
+    def append(self, tab_name: str, fila: list, on_row=None):
+        """Agrega una fila; on_row(n) recibe el número de fila real tras el commit."""
+        self.appends.setdefault(tab_name, []).append((fila, on_row))
+
+    def after_commit(self, fn):
+        self.on_commit.append(fn)
+
+    def verificar(self, tab_name: str, a1: str, esperado: str, al_fallar=None):
+        """
+        Antes de escribir, comprueba que la celda `a1` siga conteniendo
+        `esperado` (sin distinguir mayúsculas ni espacios). Si no, corre
+        al_fallar() (p. ej. recargar el índice) y commit lanza FilaDesplazada.
+        """
+        self.verificaciones.append((tab_name, a1, esperado, al_fallar))
+
+    def _verificar(self):
+        # Todas las celdas clave en una sola lectura
+        resp = _llamar_planilla(
+            self.sheet_id, "read", "values_batch_get",
+            [absolute_range_name(tab, a1) for tab, a1, _, _ in self.verificaciones],
+        )
+        self.requests += 1
+        rangos = resp.get("valueRanges", [])
+        malas = []
+        for i, (tab, a1, esperado, al_fallar) in enumerate(self.verificaciones):
+            values = rangos[i].get("values", []) if i < len(rangos) else []
+            actual = values[0][0] if values and values[0] else ""
+            if str(actual).strip().upper() != str(esperado).strip().upper():
+                malas.append((tab, a1, al_fallar))
+        if not malas:
+            return
+
+        metricas.contar("sheets.filas_desplazadas", len(malas))
+        for fn in {id(f): f for _, _, f in malas if f}.values():
+            fn()
+        tab, a1, _ = malas[0]
+        raise FilaDesplazada(f"{tab}!{a1} ya no es la fila esperada ({len(malas)} celda(s))")
+
+    def escrituras(self) -> int:
+        return len(self.updates) + sum(len(f) for f in self.appends.values())
+
+    @metricas.medir("sheets.WritePlan.commit")
+    def commit(self):
+        escrituras = self.escrituras()
+        if not escrituras:
+            return
+        # Los callbacks (on_row, after_commit, al_fallar) actualizan los
+        # índices de la planilla del plan, aunque se commitee desde otra
+        with planillas.usar(self.sheet_id):
+            self._commit(escrituras)
+
+    def _commit(self, escrituras: int):
+        if self.verificaciones:
+            self._verificar()
+
+        for tab_name, filas in self.appends.items():
+            try:
+                resp = _llamar_planilla(
+                    self.sheet_id, "append", "values_append",
+                    absolute_range_name(tab_name, "A1"),
+                    params={"valueInputOption": "USER_ENTERED"},
+                    body={"values": [fila for fila, _ in filas]},
+                )
+            except gspread.exceptions.APIError as e:
+                if 500 <= e.code < 600:
+                    _append_incierto(tab_name)
+                raise
+            self.requests += 1
+            primera = _fila_de_append(resp, None)
+            for i, (_, on_row) in enumerate(filas):
+                if on_row:
+                    on_row(primera + i if primera else None)
+
+        # Las celdas van después de las filas nuevas: si algo falla entremedio,
+        # el OK de Pendientes no queda marcado sin su fila en Gastos, y el
+        # reintento ve la fila y no la repite
+        if self.updates:
+            _llamar_planilla(self.sheet_id, "write", "values_batch_update", {
+                "valueInputOption": "USER_ENTERED",
+                "data": [
+                    {"range": absolute_range_name(tab, a1), "values": [[valor]]}
+                    for tab, a1, valor in self.updates
+                ],
+            })
+            self.requests += 1
+
+        for fn in self.on_commit:
+            fn()
+
+        with _plan_stats_lock:
+            _escrituras_propias[self.sheet_id] += 1
+            st = _plan_stats.setdefault(self.flujo, {"planes": 0, "requests": 0, "escrituras": 0})
+            st["planes"] += 1
+            st["requests"] += self.requests
+            st["escrituras"] += escrituras
+
+        self.verificaciones.clear()
+        self.updates.clear()
+        self.appends.clear()
+        self.on_commit.clear()
+
+
+def _append_incierto(tab_name: str):
+    """
+    Un append falló con 5xx (cuota.llamar no lo repite): las filas pudieron
+    quedar escritas. El índice de la hoja se relee en su siguiente uso, así
+    quien reintente (el journal) salta lo que sí quedó.
+    """
+    metricas.contar("sheets.appends_inciertos")
+    if tab_name == os.getenv("GOOGLE_SHEET_TAB", "Gastos"):
+        with _gastos_lock:
+            _gastos["ts"] = 0
+    elif tab_name == os.getenv("GOOGLE_MAP_TAB", "Comercios"):
+        with _comercios_lock:
+            _comercios["ts"] = 0
+
+
+def write_stats() -> dict:
+    """Requests de escritura usados por cada flujo (y cuántas escrituras agruparon)."""
+    with _plan_stats_lock:
+        return {flujo: dict(st) for flujo, st in _plan_stats.items()}
+
+
+def _fila_de_append(resp, default: int | None) -> int | None:
+    """Número de la primera fila escrita por un append (sale de updates.updatedRange)."""
+    try:
+        rango = resp["updates"]["updatedRange"]
+        m = re.search(r"![A-Z]+(\d+)", rango)
+        return int(m.group(1))
+    except (KeyError, TypeError, AttributeError):
+        return default
 
 
 # -------------------------
 # MAPPINGS (Comercios)
 # -------------------------
-def get_mapping(comercio_raw: str):
-    """Retorna (alias, categoria) o (None, None) desde hoja 'Comercios'."""
+# Índice residente de la hoja Comercios: RAW normalizado -> fila/alias/categoria.
+# Nuestras escrituras lo actualizan en el lugar; se re-sincroniza completo
+# cada COMERCIOS_TTL segundos (cambios hechos a mano en la hoja) o con
+# refresh_comercios(). Uno por planilla.
+_comercios = planillas.PorPlanilla(lambda: {
+    "rows": {},         # RAW -> {"row": int, "alias": str | None, "categoria": str | None}
+    "cats": Counter(),  # categoria -> nº de filas que la usan
+    "next_row": 2,
+    "ts": 0,
+    "cats_version": next(_cats_versiones),  # cambia con el conjunto de categorías
+})
+_comercios_lock = planillas.LockPorPlanilla()
+# Las versiones de categorías salen de un solo contador: dos planillas nunca
+# reportan la misma versión (el teclado de bot.main se cachea por versión)
+_cats_versiones = itertools.count(1)
+
+
+def _nueva_version_cats():
+    _comercios["cats_version"] = next(_cats_versiones)
+
+
+@metricas.medir("sheets.refresh_comercios")
+def refresh_comercios():
+    """Recarga completa del índice de Comercios desde la hoja."""
     map_tab = os.getenv("GOOGLE_MAP_TAB", "Comercios")
-    ws = _open_ws(map_tab)
+    with _comercios_lock:
+        values = leer_rangos([(map_tab, COLS_COMERCIOS, 2)])[0]
+        return _indexar_comercios(values, 2)
 
-    values = ws.get_all_values()
-    target = comercio_raw.strip().upper()
 
-    for row in values[1:]:
-        if not row:
-            continue
-        raw = (row[0] if len(row) > 0 else "").strip().upper()
-        if raw == target:
-            alias = (row[1] if len(row) > 1 else "").strip() or None
+def _indexar_comercios(values: list, desde: int):
+    with _comercios_lock:
+        rows = {}
+        cats = Counter()
+        for idx, row in enumerate(values, start=desde):
+            raw = norm_comercio(row[0] if len(row) > 0 else "")
             categoria = (row[2] if len(row) > 2 else "").strip() or None
-            return alias, categoria
+            if categoria:
+                cats[categoria] += 1
+            # Igual que el scan lineal: gana la primera fila de cada comercio
+            if not raw or raw in rows:
+                continue
+            rows[raw] = {
+                "row": idx,
+                "alias": (row[1] if len(row) > 1 else "").strip() or None,
+                "categoria": categoria,
+            }
+
+        # +Counter descarta las categorías que quedaron en 0
+        if set(+cats) != set(+_comercios["cats"]):
+            _nueva_version_cats()
+        _comercios["rows"] = rows
+        _comercios["cats"] = cats
+        _comercios["next_row"] = desde + len(values)
+        _comercios["ts"] = time.time()
+        return _comercios.de()
+
+
+def _comercios_index(force: bool = False):
+    ttl = float(os.getenv("COMERCIOS_TTL", "300"))
+    with _comercios_lock:
+        if force or time.time() - _comercios["ts"] > ttl:
+            return refresh_comercios()
+        return _comercios.de()
+
+
+@metricas.medir("sheets.get_mapping")
+def get_mapping(comercio_raw: str):
+    """Retorna (alias, categoria) o (None, None) desde hoja 'Comercios'."""
+    entry = _comercios_index()["rows"].get(norm_comercio(comercio_raw))
+    if not entry:
+        return None, None
+    return entry["alias"], entry["categoria"]
+
+
+@metricas.medir("sheets.upsert_mapping")
+def upsert_mapping(comercio_raw: str, alias: str, categoria: str | None = None, plan: "WritePlan | None" = None):
+    """
+    Inserta o actualiza alias/categoria en 'Comercios'. Con `plan` solo agrega
+    las escrituras (quien lo commitea debe tener ("comercio", RAW) tomada).
+    """
+    if plan is not None:
+        return _plan_mapping(plan, comercio_raw, alias, categoria)
+
+    def _escribir():
+        plan = WritePlan("upsert_mapping")
+        _plan_mapping(plan, comercio_raw, alias, categoria)
+        plan.commit()
 
-    return None, None
+    with candados.tomar([("comercio", norm_comercio(comercio_raw))]):
+        _reintentar_desplazada(_escribir)
 
 
-def upsert_mapping(comercio_raw: str, alias: str, categoria: str | None = None):
-    """Inserta o actualiza alias/categoria en 'Comercios'."""
+def _plan_mapping(plan: "WritePlan", comercio_raw: str, alias: str, categoria: str | None):
     map_tab = os.getenv("GOOGLE_MAP_TAB", "Comercios")
-    ws = _open_ws(map_tab)
+    target = norm_comercio(comercio_raw)
 
-    values = ws.get_all_values()
-    target = comercio_raw.strip().upper()
+    with _comercios_lock:
+        index = _comercios_index()
+        entry = index["rows"].get(target)
 
-    for idx, row in enumerate(values[1:], start=2):
-        raw = (row[0] if len(row) > 0 else "").strip().upper()
-        if raw == target:
-            ws.update_acell(f"B{idx}", alias)
+        if entry:
+            idx = entry["row"]
+            plan.verificar(map_tab, f"A{idx}", target, al_fallar=refresh_comercios)
+            plan.update(map_tab, f"B{idx}", alias)
             if categoria is not None:
-                ws.update_acell(f"C{idx}", categoria)
-            return
+                plan.update(map_tab, f"C{idx}", categoria)
+
+            def _actualizar():
+                with _comercios_lock:
+                    entry["alias"] = (alias or "").strip() or None
+                    if categoria is not None:
+                        _set_categoria(entry, categoria)
+
+            plan.after_commit(_actualizar)
+        else:
+            def _agregar(idx):
+                with _comercios_lock:
+                    idx = idx or index["next_row"]
+                    nuevo = {"row": idx, "alias": (alias or "").strip() or None, "categoria": None}
+                    _set_categoria(nuevo, categoria or "")
+                    index["rows"][target] = nuevo
+                    index["next_row"] = max(index["next_row"], idx + 1)
+
+            plan.append(map_tab, [comercio_raw, alias, categoria or ""], on_row=_agregar)
+
+
+def _set_categoria(entry: dict, categoria: str):
+    cats = _comercios["cats"]
+    anterior = entry["categoria"]
+    if anterior:
+        cats[anterior] -= 1
+        if cats[anterior] == 0:
+            _nueva_version_cats()
+    nueva = categoria.strip() or None
+    if nueva:
+        if cats[nueva] == 0:
+            _nueva_version_cats()
+        cats[nueva] += 1
+    entry["categoria"] = nueva
+
 
-    ws.append_row([comercio_raw, alias, categoria or ""], value_input_option="USER_ENTERED")
+def categorias_version() -> int:
+    """Cambia cada vez que aparece o desaparece una categoría (sin I/O)."""
+    return _comercios["cats_version"]
 
 
 # -------------------------
 # GASTOS
 # -------------------------
+# email_id que ya están en Gastos: un mismo correo no se registra dos veces
+# (doble toque, callback reintentado, /clasificar después de los botones o un
+# reenvío del journal). Se carga una vez (solo la columna J) y append_gasto
+# lo mantiene al día. Uno por planilla.
+_gastos = planillas.PorPlanilla(lambda: {
+    "ids": set(),
+    "last_row": 1,     # última fila leída de la columna J
+    "ultima": None,    # email_id en last_row (para el sondeo de cola)
+    "ts": 0,
+})
+_gastos_lock = planillas.LockPorPlanilla()
+
+
+def _indexar_gastos(values: list, desde: int):
+    with _gastos_lock:
+        for row in values:
+            email_id = str(row[0]).strip() if row else ""
+            if email_id:
+                _gastos["ids"].add(email_id)
+        if values:
+            _gastos["last_row"] = desde + len(values) - 1
+            _gastos["ultima"] = str(values[-1][0]).strip() if values[-1] else None
+        _gastos["ts"] = time.time()
+        return _gastos.de()
+
+
+@metricas.medir("sheets.refresh_gastos")
+def refresh_gastos(full: bool = False):
+    """Lee los email_id de Gastos agregados después de la última fila vista."""
+    gastos_tab = os.getenv("GOOGLE_SHEET_TAB", "Gastos")
+    with _gastos_lock:
+        if full:
+            _gastos.update(ids=set(), last_row=1, ultima=None)
+        desde = _gastos["last_row"] + 1
+        values = leer_rangos([(gastos_tab, COLS_GASTOS_ID, desde)])[0]
+        return _indexar_gastos(values, desde)
+
+
+def _gastos_index():
+    with _gastos_lock:
+        if not _gastos["ts"]:
+            return refresh_gastos()
+        return _gastos.de()
+
+
+@metricas.medir("sheets.gasto_registrado")
+def gasto_registrado(email_id: str) -> bool:
+    """True si ese email_id ya tiene su fila en Gastos (en memoria) o en un mes archivado."""
+    email_id = str(email_id).strip()
+    return email_id in _gastos_index()["ids"] or archivo.ubicar(email_id) is not None
+
+
+def _gasto_escrito(idx: int | None, fila: list):
+    agregados.agregar(idx, fila)
+    email_id = str(fila[9]).strip()
+    with _gastos_lock:
+        _gastos["ids"].add(email_id)
+        if idx is not None and idx == _gastos["last_row"] + 1:
+            _gastos["last_row"] = idx
+            _gastos["ultima"] = email_id
+
+
+@metricas.medir("sheets.append_gasto")
 def append_gasto(
     fecha: str,
     hora: str,
@@ -144,46 +893,760 @@ def append_gasto(
     usuario: str,
     chat_id: str,
     email_id: str,
+    plan: "WritePlan | None" = None,
 ):
     """Inserta fila en hoja 'Gastos'."""
     gastos_tab = os.getenv("GOOGLE_SHEET_TAB", "Gastos")
-    ws = _open_ws(gastos_tab)
+    propio = plan is None
+    plan = plan or WritePlan("append_gasto")
+
+    fila = [fecha, hora, descripcion, monto, categoria, comercio_raw, comercio_alias, usuario, str(chat_id), email_id]
+    # Los totales de /resumen y el índice de email_id se actualizan con la fila ya escrita
+    plan.append(gastos_tab, fila, on_row=lambda idx: _gasto_escrito(idx, fila))
+
+    if propio:
+        plan.commit()
+
+
+@metricas.medir("sheets.resumen_mes")
+def resumen_mes(mes: str) -> dict:
+    """
+    Totales de un mes ("YYYY-MM") por categoría, alias y usuario. Sale del
+    acumulador en memoria; de la hoja solo se leen las filas de Gastos
+    agregadas por otros desde la última pasada (como mucho cada AGREGADOS_TTL).
+    De un mes archivado se suman sus totales del índice de services.archivo.
+    """
+    if agregados.vencido(float(os.getenv("AGREGADOS_TTL", "60"))):
+        gastos_tab = os.getenv("GOOGLE_SHEET_TAB", "Gastos")
+        desde = agregados.cursor() + 1
+        values = leer_rangos([(gastos_tab, COLS_GASTOS, desde)])[0]
+        agregados.consumir(values, desde)
+    resumen = agregados.mes(mes)
+    archivado = archivo.resumen(_get_sheet_id(), mes)
+    if archivado is not None:
+        agregados.combinar(resumen, archivado)
+    return resumen
 
-    ws.append_row(
-        [fecha, hora, descripcion, monto, categoria, comercio_raw, comercio_alias, usuario, str(chat_id), email_id],
-        value_input_option="USER_ENTERED",
-    )
+
+@metricas.medir("sheets.registrar_gasto")
+def registrar_gasto(row_index: int, flujo: str = "registrar_gasto", **gasto):
+    """
+    Cierra una clasificación completa en un solo lote: fila en Gastos,
+    alias/categoría en Comercios y estado OK en Pendientes.
+    """
+    return registrar_gastos([dict(gasto, row_index=row_index)], flujo=flujo)
+
+
+@metricas.medir("sheets.registrar_gastos")
+def registrar_gastos(gastos: list[dict], flujo: str = "registrar_gastos"):
+    """
+    Como registrar_gasto pero para varios gastos en un mismo WritePlan. Cada
+    dict trae row_index (fila en Pendientes) más los argumentos de append_gasto.
+    Cada gasto va a la planilla de su chat (o a la que diga su clave "planilla",
+    p. ej. los de la ingesta): un WritePlan por planilla.
+    Retorna cuántas requests usó.
+    """
+    grupos = {}
+    for gasto in gastos:
+        gasto = dict(gasto)
+        grupos.setdefault(_planilla_del_gasto(gasto), []).append(gasto)
+
+    requests = 0
+    for sheet_id, grupo in grupos.items():
+        with planillas.usar(sheet_id):
+            requests += _registrar_en_planilla(grupo, flujo)
+    return requests
+
+
+@metricas.medir("sheets.importar_gastos")
+def importar_gastos(gastos: list[dict], flujo: str = "importar_gastos") -> int:
+    """
+    Agrega a Gastos filas que no vienen de Pendientes (una cartola, ver
+    services.cartola) en un solo append, en la planilla actual. No toca
+    Comercios ni Pendientes; se saltan los email_id que ya están en Gastos.
+    Retorna cuántas filas escribió.
+    """
+    plan = WritePlan(flujo)
+    escritos = set()
+    for gasto in gastos:
+        email_id = str(gasto["email_id"]).strip()
+        if email_id in escritos or gasto_registrado(email_id):
+            metricas.contar("gastos.duplicados_evitados")
+            continue
+        append_gasto(plan=plan, **gasto)
+        escritos.add(email_id)
+    plan.commit()
+    return len(escritos)
+
+
+def _planilla_del_gasto(gasto: dict) -> str:
+    if "planilla" in gasto:
+        return gasto.pop("planilla") or planillas.principal()
+    chat_id = str(gasto.get("chat_id") or "").strip()
+    if chat_id in _usuarios["rows"]:
+        return planilla_de(chat_id) or planillas.principal()
+    return _get_sheet_id()
+
+
+def _registrar_en_planilla(gastos: list[dict], flujo: str):
+    mappings = {}
+    for gasto in gastos:
+        # Un comercio repetido en el lote se escribe una sola vez (gana el último)
+        raw = gasto["comercio_raw"]
+        mappings[norm_comercio(raw)] = (raw, gasto["comercio_alias"], gasto["categoria"])
+
+    def _escribir():
+        plan = WritePlan(flujo)
+        escritos = set()
+        for gasto in gastos:
+            gasto = dict(gasto)
+            gasto.pop("row_index")
+            email_id = str(gasto["email_id"]).strip()
+            if email_id in escritos or gasto_registrado(email_id):
+                # Ya está en Gastos: solo se asegura el OK en Pendientes
+                metricas.contar("gastos.duplicados_evitados")
+            else:
+                append_gasto(plan=plan, **gasto)
+                escritos.add(email_id)
+            # La fila sale del índice y no del row_index recibido: el journal
+            # pudo anotarlo antes de que el archivo de meses corriera las filas
+            row_index, _ = get_pendiente(email_id)
+            if row_index is not None:
+                mark_pendiente_ok(row_index, plan=plan)
+
+        for raw, alias, categoria in mappings.values():
+            # Comercio ya conocido con los mismos datos: no hay nada que escribir
+            if get_mapping(raw) == ((alias or "").strip() or None, (categoria or "").strip() or None):
+                continue
+            upsert_mapping(raw, alias, categoria, plan=plan)
+
+        plan.commit()
+        return plan.requests
+
+    # Desde get_pendiente hasta el commit, el archivo de meses no corre filas
+    with candados.tomar(("comercio", k) for k in mappings), _filas_pendientes_lock:
+        return _reintentar_desplazada(_escribir)
 
 
 # -------------------------
 # PENDIENTES
 # -------------------------
+# Índice email_id -> (fila, registro) de la hoja Pendientes. Se carga una vez
+# y después solo se leen las filas agregadas después de la última vista.
+_pendientes = planillas.PorPlanilla(lambda: {
+    "rows": {},       # email_id -> (row_index, data_dict)
+    "by_row": {},     # row_index -> email_id
+    "last_row": 1,    # última fila leída (1 = encabezado)
+})
+_pendientes_lock = planillas.LockPorPlanilla()
+# Las filas de Pendientes solo se corren al archivar (archivar_meses las
+# borra). Quien escribe por número de fila (mark_pendiente_ok) tiene este lock
+# desde que resuelve la fila hasta commitear; las lecturas no lo toman. Va
+# siempre antes que los locks de los índices (orden completo junto a _usuarios_lock).
+_filas_pendientes_lock = planillas.LockPorPlanilla()
+
+PENDIENTES_COLS = 7  # A..G
+
+
+def _parse_pendiente(row: list) -> dict:
+    return {
+        "email_id": row[0],
+        "fecha_email": row[1],
+        "hora_email": row[2],
+        "monto": int(str(row[3]).replace(".", "").replace(",", "")),
+        "comercio_raw": row[4],
+        "desc": row[5] or "Compra Tarjeta Crédito",
+        "estado": row[6] or "",
+    }
+
+
+@metricas.medir("sheets.leer_pendientes_desde")
+def leer_pendientes_desde(desde: int):
+    """
+    Lee las filas de Pendientes desde la fila `desde` hasta el final.
+    Retorna ([(row_index, data_dict), ...], última_fila_leída).
+    """
+    values = leer_rangos([("Pendientes", COLS_PENDIENTES, desde)])[0]
+    return _parsear_pendientes(values, desde)
+
+
+def _parsear_pendientes(values: list, desde: int):
+    registros = []
+    for idx, row in enumerate(values, start=desde):
+        row = list(row) + [""] * (PENDIENTES_COLS - len(row))
+        if not str(row[0]).strip():
+            continue
+        try:
+            registros.append((idx, _parse_pendiente(row)))
+        except ValueError:
+            print(f"Pendientes fila {idx}: monto inválido {row[3]!r}, se ignora")
+    return registros, desde + len(values) - 1
+
+
+@metricas.medir("sheets.refresh_pendientes")
+def refresh_pendientes(full: bool = False):
+    """
+    Trae a memoria las filas nuevas de Pendientes (solo la cola desde la última
+    fila vista). Con full=True descarta el índice y recarga toda la hoja.
+    """
+    with _pendientes_lock:
+        if full:
+            _pendientes["rows"].clear()
+            _pendientes["by_row"].clear()
+            _pendientes["last_row"] = 1
+
+        registros, ultima = leer_pendientes_desde(_pendientes["last_row"] + 1)
+        _indexar_pendientes(registros, ultima)
+
+
+def _indexar_pendientes(registros: list, ultima: int):
+    with _pendientes_lock:
+        for idx, data in registros:
+            email_id = str(data["email_id"]).strip()
+            # Igual que el scan lineal: gana la primera fila de cada email_id
+            if email_id in _pendientes["rows"]:
+                continue
+            _pendientes["rows"][email_id] = (idx, data)
+            _pendientes["by_row"][idx] = email_id
+        _pendientes["last_row"] = ultima
+
+
+@metricas.medir("sheets.get_pendiente")
 def get_pendiente(email_id: str):
     """
     Busca en hoja 'Pendientes' por email_id y retorna:
-    (row_index, data_dict) o (None, None)
+    (row_index, data_dict), (None, data_dict) si ya se archivó, o (None, None)
+    """
+    target = str(email_id).strip()
+
+    with _pendientes_lock:
+        hit = _pendientes["rows"].get(target)
+        if hit is None:
+            # Puede ser una fila recién agregada: leemos solo la cola
+            refresh_pendientes()
+            hit = _pendientes["rows"].get(target)
+
+    if hit is None:
+        # Un pendiente ya archivado se encuentra, pero sin fila en la hoja
+        return None, archivo.pendiente(target)
+    idx, data = hit
+    return idx, dict(data)
+
+
+@metricas.medir("sheets.pendientes_nuevos")
+def pendientes_nuevos(desde_fila: int):
+    """
+    Pendientes en filas posteriores a `desde_fila`, en orden. Trae la cola
+    nueva de la hoja y retorna ([(row_index, data_dict), ...], última_fila).
+    """
+    with _pendientes_lock:
+        refresh_pendientes()
+        nuevos = []
+        # by_row está en orden de fila: recorremos desde el final hasta el cursor
+        for idx in reversed(_pendientes["by_row"]):
+            if idx <= desde_fila:
+                break
+            nuevos.append((idx, dict(_pendientes["rows"][_pendientes["by_row"][idx]][1])))
+        nuevos.reverse()
+        return nuevos, _pendientes["last_row"]
+
+
+@metricas.medir("sheets.mark_pendiente_ok")
+def mark_pendiente_ok(row_index: int, plan: "WritePlan | None" = None):
+    """
+    Marca estado = OK en hoja Pendientes (columna G). Con `plan`, quien lo
+    commitea debe tener _filas_pendientes_lock desde que obtuvo row_index.
+    """
+    propio = plan is None
+    plan = plan or WritePlan("mark_pendiente_ok")
+    plan.update("Pendientes", f"G{row_index}", "OK")
+
+    def _actualizar():
+        with _pendientes_lock:
+            email_id = _pendientes["by_row"].get(row_index)
+            if email_id:
+                _pendientes["rows"][email_id][1]["estado"] = "OK"
+
+    plan.after_commit(_actualizar)
+
+    if propio:
+        with _filas_pendientes_lock:
+            plan.commit()
+
+
+# -------------------------
+# ARCHIVO (meses cerrados)
+# -------------------------
+# Las filas de Gastos de meses cerrados pasan a una hoja por mes y las de
+# Pendientes en OK se borran; services.archivo guarda dónde quedó cada
+# email_id. Los borrados van en un solo batch_update (deleteDimension por
+# tramo de filas seguidas, de abajo hacia arriba): lo que se agregue
+# mientras tanto cae al final y no se toca.
+def _hoja_archivo(mes: str) -> str:
+    return f"{os.getenv('GOOGLE_SHEET_TAB', 'Gastos')} {mes}"
+
+
+def _crear_hoja(tab_name: str, filas: int) -> bool:
+    """Crea la hoja si no existe. True si la creó."""
+    try:
+        _open_ws(tab_name)
+        return False
+    except gspread.exceptions.WorksheetNotFound:
+        pass
+    ws = _llamar_planilla(_get_sheet_id(), "write", "add_worksheet", title=tab_name, rows=max(filas + 1, 100), cols=10)
+    with _pool_lock:
+        _pool["ws"][(_get_sheet_id(), tab_name)] = ws
+    return True
+
+
+def _tramos(filas: list[int]) -> list[tuple[int, int]]:
+    """[2, 3, 4, 9] -> [(9, 9), (2, 4)]: tramos seguidos, el de más abajo primero."""
+    tramos = []
+    for fila in sorted(set(filas)):
+        if tramos and fila == tramos[-1][1] + 1:
+            tramos[-1] = (tramos[-1][0], fila)
+        else:
+            tramos.append((fila, fila))
+    return tramos[::-1]
+
+
+def _normalizar_fila(row: list) -> list[str]:
+    fila = [str(c).strip() for c in row]
+    while fila and not fila[-1]:
+        fila.pop()
+    return fila
+
+
+def _borrar_filas(por_hoja: dict):
     """
-    ws = _open_ws("Pendientes")
-    values = ws.get_all_values()
+    Borra filas de varias hojas en una sola request. por_hoja:
+    (hoja, columnas) -> {fila: valores leídos}. Justo antes relee la primera y
+    la última fila de cada tramo (una sola lectura) y, si alguna ya no es la
+    que se leyó, lanza FilaDesplazada sin borrar nada.
+    """
+    requests = []
+    chequeos = []   # ((hoja, columnas, fila, fila), valores esperados)
+    for (tab_name, columnas), filas in por_hoja.items():
+        if not filas:
+            continue
+        sheet_id = _open_ws(tab_name).id
+        for ini, fin in _tramos(list(filas)):
+            requests.append({"deleteDimension": {"range": {
+                "sheetId": sheet_id, "dimension": "ROWS", "startIndex": ini - 1, "endIndex": fin,
+            }}})
+            chequeos += [((tab_name, columnas, fila, fila), filas[fila]) for fila in sorted({ini, fin})]
+    if not requests:
+        return
+
+    leidas = leer_rangos([pedido for pedido, _ in chequeos])
+    for (pedido, esperado), values in zip(chequeos, leidas):
+        if _normalizar_fila(values[0] if values else []) != _normalizar_fila(esperado):
+            metricas.contar("sheets.filas_desplazadas")
+            raise FilaDesplazada(f"{_rango(*pedido)} cambió desde la lectura del archivo; no se borra nada")
+
+    _llamar_planilla(_get_sheet_id(), "write", "batch_update", {"requests": requests})
+    with _plan_stats_lock:
+        _escrituras_propias[_get_sheet_id()] += 1
+
 
-    for idx, row in enumerate(values[1:], start=2):
-        if len(row) < 7:
+@metricas.medir("sheets.archivar_meses")
+def archivar_meses(corte: str) -> dict:
+    """
+    Archiva los meses anteriores a `corte` ("YYYY-MM") de la planilla actual.
+    Retorna {"gastos": n, "pendientes": n, "filas_pendientes": [filas borradas]}.
+    Solo se archivan fechas AAAA-MM-DD; si una fila a borrar cambió desde la
+    lectura, lanza FilaDesplazada sin borrar nada (repetirlo es seguro).
+    """
+    gastos_tab = os.getenv("GOOGLE_SHEET_TAB", "Gastos")
+    sheet_id = _get_sheet_id()
+    gastos, pendientes = leer_rangos([(gastos_tab, "A:J", 1), ("Pendientes", COLS_PENDIENTES, 2)])
+    cabecera = gastos[0] if gastos else []
+
+    por_mes = {}   # mes -> [(fila, valores)]
+    for fila, row in enumerate(gastos[1:], start=2):
+        # Una fecha en otro formato (p. ej. "01/05/2024" escrita a mano) se queda
+        mes = agregados.mes_de(row[0]) if row else None
+        if mes is not None and mes < corte:
+            por_mes.setdefault(mes, []).append((fila, row))
+
+    borrar_pend = {}   # fila -> valores leídos
+    datos_pend = []
+    for fila, row in enumerate(pendientes, start=2):
+        completa = list(row) + [""] * (PENDIENTES_COLS - len(row))
+        mes = agregados.mes_de(completa[1])
+        if not str(completa[0]).strip() or str(completa[6]).strip().upper() != "OK" or mes is None or mes >= corte:
             continue
-        if str(row[0]).strip() == str(email_id).strip():
-            return idx, {
-                "email_id": row[0],
-                "fecha_email": row[1],
-                "hora_email": row[2],
-                "monto": int(str(row[3]).replace(".", "").replace(",", "")),
-                "comercio_raw": row[4],
-                "desc": row[5] or "Compra Tarjeta Crédito",
-                "estado": row[6] or "",
-            }
+        try:
+            datos_pend.append(_parse_pendiente(completa))
+        except ValueError:
+            continue
+        borrar_pend[fila] = row
+
+    if not por_mes and not borrar_pend:
+        return {"gastos": 0, "pendientes": 0, "filas_pendientes": []}
+
+    # 1. Copia a las hojas de archivo. Lo que ya está en el índice (una
+    #    corrida anterior que no alcanzó a borrar) no se vuelve a copiar.
+    plan = WritePlan("archivo")
+    nuevos = {}
+    for mes, filas in sorted(por_mes.items()):
+        hoja = _hoja_archivo(mes)
+        copiar = [
+            row for _, row in filas
+            if len(row) <= 9 or not str(row[9]).strip() or archivo.ubicar(row[9]) is None
+        ]
+        if not copiar:
+            continue
+        if _crear_hoja(hoja, len(copiar)) and cabecera:
+            plan.append(hoja, cabecera)
+        for row in copiar:
+            plan.append(hoja, row)
+        nuevos[mes] = (hoja, copiar)
+    plan.commit()
+
+    # 2. Índice local, antes de borrar: si algo falla después, nada se pierde
+    archivo.anotar(sheet_id, nuevos, datos_pend)
+
+    # 3. Fuera de las hojas vivas, y los índices por fila se recargan. Solo
+    #    aquí se toman los índices: mientras se borra nadie usa números de
+    #    fila. La lectura y la copia van sin ellos (los gastos nuevos caen al
+    #    final); si una fila se movió entremedio, _borrar_filas no borra nada.
+    borrar_gastos = {fila: row for filas in por_mes.values() for fila, row in filas}
+    with _filas_pendientes_lock, _pendientes_lock, _gastos_lock:
+        _borrar_filas({(gastos_tab, "A:J"): borrar_gastos, ("Pendientes", COLS_PENDIENTES): borrar_pend})
+        borrar_gastos, borrar_pend = sorted(borrar_gastos), sorted(borrar_pend)
+        agregados.desplazar(borrar_gastos)
+        # Desde ahora esos meses se cuentan como archivo + lo que llegue tarde a la hoja viva
+        agregados.olvidar(por_mes)
+        refresh_gastos(full=True)
+        refresh_pendientes(full=True)
+
+    metricas.contar("archivo.gastos", len(borrar_gastos))
+    metricas.contar("archivo.pendientes", len(borrar_pend))
+    return {"gastos": len(borrar_gastos), "pendientes": len(borrar_pend), "filas_pendientes": borrar_pend}
+
+
+@metricas.medir("sheets.cargar_indices")
+def cargar_indices():
+    """
+    Carga Usuarios, Comercios y las colas de Pendientes y de los email_id de
+    Gastos de la planilla principal con una sola request (values_batch_get de
+    los cuatro rangos), y después las tres hojas de cada planilla del registro
+    con una request por planilla.
+    """
+    with planillas.usar(planillas.principal()):
+        cargar_planilla(con_usuarios=True)
+    for sheet_id in sorted(planillas_registradas() - {None}):
+        with planillas.usar(sheet_id):
+            try:
+                cargar_planilla()
+            except Exception as e:
+                # Una planilla mal configurada no deja sin servicio a los demás;
+                # sus índices se vuelven a pedir en el primer uso
+                print(f"Sheets: no pude cargar la planilla {sheet_id}: {e}")
+
+
+@metricas.medir("sheets.cargar_planilla")
+def cargar_planilla(con_usuarios: bool = False):
+    """Carga los índices de la planilla actual en una sola request."""
+    map_tab = os.getenv("GOOGLE_MAP_TAB", "Comercios")
+    gastos_tab = os.getenv("GOOGLE_SHEET_TAB", "Gastos")
+    # Usuarios no se bloquea durante la lectura (se consulta desde el event
+    # loop): se reemplaza al final si no hubo escrituras propias entremedio
+    version = _usuarios["version"]
+    with _comercios_lock, _pendientes_lock, _gastos_lock:
+        desde_pend = _pendientes["last_row"] + 1
+        desde_gastos = _gastos["last_row"] + 1
+        pedidos = [
+            (map_tab, COLS_COMERCIOS, 2),
+            ("Pendientes", COLS_PENDIENTES, desde_pend),
+            (gastos_tab, COLS_GASTOS_ID, desde_gastos),
+        ]
+        if con_usuarios:
+            pedidos.insert(0, ("Usuarios", COLS_USUARIOS, 2))
+        resultados = leer_rangos(pedidos)
+        usuarios = resultados.pop(0) if con_usuarios else None
+        comercios, pendientes, gastos = resultados
+        _indexar_comercios(comercios, 2)
+        registros, ultima = _parsear_pendientes(pendientes, desde_pend)
+        _indexar_pendientes(registros, ultima)
+        _indexar_gastos(gastos, desde_gastos)
+        if desde_pend == 2 and desde_gastos == 2:
+            _revalidacion["completa"] = time.time()
+    # Ya sin los locks de la planilla: _usuarios_lock va al final del orden
+    if con_usuarios and _indexar_usuarios(usuarios, 2, version) is None:
+        refresh_usuarios()
+
+
+# -------------------------
+# REVALIDACIÓN (detección barata de cambios)
+# -------------------------
+# En vez de volver a bajar las hojas para saber si cambiaron (en cada planilla
+# que ya tenga índices cargados):
+# 1. modifiedTime de la planilla (Drive, una request chica para todas las hojas).
+#    Si no cambió desde el último sondeo, los índices siguen válidos.
+# 2. Si cambió: la "cola" de cada hoja (clave de la última fila conocida y la
+#    fila siguiente) en un solo values_batch_get. Si no coincide, hubo filas
+#    nuevas o borradas en esa hoja y solo esa se recarga.
+# 3. Si cambió, Usuarios y Comercios se recargan siempre (son chicas): no hay
+#    forma de probar que todos los cambios fueron escrituras nuestras, y una
+#    edición a mano en el medio de la hoja no mueve las colas.
+# 4. Pendientes y Gastos son grandes: una edición en el medio solo se ve con
+#    una recarga completa, cada REVALIDACION_COMPLETA_S segundos (también
+#    rearma los totales de /resumen y reescribe el snapshot).
+_revalidacion = planillas.PorPlanilla(lambda: {
+    "modified": None,      # último modifiedTime visto
+    "escrituras": 0,       # _escrituras_propias de la planilla en ese momento
+    "completa": 0,         # última recarga completa de Pendientes y Gastos
+    "stats": Counter(),
+})
+
+
+def _modified_time() -> str | None:
+    """modifiedTime de la planilla, o None si Drive no está disponible."""
+    try:
+        return _llamar_planilla(_get_sheet_id(), "read", "get_lastUpdateTime")
+    except Exception as e:
+        _revalidacion["stats"]["drive_no_disponible"] += 1
+        if _revalidacion["stats"]["drive_no_disponible"] == 1:
+            print(f"Revalidación: no pude leer modifiedTime de {_get_sheet_id()} ({e}); uso solo el sondeo de colas")
+        return None
+
+
+def _clave_en_fila(rows: dict, fila: int) -> str | None:
+    for clave, entry in rows.items():
+        if entry["row"] == fila:
+            return clave
+    return None
+
+
+def _colas() -> dict:
+    """tab -> (columna clave, fila de la última clave conocida, clave esperada o None)."""
+    map_tab = os.getenv("GOOGLE_MAP_TAB", "Comercios")
+    gastos_tab = os.getenv("GOOGLE_SHEET_TAB", "Gastos")
+    with _comercios_lock, _pendientes_lock, _gastos_lock:
+        colas = {
+            map_tab: ("A", _comercios["next_row"] - 1, _clave_en_fila(_comercios["rows"], _comercios["next_row"] - 1)),
+            "Pendientes": ("A", _pendientes["last_row"], _pendientes["by_row"].get(_pendientes["last_row"])),
+        }
+        if _gastos["ts"]:
+            colas[gastos_tab] = ("J", _gastos["last_row"], _gastos["ultima"])
+    if planillas.es_principal():
+        with _usuarios_lock:
+            colas["Usuarios"] = ("A", _usuarios["next_row"] - 1, _clave_en_fila(_usuarios["rows"], _usuarios["next_row"] - 1))
+    return colas
+
+
+def _sondear_colas() -> set[str]:
+    """Hojas cuya cola no coincide con el índice (una sola lectura)."""
+    colas = _colas()
+    pedidos = []
+    for tab, (col, fila, _) in colas.items():
+        pedidos.append(absolute_range_name(tab, f"{col}{max(fila, 1)}:{col}{max(fila, 1) + 1}"))
+    resp = _llamar_planilla(_get_sheet_id(), "read", "values_batch_get", pedidos)
+    rangos = resp.get("valueRanges", [])
+
+    cambiadas = set()
+    for i, (tab, (_, fila, esperada)) in enumerate(colas.items()):
+        values = rangos[i].get("values", []) if i < len(rangos) else []
+        actual = str(values[0][0]).strip().upper() if values and values[0] else ""
+        siguiente = values[1][0] if len(values) > 1 and values[1] else ""
+        if str(siguiente).strip():
+            cambiadas.add(tab)          # hay filas nuevas
+        elif fila > 1 and esperada is not None and actual != esperada.strip().upper():
+            cambiadas.add(tab)          # filas borradas o movidas
+    return cambiadas
+
+
+def _planillas_cargadas() -> list[str]:
+    """La principal y las demás que ya tienen índices en memoria."""
+    principal = planillas.principal()
+    return [principal] + sorted(set(_comercios.planillas()) - {principal})
+
+
+@metricas.medir("sheets.revalidar")
+def revalidar() -> set[str]:
+    """
+    Revalida los índices con sondeos baratos y recarga solo lo que cambió.
+    Retorna las hojas recargadas ("planilla/hoja" si no es la principal).
+    """
+    if not usuarios_cargados():
+        _revalidacion["stats"]["sondeos"] += 1
+        cargar_indices()
+        return {"todas"}
+
+    principal = planillas.principal()
+    cambiadas = set()
+    for sheet_id in _planillas_cargadas():
+        with planillas.usar(sheet_id):
+            tabs = _revalidar_planilla()
+        cambiadas |= tabs if sheet_id == principal else {f"{sheet_id}/{tab}" for tab in tabs}
+    if any(tab.endswith("completa") for tab in cambiadas):
+        # El snapshot en disco tiene las filas de antes de la recarga completa:
+        # se reescribe ya, para que un reinicio no las reviva. (Usuarios y
+        # Comercios se recargan en la primera revalidación tras arrancar.)
+        from services import snapshot
+        snapshot.guardar()
+    return cambiadas
+
+
+def _revalidar_planilla() -> set[str]:
+    stats = _revalidacion["stats"]
+    stats["sondeos"] += 1
+    principal = planillas.es_principal()
+
+    escrituras = _escrituras_propias[_get_sheet_id()]
+    modified = _modified_time()
+    if modified is not None and modified == _revalidacion["modified"]:
+        stats["sin_cambios"] += 1
+        # Los índices siguen válidos: se renueva su vigencia sin leerlos
+        with _comercios_lock:
+            _comercios["ts"] = time.time()
+        if principal:
+            with _usuarios_lock:
+                _usuarios["ts"] = time.time()
+        return set()
+
+    cambiadas = _sondear_colas()
+    map_tab = os.getenv("GOOGLE_MAP_TAB", "Comercios")
+    gastos_tab = os.getenv("GOOGLE_SHEET_TAB", "Gastos")
+    if modified is not None:
+        # Aunque también hayamos escrito, pudo haber una edición a mano
+        cambiadas |= {"Usuarios", map_tab} if principal else {map_tab}
+        stats["edicion_a_mano" if escrituras == _revalidacion["escrituras"] else "cambio_no_atribuible"] += 1
+    elif modified is None and principal and time.time() - _usuarios["ts"] > float(os.getenv("USUARIOS_REFRESH_S", "120")):
+        # Sin Drive no se ven las ediciones a mano: Usuarios se recarga por tiempo
+        cambiadas.add("Usuarios")
+
+    if "Usuarios" in cambiadas:
+        refresh_usuarios()
+    if map_tab in cambiadas:
+        refresh_comercios()
+    if time.time() - _revalidacion["completa"] > float(os.getenv("REVALIDACION_COMPLETA_S", "3600")):
+        refresh_pendientes(full=True)
+        refresh_gastos(full=True)
+        # Los totales se rearman con la próxima consulta, desde Gastos entera
+        agregados.rehacer()
+        _revalidacion["completa"] = time.time()
+        cambiadas -= {"Pendientes", gastos_tab}
+        cambiadas.add("completa")
+    if "Pendientes" in cambiadas:
+        # Filas nuevas: basta la cola. Si la última fila ya no coincide, recarga entera.
+        with _pendientes_lock:
+            ultima = _pendientes["last_row"]
+        refresh_pendientes()
+        if _pendientes["last_row"] == ultima:
+            refresh_pendientes(full=True)
+    if gastos_tab in cambiadas:
+        with _gastos_lock:
+            ultima = _gastos["last_row"]
+        refresh_gastos()
+        if _gastos["last_row"] == ultima:
+            refresh_gastos(full=True)
+
+    for tab in cambiadas:
+        stats[f"recargas.{tab}"] += 1
+    _revalidacion["modified"] = modified
+    _revalidacion["escrituras"] = escrituras
+    return cambiadas
+
+
+def revalidacion_stats() -> dict:
+    """Contadores de la revalidación, sumados entre planillas."""
+    total = Counter()
+    for sheet_id in _revalidacion.planillas():
+        total.update(_revalidacion.de(sheet_id)["stats"])
+    return dict(total)
+
+
+# -------------------------
+# SNAPSHOT (arranque en caliente)
+# -------------------------
+def exportar_indices() -> dict:
+    """Copia de los índices lista para json.dump (la usa services.snapshot)."""
+    with _usuarios_lock:
+        data = {
+            "usuarios": {
+                "rows": {k: dict(v) for k, v in _usuarios["rows"].items()},
+                "next_row": _usuarios["next_row"],
+                "ts": _usuarios["ts"],
+            },
+            "planillas": {},
+        }
+    for sheet_id in _planillas_cargadas():
+        with planillas.usar(sheet_id):
+            data["planillas"][sheet_id] = _exportar_planilla()
+    return data
+
+
+def _exportar_planilla() -> dict:
+    with _comercios_lock, _pendientes_lock, _gastos_lock:
+        return {
+            "comercios": {
+                "rows": {k: dict(v) for k, v in _comercios["rows"].items()},
+                "next_row": _comercios["next_row"],
+                "ts": _comercios["ts"],
+            },
+            "pendientes": {
+                "rows": [[idx, dict(data)] for idx, data in _pendientes["rows"].values()],
+                "last_row": _pendientes["last_row"],
+            },
+            "agregados": agregados.exportar(),
+            "completa": _revalidacion["completa"],
+            "gastos": {
+                "ids": sorted(_gastos["ids"]),
+                "last_row": _gastos["last_row"],
+                "ultima": _gastos["ultima"],
+                "ts": _gastos["ts"],
+            },
+        }
+
+
+def importar_indices(data: dict) -> bool:
+    """
+    Carga índices exportados con exportar_indices(). Solo si todavía no hay
+    nada cargado: nunca pisa datos más nuevos leídos de la hoja.
+    """
+    with _usuarios_lock:
+        if usuarios_cargados():
+            return False
+        u = data["usuarios"]
+        for entry in u["rows"].values():
+            entry.setdefault("planilla", None)
+        _usuarios.update(rows=u["rows"], next_row=u["next_row"], ts=u["ts"])
+
+    for sheet_id, datos in data["planillas"].items():
+        with planillas.usar(sheet_id):
+            _importar_planilla(datos)
+    return True
+
+
+def _importar_planilla(data: dict):
+    with _comercios_lock, _pendientes_lock, _gastos_lock:
+        if _comercios["ts"] or _pendientes["rows"]:
+            return
+
+        c = data["comercios"]
+        cats = Counter(e["categoria"] for e in c["rows"].values() if e["categoria"])
+        _comercios.update(rows=c["rows"], cats=cats, next_row=c["next_row"], ts=c["ts"])
+        _nueva_version_cats()
+
+        p = data["pendientes"]
+        _indexar_pendientes([(idx, d) for idx, d in sorted(p["rows"], key=lambda r: r[0])], p["last_row"])
 
-    return None, None
+        agregados.importar(data["agregados"])
+        # La antigüedad de las filas del snapshot cuenta para la próxima recarga completa
+        _revalidacion["completa"] = data.get("completa", 0)
+        g = data["gastos"]
+        _gastos.update(ids=set(g["ids"]) | _gastos["ids"], last_row=g["last_row"], ultima=g["ultima"], ts=g["ts"])
 
 
-def mark_pendiente_ok(row_index: int):
-    """Marca estado = OK en hoja Pendientes (columna G)."""
-    ws = _open_ws("Pendientes")
-    ws.update_acell(f"G{row_index}", "OK")
+def reset_indices():
+    """Olvida los índices en memoria; el siguiente uso los recarga desde la hoja."""
+    with _usuarios_lock:
+        _usuarios.update(rows={}, next_row=2, ts=0)
+    # Cada planilla vuelve a crear su estado vacío en el siguiente uso
+    _comercios.reset()
+    _pendientes.reset()
+    _gastos.reset()
+    agregados.reset()
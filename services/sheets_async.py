@@ -0,0 +1,132 @@
+"""
+Versión awaitable de la API de almacenamiento (services.storage: Sheets o SQLite).
+
+Los backends son síncronos: cada llamada se ejecuta en un pool de hilos acotado
+(SHEETS_MAX_WORKERS, por defecto 8) para no bloquear el event loop del bot.
+"""
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from services import cuota, storage
+
+_executor: ThreadPoolExecutor | None = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        workers = int(os.getenv("SHEETS_MAX_WORKERS", "8"))
+        _executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="sheets")
+    return _executor
+
+
+def shutdown(wait: bool = True):
+    """Cierra el pool de hilos (se llama al apagar el bot)."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
+
+
+async def run(fn, *args, **kwargs):
+    """Ejecuta fn(*args, **kwargs) en el pool de Sheets y espera el resultado."""
+    loop = asyncio.get_running_loop()
+    # Copiamos el contexto para que la prioridad de cuota (services.cuota) y la
+    # planilla del chat (services.planillas) viajen al hilo
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), partial(ctx.run, fn, *args, **kwargs))
+
+
+async def refrescar_cada(fn, segundos: float, nombre: str):
+    """Loop de fondo: ejecuta fn en el pool cada `segundos`, con prioridad de fondo."""
+    while True:
+        await asyncio.sleep(segundos)
+        try:
+            with cuota.prioridad(cuota.FONDO):
+                await run(fn)
+        except Exception as e:
+            print(f"Error refrescando {nombre}: {e}")
+
+
+async def cargar_indices():
+    return await run(storage.backend().cargar_indices)
+
+
+# -------------------------
+# USUARIOS
+# -------------------------
+async def get_estado_usuario(chat_id: int) -> str | None:
+    # Con el índice ya cargado es solo memoria y sin locks: no pasamos por el pool de hilos
+    if storage.backend().usuarios_cargados():
+        return storage.backend().get_estado_usuario(chat_id)
+    return await run(storage.backend().get_estado_usuario, chat_id)
+
+
+async def get_usuarios_autorizados() -> set[int]:
+    if storage.backend().usuarios_cargados():
+        return storage.backend().get_usuarios_autorizados()
+    return await run(storage.backend().get_usuarios_autorizados)
+
+
+async def upsert_usuario(chat_id: int, nombre: str, estado: str, si_estado: str | None = None) -> bool:
+    return await run(storage.backend().upsert_usuario, chat_id, nombre, estado, si_estado=si_estado)
+
+
+async def refresh_usuarios():
+    return await run(storage.backend().refresh_usuarios)
+
+
+# -------------------------
+# MAPPINGS (Comercios)
+# -------------------------
+async def get_unique_categories():
+    return await run(storage.backend().get_unique_categories)
+
+
+async def get_mapping(comercio_raw: str):
+    return await run(storage.backend().get_mapping, comercio_raw)
+
+
+async def upsert_mapping(comercio_raw: str, alias: str, categoria: str | None = None):
+    return await run(storage.backend().upsert_mapping, comercio_raw, alias, categoria)
+
+
+async def refresh_comercios():
+    return await run(storage.backend().refresh_comercios)
+
+
+# -------------------------
+# GASTOS
+# -------------------------
+async def gasto_registrado(email_id: str) -> bool:
+    return await run(storage.backend().gasto_registrado, email_id)
+
+
+async def append_gasto(**kwargs):
+    return await run(storage.backend().append_gasto, **kwargs)
+
+
+async def registrar_gasto(row_index: int, **kwargs):
+    return await run(storage.backend().registrar_gasto, row_index, **kwargs)
+
+
+async def resumen_mes(mes: str) -> dict:
+    return await run(storage.backend().resumen_mes, mes)
+
+
+# -------------------------
+# PENDIENTES
+# -------------------------
+async def get_pendiente(email_id: str):
+    return await run(storage.backend().get_pendiente, email_id)
+
+
+async def mark_pendiente_ok(row_index: int):
+    return await run(storage.backend().mark_pendiente_ok, row_index)
+
+
+async def refresh_pendientes(full: bool = False):
+    return await run(storage.backend().refresh_pendientes, full)
@@ -0,0 +1,68 @@
+"""
+Snapshot en disco de los índices de Sheets, para arrancar en caliente.
+
+Al reiniciar, el bot carga Usuarios y los Comercios, Pendientes y Gastos de
+cada planilla desde SNAPSHOT_PATH en milisegundos y atiende de inmediato; las
+hojas se revalidan en segundo plano. El snapshot se reescribe cada SNAPSHOT_S segundos y al
+apagar. Con el backend SQLite no hace falta (los datos ya son locales).
+"""
+import json
+import os
+import time
+
+from services import metricas, sheets, storage
+
+VERSION = 2  # 2: índices separados por planilla
+
+
+def _path() -> str:
+    return os.getenv("SNAPSHOT_PATH", "data/snapshot.json")
+
+
+def _aplica() -> bool:
+    return storage.nombre_backend() == "sheets"
+
+
+@metricas.medir("snapshot.guardar")
+def guardar() -> bool:
+    """Escribe el snapshot (de forma atómica). False si no hay nada que guardar."""
+    if not _aplica() or not sheets.usuarios_cargados():
+        return False
+
+    data = {
+        "version": VERSION,
+        "sheet_id": os.getenv("GOOGLE_SHEET_ID", ""),
+        "ts": time.time(),
+        "indices": sheets.exportar_indices(),
+    }
+    path = _path()
+    carpeta = os.path.dirname(path)
+    if carpeta:
+        os.makedirs(carpeta, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, path)
+    return True
+
+
+@metricas.medir("snapshot.cargar")
+def cargar() -> bool:
+    """
+    Carga el snapshot en los índices de services.sheets. False si no hay, es
+    de otra planilla o versión, o tiene más de SNAPSHOT_MAX_S segundos.
+    """
+    if not _aplica() or not os.path.exists(_path()):
+        return False
+    try:
+        with open(_path(), encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Snapshot ilegible, se ignora: {e}")
+        return False
+
+    if data.get("version") != VERSION or data.get("sheet_id") != os.getenv("GOOGLE_SHEET_ID", ""):
+        return False
+    if time.time() - data.get("ts", 0) > float(os.getenv("SNAPSHOT_MAX_S", str(7 * 86400))):
+        return False
+    return sheets.importar_indices(data["indices"])
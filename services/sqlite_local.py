@@ -0,0 +1,52 @@
+"""
+Bases SQLite chicas del proceso (journal, ingesta, archivo).
+
+Cada módulo tiene su archivo y su esquema; aquí va lo común: conexiones
+cortas (una por operación, así sirven desde cualquier hilo del pool de
+services.sheets_async) y el esquema en WAL, creado y migrado una sola vez
+por proceso y ruta.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Rutas con el esquema ya creado (y migrado) en este proceso
+_iniciadas = set()
+_iniciadas_lock = threading.Lock()
+
+
+def _iniciar(path: str, esquema: str, migrar=None):
+    with _iniciadas_lock:
+        if path in _iniciadas:
+            return
+        carpeta = os.path.dirname(path)
+        if carpeta:
+            os.makedirs(carpeta, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=10)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(esquema)
+            if migrar is not None:
+                with conn:
+                    migrar(conn)
+        finally:
+            conn.close()
+        _iniciadas.add(path)
+
+
+@contextmanager
+def conectar(path: str, esquema: str, migrar=None):
+    """
+    Conexión corta a `path`: commit al salir sin error y siempre cierra. La
+    primera vez en el proceso crea la carpeta y el esquema, y corre
+    migrar(conn) si se pasa.
+    """
+    if path not in _iniciadas:
+        _iniciar(path, esquema, migrar)
+    conn = sqlite3.connect(path, timeout=10)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
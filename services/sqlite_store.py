@@ -0,0 +1,422 @@
+"""
+Backend local en SQLite con la misma API que services.sheets.
+
+Usuarios, Comercios, Gastos y Pendientes viven en tablas indexadas por
+chat_id, comercio_raw normalizado y email_id. Cada escritura deja una marca
+en la tabla `cambios` para que services.mirror la replique al spreadsheet.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import nullcontext
+from datetime import date
+
+from services import agregados
+from services.storage import CATEGORIAS_BASE, norm_comercio
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usuarios (
+    chat_id TEXT PRIMARY KEY,
+    nombre  TEXT NOT NULL DEFAULT '',
+    estado  TEXT,
+    fecha   TEXT
+);
+CREATE TABLE IF NOT EXISTS comercios (
+    clave        TEXT PRIMARY KEY,   -- comercio_raw normalizado (strip + upper)
+    comercio_raw TEXT NOT NULL,
+    alias        TEXT,
+    categoria    TEXT
+);
+CREATE INDEX IF NOT EXISTS comercios_categoria ON comercios (categoria);
+CREATE TABLE IF NOT EXISTS gastos (
+    id             INTEGER PRIMARY KEY,
+    fecha          TEXT,
+    hora           TEXT,
+    descripcion    TEXT,
+    monto          INTEGER,
+    categoria      TEXT,
+    comercio_raw   TEXT,
+    comercio_alias TEXT,
+    usuario        TEXT,
+    chat_id        TEXT,
+    email_id       TEXT
+);
+CREATE INDEX IF NOT EXISTS gastos_email_id ON gastos (email_id);
+CREATE INDEX IF NOT EXISTS gastos_chat_id ON gastos (chat_id);
+CREATE INDEX IF NOT EXISTS gastos_fecha ON gastos (fecha);
+CREATE TABLE IF NOT EXISTS pendientes (
+    id           INTEGER PRIMARY KEY,
+    email_id     TEXT NOT NULL UNIQUE,
+    fecha_email  TEXT,
+    hora_email   TEXT,
+    monto        INTEGER,
+    comercio_raw TEXT,
+    descripcion  TEXT,
+    estado       TEXT NOT NULL DEFAULT '',
+    sheet_row    INTEGER             -- fila en la hoja Pendientes, si vino de ahí
+);
+CREATE TABLE IF NOT EXISTS cambios (
+    id    INTEGER PRIMARY KEY,
+    tabla TEXT NOT NULL,
+    clave TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    clave TEXT PRIMARY KEY,
+    valor TEXT
+);
+"""
+
+_local = threading.local()
+
+
+def _path() -> str:
+    return os.getenv("SQLITE_PATH", "data/gastobot.sqlite3")
+
+
+def _conn() -> sqlite3.Connection:
+    """Una conexión por hilo (el pool de services.sheets_async usa varios)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        path = _path()
+        carpeta = os.path.dirname(path)
+        if carpeta:
+            os.makedirs(carpeta, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        _local.conn = conn
+    return conn
+
+
+def _cambio(conn, tabla: str, clave):
+    conn.execute("INSERT INTO cambios (tabla, clave) VALUES (?, ?)", (tabla, str(clave)))
+
+
+# -------------------------
+# USUARIOS
+# -------------------------
+def usuarios_cargados() -> bool:
+    # No hay índice en memoria: la consulta puede esperar el busy_timeout de
+    # SQLite, así que sheets_async la manda al pool de hilos y no al event loop
+    return False
+
+
+def refresh_usuarios():
+    return None
+
+
+def cargar_indices():
+    # No hay índices en memoria que precargar
+    return None
+
+
+def revalidar():
+    # Los datos son locales: no hay caché que revalidar
+    return set()
+
+
+def planilla_de(chat_id) -> str | None:
+    # Una sola base local: no hay planillas por chat
+    return None
+
+
+def en_planilla(chat_id):
+    return nullcontext()
+
+
+def planillas_registradas() -> set:
+    return {None}
+
+
+def get_estado_usuario(chat_id: int) -> str | None:
+    row = _conn().execute("SELECT estado FROM usuarios WHERE chat_id = ?", (str(chat_id),)).fetchone()
+    return row["estado"] if row else None
+
+
+def get_usuarios_autorizados() -> set[int]:
+    rows = _conn().execute("SELECT chat_id FROM usuarios WHERE estado = 'AUTORIZADO'").fetchall()
+    return {int(r["chat_id"]) for r in rows if r["chat_id"].lstrip("-").isdigit()}
+
+
+def upsert_usuario(chat_id: int, nombre: str, estado: str, plan=None, si_estado: str | None = None) -> bool:
+    """
+    Con si_estado solo escribe si el estado actual es ese ("" = el chat no
+    está registrado). La condición va en la misma sentencia (WHERE estado = ?),
+    así dos procesos no se pisan. Retorna si escribió.
+    """
+    fila = (str(chat_id), nombre, estado.strip().upper(), str(date.today()))
+    conn = _conn()
+    with conn:
+        if si_estado is None:
+            cur = conn.execute(
+                "INSERT INTO usuarios (chat_id, nombre, estado, fecha) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET nombre = excluded.nombre, estado = excluded.estado",
+                fila,
+            )
+        elif not si_estado.strip():
+            cur = conn.execute(
+                "INSERT INTO usuarios (chat_id, nombre, estado, fecha) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET nombre = excluded.nombre, estado = excluded.estado "
+                "WHERE COALESCE(usuarios.estado, '') = ''",
+                fila,
+            )
+        else:
+            cur = conn.execute(
+                "UPDATE usuarios SET nombre = ?, estado = ? WHERE chat_id = ? AND estado = ?",
+                (nombre, fila[2], fila[0], si_estado.strip().upper()),
+            )
+        if not cur.rowcount:
+            return False
+        _cambio(conn, "usuarios", chat_id)
+    return True
+
+
+# -------------------------
+# MAPPINGS (Comercios)
+# -------------------------
+_cats_version = 0
+
+
+def refresh_comercios():
+    return None
+
+
+def categorias_version() -> int:
+    """Sube cuando este proceso agrega una categoría nueva."""
+    return _cats_version
+
+
+def get_unique_categories():
+    rows = _conn().execute(
+        "SELECT DISTINCT categoria FROM comercios WHERE categoria IS NOT NULL AND categoria != ''"
+    ).fetchall()
+    return sorted(set(CATEGORIAS_BASE).union(r["categoria"] for r in rows))
+
+
+def get_mapping(comercio_raw: str):
+    """Retorna (alias, categoria) o (None, None)."""
+    row = _conn().execute(
+        "SELECT alias, categoria FROM comercios WHERE clave = ?", (norm_comercio(comercio_raw),)
+    ).fetchone()
+    if not row:
+        return None, None
+    return (row["alias"] or None), (row["categoria"] or None)
+
+
+def _upsert_mapping(conn, comercio_raw: str, alias: str, categoria: str | None):
+    global _cats_version
+    clave = norm_comercio(comercio_raw)
+    if categoria and not conn.execute("SELECT 1 FROM comercios WHERE categoria = ? LIMIT 1", (categoria,)).fetchone():
+        _cats_version += 1
+    if categoria is None:
+        conn.execute(
+            "INSERT INTO comercios (clave, comercio_raw, alias, categoria) VALUES (?, ?, ?, '') "
+            "ON CONFLICT (clave) DO UPDATE SET alias = excluded.alias",
+            (clave, comercio_raw, alias),
+        )
+    else:
+        conn.execute(
+            "INSERT INTO comercios (clave, comercio_raw, alias, categoria) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (clave) DO UPDATE SET alias = excluded.alias, categoria = excluded.categoria",
+            (clave, comercio_raw, alias, categoria),
+        )
+    _cambio(conn, "comercios", clave)
+
+
+def upsert_mapping(comercio_raw: str, alias: str, categoria: str | None = None, plan=None):
+    conn = _conn()
+    with conn:
+        _upsert_mapping(conn, comercio_raw, alias, categoria)
+
+
+# -------------------------
+# GASTOS
+# -------------------------
+_GASTO_COLS = (
+    "fecha", "hora", "descripcion", "monto", "categoria",
+    "comercio_raw", "comercio_alias", "usuario", "chat_id", "email_id",
+)
+
+
+def _append_gasto(conn, **gasto):
+    valores = [gasto[c] for c in _GASTO_COLS]
+    valores[_GASTO_COLS.index("chat_id")] = str(gasto["chat_id"])
+    cur = conn.execute(
+        f"INSERT INTO gastos ({', '.join(_GASTO_COLS)}) VALUES ({', '.join('?' * len(_GASTO_COLS))})",
+        valores,
+    )
+    _cambio(conn, "gastos", cur.lastrowid)
+
+
+def gasto_registrado(email_id: str) -> bool:
+    row = _conn().execute("SELECT 1 FROM gastos WHERE email_id = ? LIMIT 1", (str(email_id).strip(),)).fetchone()
+    return row is not None
+
+
+def append_gasto(plan=None, **gasto):
+    conn = _conn()
+    with conn:
+        _append_gasto(conn, **gasto)
+
+
+def resumen_mes(mes: str) -> dict:
+    """Totales de un mes ("YYYY-MM"), agrupados en SQL sobre el índice por fecha."""
+    rows = _conn().execute(
+        "SELECT categoria, comercio_alias, usuario, SUM(monto) AS total, COUNT(*) AS n FROM gastos "
+        "WHERE fecha >= ? AND fecha < ? GROUP BY categoria, comercio_alias, usuario",
+        (mes, f"{mes}-99"),
+    ).fetchall()
+    resumen = agregados.vacio()
+    for r in rows:
+        agregados.acumular(resumen, r["categoria"], r["comercio_alias"], r["usuario"], r["total"] or 0, n=r["n"])
+    return resumen
+
+
+def registrar_gasto(row_index: int, flujo: str = "registrar_gasto", **gasto):
+    return registrar_gastos([dict(gasto, row_index=row_index)], flujo=flujo)
+
+
+def registrar_gastos(gastos: list[dict], flujo: str = "registrar_gastos"):
+    """Gastos + Comercios + Pendientes OK en una sola transacción."""
+    conn = _conn()
+    with conn:
+        # Toma el lock de escritura antes del chequeo: con varios procesos
+        # (bot.trabajadores) dos lotes no ven "no registrado" a la vez
+        conn.execute("BEGIN IMMEDIATE")
+        for gasto in gastos:
+            gasto = dict(gasto)
+            row_index = gasto.pop("row_index")
+            # Ya está en Gastos: solo se asegura el OK en Pendientes
+            if not gasto_registrado(gasto["email_id"]):
+                _append_gasto(conn, **gasto)
+                _upsert_mapping(conn, gasto["comercio_raw"], gasto["comercio_alias"], gasto["categoria"])
+            _mark_pendiente_ok(conn, row_index)
+    return 0
+
+
+def importar_gastos(gastos: list[dict], flujo: str = "importar_gastos") -> int:
+    """Solo filas de Gastos (sin Pendientes ni Comercios), en una transacción."""
+    conn = _conn()
+    escritos = 0
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for gasto in gastos:
+            if not gasto_registrado(gasto["email_id"]):
+                _append_gasto(conn, **gasto)
+                escritos += 1
+    return escritos
+
+
+# -------------------------
+# PENDIENTES
+# -------------------------
+def refresh_pendientes(full: bool = False):
+    # Las filas nuevas llegan por services.mirror.pull_pendientes()
+    return None
+
+
+def _pendiente_dict(row) -> dict:
+    return {
+        "email_id": row["email_id"],
+        "fecha_email": row["fecha_email"],
+        "hora_email": row["hora_email"],
+        "monto": row["monto"],
+        "comercio_raw": row["comercio_raw"],
+        "desc": row["descripcion"] or "Compra Tarjeta Crédito",
+        "estado": row["estado"] or "",
+    }
+
+
+def get_pendiente(email_id: str):
+    """Retorna (row_index, data_dict) o (None, None)."""
+    row = _conn().execute(
+        "SELECT * FROM pendientes WHERE email_id = ?", (str(email_id).strip(),)
+    ).fetchone()
+    if not row:
+        return None, None
+    return row["id"], _pendiente_dict(row)
+
+
+def pendientes_nuevos(desde_fila: int):
+    """Pendientes con id > desde_fila: ([(id, data_dict), ...], último id)."""
+    rows = _conn().execute("SELECT * FROM pendientes WHERE id > ? ORDER BY id", (desde_fila,)).fetchall()
+    return [(r["id"], _pendiente_dict(r)) for r in rows], (rows[-1]["id"] if rows else desde_fila)
+
+
+def _mark_pendiente_ok(conn, row_index: int):
+    conn.execute("UPDATE pendientes SET estado = 'OK' WHERE id = ?", (row_index,))
+    _cambio(conn, "pendientes", row_index)
+
+
+def mark_pendiente_ok(row_index: int, plan=None):
+    conn = _conn()
+    with conn:
+        _mark_pendiente_ok(conn, row_index)
+
+
+def insertar_pendientes(registros: list, sheet: bool = True) -> int:
+    """
+    Agrega pendientes [(fila, data_dict), ...] (ignora email_id repetidos).
+    Con sheet=True la fila se guarda como su posición en la hoja Pendientes.
+    """
+    conn = _conn()
+    with conn:
+        cur = conn.executemany(
+            "INSERT OR IGNORE INTO pendientes "
+            "(email_id, fecha_email, hora_email, monto, comercio_raw, descripcion, estado, sheet_row) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    str(d["email_id"]).strip(), d["fecha_email"], d["hora_email"], d["monto"],
+                    d["comercio_raw"], d["desc"], d["estado"], fila if sheet else None,
+                )
+                for fila, d in registros
+            ],
+        )
+    return cur.rowcount
+
+
+# -------------------------
+# ESPEJO (para services.mirror)
+# -------------------------
+def get_meta(clave: str, default: str | None = None) -> str | None:
+    row = _conn().execute("SELECT valor FROM meta WHERE clave = ?", (clave,)).fetchone()
+    return row["valor"] if row else default
+
+
+def set_meta(clave: str, valor: str):
+    conn = _conn()
+    with conn:
+        conn.execute(
+            "INSERT INTO meta (clave, valor) VALUES (?, ?) "
+            "ON CONFLICT (clave) DO UPDATE SET valor = excluded.valor",
+            (clave, str(valor)),
+        )
+
+
+def metas(prefijo: str) -> dict:
+    """Todas las claves de meta que empiezan con `prefijo` -> valor."""
+    rows = _conn().execute(
+        "SELECT clave, valor FROM meta WHERE substr(clave, 1, ?) = ?", (len(prefijo), prefijo)
+    ).fetchall()
+    return {r["clave"]: r["valor"] for r in rows}
+
+
+def cambios(limite: int = 500) -> list:
+    return _conn().execute("SELECT id, tabla, clave FROM cambios ORDER BY id LIMIT ?", (limite,)).fetchall()
+
+
+def borrar_cambios(ids: list[int]):
+    conn = _conn()
+    with conn:
+        conn.executemany("DELETE FROM cambios WHERE id = ?", [(i,) for i in ids])
+
+
+def leer(tabla: str, columna: str, clave):
+    """Fila actual de una tabla por su clave (usado al replicar cambios)."""
+    return _conn().execute(f"SELECT * FROM {tabla} WHERE {columna} = ?", (clave,)).fetchone()
+
+
+def vacia(tabla: str) -> bool:
+    return _conn().execute(f"SELECT 1 FROM {tabla} LIMIT 1").fetchone() is None
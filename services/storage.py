@@ -0,0 +1,78 @@
+"""
+Selección del backend de almacenamiento.
+
+STORAGE_BACKEND=sheets (por defecto) usa Google Sheets vía gspread
+(services.sheets); STORAGE_BACKEND=sqlite usa la base local de
+services.sqlite_store. Ambos módulos exponen las mismas funciones (API).
+"""
+import importlib
+import os
+
+API = (
+    # Arranque
+    "cargar_indices",
+    "revalidar",
+    # Usuarios
+    "get_estado_usuario",
+    "get_usuarios_autorizados",
+    "upsert_usuario",
+    "refresh_usuarios",
+    "usuarios_cargados",
+    # Planillas (una por chat u hogar; ver services.planillas)
+    "planilla_de",
+    "en_planilla",
+    "planillas_registradas",
+    # Comercios
+    "get_unique_categories",
+    "categorias_version",
+    "get_mapping",
+    "upsert_mapping",
+    "refresh_comercios",
+    # Gastos
+    "gasto_registrado",
+    "append_gasto",
+    "registrar_gasto",
+    "registrar_gastos",
+    "importar_gastos",
+    "resumen_mes",
+    # Pendientes
+    "get_pendiente",
+    "pendientes_nuevos",
+    "mark_pendiente_ok",
+    "refresh_pendientes",
+)
+
+# Categorías que SIEMPRE aparecen en el teclado, se usen o no
+CATEGORIAS_BASE = ["Comida", "Supermercado", "Salud", "Transporte", "Hogar", "Ocio"]
+
+
+def norm_comercio(comercio_raw: str) -> str:
+    """Clave de un comercio en Comercios (igual en los dos backends y en la ingesta)."""
+    return (comercio_raw or "").strip().upper()
+
+
+BACKENDS = {
+    "sheets": "services.sheets",
+    "sqlite": "services.sqlite_store",
+}
+
+_backend = None
+
+
+def backend():
+    """Módulo del backend configurado (se resuelve una vez por proceso)."""
+    global _backend
+    if _backend is None:
+        nombre = os.getenv("STORAGE_BACKEND", "sheets").strip().lower()
+        if nombre not in BACKENDS:
+            raise RuntimeError(f"STORAGE_BACKEND inválido: {nombre!r} (usa {', '.join(BACKENDS)})")
+        modulo = importlib.import_module(BACKENDS[nombre])
+        faltan = [f for f in API if not callable(getattr(modulo, f, None))]
+        if faltan:
+            raise RuntimeError(f"El backend {nombre} no implementa: {', '.join(faltan)}")
+        _backend = modulo
+    return _backend
+
+
+def nombre_backend() -> str:
+    return os.getenv("STORAGE_BACKEND", "sheets").strip().lower()
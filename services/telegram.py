@@ -0,0 +1,211 @@
+"""
+Salida a Telegram: límite de tasa, ediciones que se pisan y reintentos.
+
+LimiteSalida se instala con ApplicationBuilder.rate_limiter(), así TODA
+llamada del bot a la API pasa por acá (respuestas, ediciones, avisos al
+admin, la ingesta):
+- cada una espera su turno en el bucket de su chat (TELEGRAM_CHAT_S por
+  segundo; los grupos, TELEGRAM_GRUPO_MIN por minuto) y después en el global
+  (TELEGRAM_GLOBAL_S por segundo, repartido entre los procesos);
+- una edición que todavía espera turno se descarta si llegó otra edición
+  del mismo mensaje: solo se manda la última;
+- un RetryAfter pausa el bucket global (y el del chat) lo que pida Telegram
+  y se reintenta, hasta TELEGRAM_REINTENTOS veces.
+
+provisional() es para los textos intermedios ("⏳ Guardando..."): sale solo
+si el flujo tarda más de TELEGRAM_PROVISIONAL_S; si antes llega la edición
+final del mismo mensaje, no se manda nunca.
+"""
+import asyncio
+import itertools
+import os
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from services import metricas
+
+_EDICIONES = {"editMessageText", "editMessageCaption", "editMessageReplyMarkup"}
+
+
+class _Bucket:
+    """Token bucket async; los turnos se dan en orden de llegada."""
+
+    def __init__(self, por_segundo: float, capacidad: float):
+        self.rate = por_segundo
+        self.capacidad = capacidad
+        self.tokens = capacidad
+        self.ts = time.monotonic()
+        self.pausa_hasta = 0.0
+        self.turno = asyncio.Lock()
+        self.esperando = 0
+
+    async def tomar(self, vigente=None) -> bool:
+        """
+        Espera un token y lo toma. Si vigente() pasa a False antes de que
+        toque (una edición pisada), retorna False sin gastar el token.
+        """
+        self.esperando += 1
+        try:
+            async with self.turno:
+                while True:
+                    if vigente is not None and not vigente():
+                        return False
+                    ahora = time.monotonic()
+                    self.tokens = min(self.capacidad, self.tokens + (ahora - self.ts) * self.rate)
+                    self.ts = ahora
+                    if self.pausa_hasta > ahora:
+                        await asyncio.sleep(self.pausa_hasta - ahora)
+                    elif self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+                    else:
+                        await asyncio.sleep((1 - self.tokens) / self.rate)
+        finally:
+            self.esperando -= 1
+
+    def devolver(self):
+        """Devuelve un token tomado que al final no se usó."""
+        self.tokens = min(self.capacidad, self.tokens + 1)
+
+    def pausar(self, segundos: float):
+        self.pausa_hasta = max(self.pausa_hasta, time.monotonic() + segundos)
+
+    def ocioso(self) -> bool:
+        return not self.esperando and self.tokens >= self.capacidad - 1e-9
+
+
+def _segundos(retry_after) -> float:
+    # int en PTB 21; timedelta en versiones nuevas
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+def _clave_mensaje(data: dict):
+    if data.get("inline_message_id"):
+        return ("inline", data["inline_message_id"])
+    if data.get("chat_id") is not None and data.get("message_id") is not None:
+        return (str(data["chat_id"]), int(data["message_id"]))
+    return None
+
+
+# Ediciones provisionales pendientes: clave de mensaje -> tarea
+_provisionales = {}
+
+
+def cancelar_provisional(clave):
+    """Descarta la edición provisional del mensaje (clave: (str(chat_id), message_id))."""
+    tarea = _provisionales.pop(clave, None)
+    if tarea is not None and tarea is not asyncio.current_task():
+        tarea.cancel()
+        metricas.contar("telegram.provisionales_evitadas")
+
+
+class LimiteSalida(BaseRateLimiter):
+    def __init__(self, procesos: int = 1):
+        self._global = _Bucket(
+            float(os.getenv("TELEGRAM_GLOBAL_S", "30")) / max(procesos, 1),
+            float(os.getenv("TELEGRAM_GLOBAL_RAFAGA", "30")) / max(procesos, 1),
+        )
+        self._chats = {}          # chat_id -> _Bucket
+        self._ultima = {}         # clave de mensaje -> seq de su edición más nueva
+        self._seq = itertools.count()
+        self._reintentos = int(os.getenv("TELEGRAM_REINTENTOS", "3"))
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _bucket_chat(self, chat_id) -> _Bucket:
+        clave = str(chat_id)
+        bucket = self._chats.get(clave)
+        if bucket is None:
+            if len(self._chats) > 1000:
+                # Se descartan los chats sin nada pendiente y con el bucket lleno
+                self._chats = {c: b for c, b in self._chats.items() if not b.ocioso()}
+            if clave.startswith("-"):
+                bucket = _Bucket(float(os.getenv("TELEGRAM_GRUPO_MIN", "20")) / 60, 3)
+            else:
+                bucket = _Bucket(float(os.getenv("TELEGRAM_CHAT_S", "1")), float(os.getenv("TELEGRAM_CHAT_RAFAGA", "5")))
+            self._chats[clave] = bucket
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        data = data or {}
+        clave = _clave_mensaje(data) if endpoint in _EDICIONES else None
+        seq = None
+        if clave is not None:
+            # Esta edición pisa a la provisional y a cualquiera que siga esperando turno
+            cancelar_provisional(clave)
+            seq = next(self._seq)
+            self._ultima[clave] = seq
+
+        def vigente():
+            return seq is None or self._ultima.get(clave) == seq
+
+        chat = self._bucket_chat(data["chat_id"]) if data.get("chat_id") is not None else None
+        try:
+            for intento in range(self._reintentos + 1):
+                with metricas.medir_bloque("telegram.espera"):
+                    # Una edición pisada mientras espera turno sale sin gastar
+                    # tokens del chat ni del global
+                    descartada = chat is not None and not await chat.tomar(vigente)
+                    if not descartada and not await self._global.tomar(vigente):
+                        if chat is not None:
+                            chat.devolver()
+                        descartada = True
+                    if descartada:
+                        metricas.contar("telegram.ediciones_descartadas")
+                        # Lo mismo que responde la API al editar un mensaje inline
+                        return True
+                try:
+                    metricas.contar("telegram.llamadas")
+                    return await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    if intento == self._reintentos:
+                        raise
+                    espera = _segundos(e.retry_after)
+                    metricas.contar("telegram.retry_after")
+                    print(f"Telegram: RetryAfter {espera:.0f}s en {endpoint}, reintento")
+                    self._global.pausar(espera)
+                    if chat is not None:
+                        chat.pausar(espera)
+        finally:
+            if seq is not None and self._ultima.get(clave) == seq:
+                del self._ultima[clave]
+
+    def estado(self) -> dict:
+        return {
+            "chats": len(self._chats),
+            "esperando": self._global.esperando,
+            "provisionales": len(_provisionales),
+        }
+
+
+def provisional(query, texto: str, **kwargs):
+    """
+    Edita el mensaje del callback con un texto intermedio, sin esperar: sale
+    recién después de TELEGRAM_PROVISIONAL_S y solo si para entonces no llegó
+    otra edición del mismo mensaje.
+    """
+    demora = float(os.getenv("TELEGRAM_PROVISIONAL_S", "0.7"))
+    msg = query.message
+    clave = (str(msg.chat_id), msg.message_id) if msg is not None else ("inline", query.inline_message_id)
+
+    async def _diferida():
+        await asyncio.sleep(demora)
+        # Ya en camino: desde acá solo la descarta LimiteSalida si la pisa otra
+        if _provisionales.get(clave) is asyncio.current_task():
+            del _provisionales[clave]
+        try:
+            await query.edit_message_text(texto, **kwargs)
+        except BadRequest as e:
+            print(f"Telegram: no pude mostrar {texto!r}: {e}")
+
+    cancelar_provisional(clave)
+    _provisionales[clave] = asyncio.create_task(_diferida())